@@ -13,8 +13,10 @@ import cv2 as cv
 import numpy as np
 import math
 import random
+import time
 
 from scipy.optimize import least_squares
+from scipy.sparse import coo_matrix
 from key_frame import KeyFrame
 from image_process import build_matching_graph, draw_matches
 from sequence_manager import SequenceManager
@@ -22,34 +24,65 @@ from transformation import TransFunction
 from util import overlap_pan_angle
 
 
-def _compute_residual(x, n_pose, n_landmark, n_residual, keypoints, src_pt_index, dst_pt_index, landmark_index, u, v,
+def _flatten_observations(points, src_pt_index, dst_pt_index, landmark_index):
+    """
+    Flatten pair-wise keypoint matches to observation arrays (once, before optimization).
+    Each match from image i to image j gives two observations of the landmark: in image i and in image j.
+    :param points: list of N*2 matrix, (x, y) in each frame
+    : src_pt_index, dst_pt_index, landmark_index: 2D list of indices
+    :return: pose index [K], landmark index [K], observed points [K, 2], K = 2 * match number
+    """
+    N = len(points)
+    assert len(src_pt_index) == N
+    assert len(dst_pt_index) == N
+    assert len(landmark_index) == N
+
+    obs_pose_index, obs_landmark_index, observations = [], [], []
+    for i in range(N):
+        assert len(src_pt_index[i]) == N
+        assert len(dst_pt_index[i]) == N
+        assert len(landmark_index[i]) == N
+        for j in range(N):
+            n_match = len(src_pt_index[i][j])
+            if n_match == 0:
+                continue
+            src = np.asarray(src_pt_index[i][j], dtype=np.int64)
+            dst = np.asarray(dst_pt_index[i][j], dtype=np.int64)
+            landmark = np.asarray(landmark_index[i][j], dtype=np.int64)
+
+            # point in camera i, then point in camera j
+            pts = np.empty((n_match, 2, 2))
+            pts[:, 0] = np.asarray(points[i])[src, 0:2]
+            pts[:, 1] = np.asarray(points[j])[dst, 0:2]
+            pose = np.empty((n_match, 2), dtype=np.int64)
+            pose[:, 0] = i
+            pose[:, 1] = j
+
+            obs_pose_index.append(pose.reshape(-1))
+            obs_landmark_index.append(np.repeat(landmark, 2))
+            observations.append(pts.reshape(-1, 2))
+
+    if len(observations) == 0:
+        return np.ndarray([0], dtype=np.int64), np.ndarray([0], dtype=np.int64), np.ndarray([0, 2])
+    return np.concatenate(obs_pose_index), np.concatenate(obs_landmark_index), np.concatenate(observations)
+
+
+def _compute_residual(x, n_pose, n_landmark, obs_pose_index, obs_landmark_index, observations, u, v,
                       reference_pose, verbose=False):
     """
     The function compute residuals form N - 1 camera poses and M landmarks
     :param x: N - 1 * 3 camera pose, pan, tilt, focal_length + M * 2 landmark, (pan, tilt)
     :n_pose: camera pose number, only N - 1 poses are actually optimized
     :n_landmark: landmark number
-    :n_residual: number of residuals
-    :param keypoints: list of N*2 matrix, (x, y) in each frame
-    : src_pt_index, dst_pt_index, landmark_index: 2D list of indices
+    : obs_pose_index, obs_landmark_index, observations: observation arrays from _flatten_observations
     :u, v: image center
     :reference_pose: camera pose of the reference frame. This frame must be the first frame
-    :return: residual
+    :return: residual, [K * 2] (dx, dy) of each observation
     """
     # check input dimension
     assert x.shape[0] == (n_pose - 1) * 3 + n_landmark * 2
-    N = len(keypoints)
-    assert n_pose == N
-    assert len(src_pt_index) == N
-    assert len(dst_pt_index) == N
-    assert len(landmark_index) == N
     assert reference_pose.shape[0] == 3
 
-    for i in range(N):
-        assert len(src_pt_index[i]) == N
-        assert len(dst_pt_index[i]) == N
-        assert len(landmark_index[i]) == N
-
     landmark_start_index = n_pose * 3
 
     # step 1: prepare data
@@ -58,56 +91,131 @@ def _compute_residual(x, n_pose, n_landmark, n_residual, keypoints, src_pt_index
     x0[0:3] = reference_pose  # first pose
     x0[3:] = x  # the rest pose and landmarks
 
-    residual = np.ndarray(n_residual)
-    residual_idx = 0
-
-    reprojection_err = 0.0
-    # step 2: compute residual
-    # loop each image pairs
-    for i in range(N):
-        for j in range(N):
-            pan1, tilt1, fl1 = x0[i * 3 + 0], x0[i * 3 + 1], x0[i * 3 + 2]  # estimated camera pose
-            pan2, tilt2, fl2 = x0[j * 3 + 0], x0[j * 3 + 1], x0[j * 3 + 2]
+    poses = x0[0:landmark_start_index].reshape(-1, 3)[obs_pose_index]
+    rays = x0[landmark_start_index:].reshape(-1, 2)[obs_landmark_index]
 
-            # loop each keypoint matches from image i to image j
-            for idx1, idx2, idx3 in zip(src_pt_index[i][j], dst_pt_index[i][j], landmark_index[i][j]):
-                pan, tilt = x0[landmark_start_index + idx3 * 2], x0[
-                    landmark_start_index + idx3 * 2 + 1]  # estimated landmark pan, tilt
-                x1, y1 = keypoints[i][idx1][0], keypoints[i][idx1][1]  # observation
-                x2, y2 = keypoints[j][idx2][0], keypoints[j][idx2][1]
-                proj_x1, proj_y1 = TransFunction.from_ray_to_image(u, v, fl1, pan1, tilt1, pan,
-                                                                     tilt)  # projection by pose and landmark
-                proj_x2, proj_y2 = TransFunction.from_ray_to_image(u, v, fl2, pan2, tilt2, pan, tilt)
-
-                # point in camera i
-                dx = proj_x1 - x1
-                dy = proj_y1 - y1
-
-                residual[residual_idx] = dx
-                residual_idx += 1
-                residual[residual_idx] = dy
-                residual_idx += 1
-                reprojection_err += math.sqrt(dx * dx + dy * dy)
-
-                # point in camera j
-                dx = proj_x2 - x2
-                dy = proj_y2 - y2
-                residual[residual_idx] = dx
-                residual_idx += 1
-                residual[residual_idx] = dy
-                residual_idx += 1
-                reprojection_err += math.sqrt(dx * dx + dy * dy)
-
-    assert residual_idx == n_residual
+    # step 2: compute residual of all observations
+    proj_x, proj_y = TransFunction.from_ray_to_image_array(u, v, poses[:, 2], poses[:, 0], poses[:, 1],
+                                                           rays[:, 0], rays[:, 1])
+    residual = np.empty((len(observations), 2))
+    residual[:, 0] = proj_x - observations[:, 0]
+    residual[:, 1] = proj_y - observations[:, 1]
 
     # debug
     if verbose:
-        print("reprojection error is %f" % (reprojection_err / (n_residual / 2)))
-    return residual
+        reprojection_err = np.sum(np.sqrt(np.sum(residual * residual, axis=1)))
+        print("reprojection error is %f" % (reprojection_err / len(observations)))
+    return residual.reshape(-1)
+
+
+def _sparsity_pattern(obs_pose_column, obs_landmark_column, n_var):
+    """
+    Sparsity pattern of the residual jacobian: each residual only depends on its camera pose and its landmark.
+    :param obs_pose_column: [K] first column of the camera pose of each observation, -1 if the pose is fixed
+    :param obs_landmark_column: [K] first column of the landmark of each observation, -1 if the landmark is fixed
+    :param n_var: number of variables
+    :return: sparse matrix [K * 2, n_var]
+    """
+    n_obs = len(obs_pose_column)
+
+    # each observation has 2 residual rows
+    obs_rows = np.arange(2 * n_obs).reshape(-1, 2)
+
+    has_pose = obs_pose_column >= 0
+    pose_cols = np.tile(obs_pose_column[has_pose].reshape(-1, 1) + np.arange(3), 2)
+    pose_rows = np.repeat(obs_rows[has_pose], 3, axis=1)
+
+    has_landmark = obs_landmark_column >= 0
+    landmark_cols = np.tile(obs_landmark_column[has_landmark].reshape(-1, 1) + np.arange(2), 2)
+    landmark_rows = np.repeat(obs_rows[has_landmark], 2, axis=1)
+
+    rows = np.concatenate([pose_rows.ravel(), landmark_rows.ravel()])
+    cols = np.concatenate([pose_cols.ravel(), landmark_cols.ravel()])
+    return coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(2 * n_obs, n_var)).tocsr()
+
+
+def _jacobian_sparsity(n_pose, n_landmark, obs_pose_index, obs_landmark_index):
+    """
+    Sparsity pattern of the residual jacobian in bundle_adjustment.
+    :return: sparse matrix [K * 2, (N - 1) * 3 + M * 2]
+    """
+    # the reference pose (index 0) is not optimized
+    obs_pose_column = 3 * (obs_pose_index - 1)
+    obs_landmark_column = (n_pose - 1) * 3 + 2 * obs_landmark_index
+    return _sparsity_pattern(obs_pose_column, obs_landmark_column, (n_pose - 1) * 3 + n_landmark * 2)
+
+
+def _compute_local_residual(x, poses, landmarks, pose_var_index, landmark_var_index,
+                            obs_pose_index, obs_landmark_index, observations, u, v):
+    """
+    Residual of local bundle adjustment, only a part of poses and landmarks are variables.
+    :param x: variables, poses[pose_var_index] (3 each) + landmarks[landmark_var_index] (2 each)
+    :param poses: [N, 3] all camera poses (values of fixed poses are used)
+    :param landmarks: [M, 2] all landmarks (values of fixed landmarks are used)
+    :param pose_var_index: index of optimized poses
+    :param landmark_var_index: index of optimized landmarks
+    : obs_pose_index, obs_landmark_index, observations: observation arrays
+    :u, v: image center
+    :return: residual, [K * 2] (dx, dy) of each observation
+    """
+    n_pose_var = len(pose_var_index) * 3
+    poses = poses.copy()
+    landmarks = landmarks.copy()
+    poses[pose_var_index] = x[0:n_pose_var].reshape(-1, 3)
+    landmarks[landmark_var_index] = x[n_pose_var:].reshape(-1, 2)
+
+    pose = poses[obs_pose_index]
+    ray = landmarks[obs_landmark_index]
+    proj_x, proj_y = TransFunction.from_ray_to_image_array(u, v, pose[:, 2], pose[:, 0], pose[:, 1],
+                                                           ray[:, 0], ray[:, 1])
+    residual = np.empty((len(observations), 2))
+    residual[:, 0] = proj_x - observations[:, 0]
+    residual[:, 1] = proj_y - observations[:, 1]
+    return residual.reshape(-1)
+
+
+def local_bundle_adjustment(poses, landmarks, pose_var_index, landmark_var_index,
+                            obs_pose_index, obs_landmark_index, observations, u, v, verbose=False):
+    """
+    Optimize a window of camera poses and landmarks, other poses and landmarks are fixed.
+    Observations from fixed poses of optimized landmarks keep the window consistent with the rest of the map.
+    :param poses: [N, 3] camera poses, pan, tilt, focal_length
+    :param landmarks: [M, 2] landmarks, (pan, tilt)
+    :param pose_var_index: index of optimized poses
+    :param landmark_var_index: index of optimized landmarks
+    :param obs_pose_index: [K] camera pose index of each observation
+    :param obs_landmark_index: [K] landmark index of each observation
+    :param observations: [K, 2] observed image points
+    :param u:
+    :param v:
+    :return: optimized poses [N, 3], optimized landmarks [M, 2] (new arrays)
+    """
+    pose_var_index = np.asarray(pose_var_index, dtype=np.int64)
+    landmark_var_index = np.asarray(landmark_var_index, dtype=np.int64)
+
+    # column of each pose/landmark in x, -1 for fixed ones
+    pose_column = np.full(len(poses), -1, dtype=np.int64)
+    pose_column[pose_var_index] = 3 * np.arange(len(pose_var_index))
+    landmark_column = np.full(len(landmarks), -1, dtype=np.int64)
+    landmark_column[landmark_var_index] = len(pose_var_index) * 3 + 2 * np.arange(len(landmark_var_index))
+
+    x0 = np.concatenate([poses[pose_var_index].ravel(), landmarks[landmark_var_index].ravel()])
+    jac_sparsity = _sparsity_pattern(pose_column[obs_pose_index], landmark_column[obs_landmark_index], len(x0))
+
+    optimized = least_squares(_compute_local_residual, x0, verbose=2 if verbose else 0, x_scale='jac',
+                              ftol=1e-4, method='trf', jac_sparsity=jac_sparsity,
+                              args=(poses, landmarks, pose_var_index, landmark_var_index,
+                                    obs_pose_index, obs_landmark_index, observations, u, v))
+
+    optimized_poses = poses.copy()
+    optimized_landmarks = landmarks.copy()
+    optimized_poses[pose_var_index] = optimized.x[0:len(pose_var_index) * 3].reshape(-1, 3)
+    optimized_landmarks[landmark_var_index] = optimized.x[len(pose_var_index) * 3:].reshape(-1, 2)
+    return optimized_poses, optimized_landmarks
 
 
 def bundle_adjustment(images, image_indices, feature_method, initial_ptzs, center, rotation, u, v, save_path,
-                      verbose=False):
+                      verbose=False, features=None):
     """
     build a map from image matching: it takes long time
     assumption: first camera pose is the ground truth
@@ -120,6 +228,7 @@ def bundle_adjustment(images, image_indices, feature_method, initial_ptzs, cente
     :param u:
     :param v:
     :param save_path: a path to save pair-wise image matching
+    :param features: optional list of (keypoints, descriptors) of images, detected if None
     :return: a map
     """
     # check input parameters
@@ -147,7 +256,7 @@ def bundle_adjustment(images, image_indices, feature_method, initial_ptzs, cente
     keypoints, descriptors, points, \
     src_pt_index, dst_pt_index, landmark_index, n_landmark = build_matching_graph(images,
                                                                                   image_match_mask, feature_method,
-                                                                                  verbose)
+                                                                                  verbose, features)
 
     # save image matching result for debug
     for i in range(N):
@@ -165,10 +274,9 @@ def bundle_adjustment(images, image_indices, feature_method, initial_ptzs, cente
         print('Complete pair-wise image matching')
 
     # step 2: prepare bundle adjustment data
-    n_residual = 0
-    for i in range(N):
-        for j in range(N):
-            n_residual += len(src_pt_index[i][j]) * 4
+    obs_pose_index, obs_landmark_index, observations = _flatten_observations(points, src_pt_index,
+                                                                             dst_pt_index, landmark_index)
+    n_residual = len(observations) * 2
     print('residual number is %d.' % n_residual)
 
     # initialize reference camera pose
@@ -197,9 +305,11 @@ def bundle_adjustment(images, image_indices, feature_method, initial_ptzs, cente
     x0 = x0[3:]  # remove first camera pose so that it is not optimized
 
     # step 3: camera pose and landmark optimization
+    jac_sparsity = _jacobian_sparsity(n_pose, n_landmark, obs_pose_index, obs_landmark_index)
     optimized = least_squares(_compute_residual, x0, verbose=2, x_scale='jac', ftol=1e-4, method='trf',
-                              args=(n_pose, n_landmark, n_residual, points, src_pt_index, dst_pt_index,
-                                    landmark_index, u, v, ref_pose))
+                              jac_sparsity=jac_sparsity,
+                              args=(n_pose, n_landmark, obs_pose_index, obs_landmark_index, observations,
+                                    u, v, ref_pose))
 
     optimized_pose = optimized.x[0:landmark_start_index - 3]
     all_poses = np.zeros((n_pose * 3))
@@ -243,6 +353,7 @@ def bundle_adjustment(images, image_indices, feature_method, initial_ptzs, cente
         key_frame.feature_pts = [keypoints[i][j] for j in local_index]
         key_frame.feature_des = descriptors[i].take(local_index, axis=0)
         key_frame.landmark_index = np.array(global_index, dtype=np.int32)
+        key_frame.keypoint_index = np.array(local_index, dtype=np.int32)
         keyframes.append(key_frame)
         if verbose:
             print('frame %d, landmark number %d' % (image_indices[i], len(key_frame.landmark_index)))
@@ -439,8 +550,45 @@ def ut_least_square():
     print(res.x)
 
 
+def ut_local_bundle_adjustment():
+    """
+    Local bundle adjustment on synthesized rays: the last 3 poses are noisy and optimized.
+    """
+    u, v = 640, 360
+    n_pose, n_landmark = 10, 2000
+    poses = np.column_stack([np.linspace(0, 30, n_pose), np.full(n_pose, -8.0), np.linspace(2500, 3500, n_pose)])
+    landmarks = np.column_stack([np.random.uniform(-20, 50, n_landmark), np.random.uniform(-14, -2, n_landmark)])
+
+    obs_pose_index, obs_landmark_index, observations = [], [], []
+    for i in range(n_pose):
+        x, y = TransFunction.from_ray_to_image_array(u, v, poses[i, 2], poses[i, 0], poses[i, 1],
+                                                     landmarks[:, 0], landmarks[:, 1])
+        visible = np.flatnonzero((0 < x) & (x < 1280) & (0 < y) & (y < 720))
+        obs_pose_index.append(np.full(len(visible), i))
+        obs_landmark_index.append(visible)
+        observations.append(np.column_stack([x[visible], y[visible]]) + np.random.normal(0, 0.5, (len(visible), 2)))
+    obs_pose_index = np.concatenate(obs_pose_index)
+    obs_landmark_index = np.concatenate(obs_landmark_index)
+    observations = np.concatenate(observations)
+
+    pose_var_index = np.arange(n_pose - 3, n_pose)
+    landmark_var_index = np.unique(obs_landmark_index[np.isin(obs_pose_index, pose_var_index)])
+
+    noisy_poses = poses.copy()
+    noisy_poses[pose_var_index] += np.random.normal(0, [0.5, 0.2, 50], (3, 3))
+
+    start = time.time()
+    optimized_poses, _ = local_bundle_adjustment(noisy_poses, landmarks, pose_var_index, landmark_var_index,
+                                                 obs_pose_index, obs_landmark_index, observations, u, v)
+    print("%d observations, %d landmarks optimized in %.3f s" %
+          (len(observations), len(landmark_var_index), time.time() - start))
+    print("pose error before:", noisy_poses[pose_var_index] - poses[pose_var_index])
+    print("pose error after:", optimized_poses[pose_var_index] - poses[pose_var_index])
+
+
 if __name__ == '__main__':
     # ut_build_adjustment_from_image_sequence()
     ut_bundle_adjustment_interface()
 
     # ut_least_square()
+    # ut_local_bundle_adjustment()
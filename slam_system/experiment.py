@@ -5,6 +5,7 @@ Experiment code for different algorithms.
 """
 
 
+import scipy.io as sio
 from ptz_slam import *
 
 def ut_basketball():
@@ -30,7 +30,7 @@ def ut_single_image():
     rays = camera.back_project_to_rays(points)
     print(rays.shape)
 
-    from relocalization import _compute_residual
+    from relocalization import _compute_residual, _compute_jacobian
     from scipy.optimize import least_squares
     from transformation import TransFunction
 
@@ -51,8 +51,8 @@ def ut_single_image():
         init_pose[2] = fl + np.random.normal(0, 150)
 
         # optimized the camera pose
-        optimized_pose = least_squares(_compute_residual, init_pose, verbose=0, x_scale='jac', ftol=1e-4, method='trf',
-                                       args=(rays, noise_pts, im_w / 2, im_h / 2))
+        optimized_pose = least_squares(_compute_residual, init_pose, jac=_compute_jacobian, verbose=0, x_scale='jac',
+                                       ftol=1e-4, method='trf', args=(rays, noise_pts, im_w / 2, im_h / 2))
         optimzied_ptz = optimized_pose.x
         #print('ground truth: {}'.format(gt_pose))
         #print('estiamted pose: {}'.format(optimzied_ptz))
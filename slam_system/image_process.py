@@ -158,21 +158,25 @@ def detect_compute_latch(im, nfeatures=1500, verbose=False):
 def keypoints_masking(kp, mask):
     """
     use bounding box to remove keypoints on players
-    :param kp: list [N] of keypoints object (need use .pt to access point location)
-    :param mask: bounding box mask
+    :param kp: list [N] of keypoints object (need use .pt to access point location) or array [N, 2]
+    :param mask: bounding box mask (1 for no player, 0 for player), or int array [M, 4] of player boxes
+    (x1, y1, x2, y2) from SequenceManager.get_bounding_box_mask(return_boxes=True)
     :return: index array for keypoints out of players
     """
-    inner_index = np.ndarray([0], dtype=np.int32)
-    for i in range(len(kp)):
-
-        if isinstance(kp, np.ndarray):
-            x, y = int(kp[i, 0]), int(kp[i, 1])
-        else:
-            x, y = int(kp[i].pt[0]), int(kp[i].pt[1])
-
-        if mask[y, x] == 1:
-            inner_index = np.append(inner_index, i)
-    return inner_index
+    if isinstance(kp, np.ndarray):
+        pts = kp[:, 0:2]
+    else:
+        pts = np.array([p.pt for p in kp]).reshape(-1, 2)
+    x, y = pts[:, 0].astype(np.int32), pts[:, 1].astype(np.int32)
+
+    if mask.ndim == 2 and mask.shape[1] == 4:
+        # test points against boxes, no mask is built
+        x, y = x[:, np.newaxis], y[:, np.newaxis]
+        on_player = (x >= mask[:, 0]) & (x < mask[:, 2]) & (y >= mask[:, 1]) & (y < mask[:, 3])
+        inner = np.logical_not(np.any(on_player, axis=1))
+    else:
+        inner = mask[y, x] == 1
+    return np.flatnonzero(inner).astype(np.int32)
 
 
 def match_sift_features(keypiont1, descriptor1, keypoint2, descriptor2, pts_array=False, verbose=False):
@@ -310,6 +314,39 @@ def match_latch_features(keypiont1, descriptor1, keypoint2, descriptor2, verbose
     return pts1, index1, pts2, index2
 
 
+def detect_compute_features(im, feature_method, nfeatures=None, verbose=False):
+    """
+    detect keypoints and compute descriptors
+    :param im: RGB or gray image
+    :param feature_method: 'sift', 'orb' or 'latch'
+    :param nfeatures: None for the feature numbers used in mapping (sift 1500, orb 6000, latch 5000)
+    :return: a list of key_point, and descriptors
+    """
+    if feature_method == 'sift':
+        return detect_compute_sift(im, 1500 if nfeatures is None else nfeatures, verbose)
+    elif feature_method == 'orb':
+        return detect_compute_orb(im, 6000 if nfeatures is None else nfeatures, verbose)
+    elif feature_method == 'latch':
+        return detect_compute_latch(im, 5000 if nfeatures is None else nfeatures, verbose)
+    else:
+        assert False
+
+
+def match_features(keypoint1, descriptor1, keypoint2, descriptor2, feature_method, verbose=False):
+    """
+    match keypoints of two images with the matching function of feature_method
+    :return: matched points and their indices in both images, same as match_sift_features
+    """
+    if feature_method == 'sift':
+        return match_sift_features(keypoint1, descriptor1, keypoint2, descriptor2, False, verbose)
+    elif feature_method == 'orb':
+        return match_orb_features(keypoint1, descriptor1, keypoint2, descriptor2, verbose)
+    elif feature_method == 'latch':
+        return match_latch_features(keypoint1, descriptor1, keypoint2, descriptor2, verbose)
+    else:
+        assert False
+
+
 def compute_homography(keypiont1, descriptor1, keypoint2, descriptor2):
     """
     Get the estimated homography matrix from two sets of keypoints with descriptor.
@@ -506,7 +543,7 @@ def matching_and_ransac(img1, img2, img1_keypoints, img1_keypoints_index, visual
     return inlier_keypoints, inlier_index, outlier_index
 
 
-def build_matching_graph(images, image_match_mask=[], feature_method='sift', verbose=False):
+def build_matching_graph(images, image_match_mask=[], feature_method='sift', verbose=False, features=None):
     """
     build a graph for a list of images
     The graph is 2D hash map using list index as key
@@ -516,6 +553,7 @@ def build_matching_graph(images, image_match_mask=[], feature_method='sift', ver
     :image_match_mask: optional N * N a list of list [[]], 1 for matched, 0 or can not match
     :feature_method, 'sift', 'orb'
     :param verbose:
+    :param features: optional list of (keypoints, descriptors) of images, e.g. from KeyFrame.get_features
     :return: keypoints, points,descriptors, src_pt_index, dst_pt_index, landmark_index (global index), landmark_num
     """
     assert feature_method == 'sift' or feature_method == 'orb' or feature_method == 'latch'
@@ -535,16 +573,11 @@ def build_matching_graph(images, image_match_mask=[], feature_method='sift', ver
 
     # step 1: extract key points and descriptors
     keypoints, descriptors = [], []
-    for im in images:
-        kp, des = None, None
-        if feature_method == 'sift':
-            kp, des = detect_compute_sift(im, 1500, False)
-        elif feature_method == 'orb':
-            kp, des = detect_compute_orb(im, 6000, False)
-        elif feature_method == 'latch':
-            kp, des = detect_compute_latch(im, 5000, False)
+    for i, im in enumerate(images):
+        if features is not None:
+            kp, des = features[i]
         else:
-            assert False
+            kp, des = detect_compute_features(im, feature_method)
         keypoints.append(kp)
         descriptors.append(des)
 
@@ -576,14 +609,7 @@ def build_matching_graph(images, image_match_mask=[], feature_method='sift', ver
                 continue
 
             kp2, des2 = keypoints[j], descriptors[j]
-            if feature_method == 'sift':
-                pts1, index1, pts2, index2 = match_sift_features(kp1, des1, kp2, des2, False)
-            elif feature_method == 'orb':
-                pts1, index1, pts2, index2 = match_orb_features(kp1, des1, kp2, des2, False)
-            elif feature_method == 'latch':
-                pts1, index1, pts2, index2 = match_latch_features(kp1, des1, kp2, des2, False)
-            else:
-                assert False
+            pts1, index1, pts2, index2 = match_features(kp1, des1, kp2, des2, feature_method)
 
             # matching is not found
             assert len(index1) == len(index2)
@@ -4,10 +4,9 @@ Keyframe class.
 Created by Luke, 2018.9
 """
 
-import scipy.io as sio
 import numpy as np
 import cv2 as cv
-from image_process import detect_compute_sift_array, visualize_points
+from image_process import detect_compute_sift_array, detect_compute_features, visualize_points
 from util import *
 
 class KeyFrame:
@@ -39,6 +38,12 @@ class KeyFrame:
         # a [N] int array of index for keypoint in global_ray
         self.landmark_index = []
 
+        # a [N] int array of index for keypoint in get_features(feature_method) of the map
+        self.keypoint_index = []
+
+        # detected (keypoints, descriptors) of img, key is (feature_method, nfeatures, pts_array)
+        self.feature_cache = dict()
+
         """camera pose"""
         self.pan, self.tilt, self.f = pan, tilt, f
 
@@ -50,6 +55,24 @@ class KeyFrame:
         self.u = u
         self.v = v
 
+    def get_features(self, feature_method, nfeatures=None, pts_array=False):
+        """
+        keypoints and descriptors of the image. Each (feature_method, nfeatures) is only detected once.
+        :param feature_method: 'sift', 'orb' or 'latch'
+        :param nfeatures: None for the feature number used in mapping, see detect_compute_features
+        :param pts_array: True for keypoints as a [N, 2] array, False for a list of key_point
+        :return: keypoints, descriptors
+        """
+        key = (feature_method, nfeatures, pts_array)
+        if key not in self.feature_cache:
+            if pts_array:
+                kp, des = self.get_features(feature_method, nfeatures)
+                kp = np.array([p.pt for p in kp], dtype=np.float64).reshape(-1, 2)
+            else:
+                kp, des = detect_compute_features(self.img, feature_method, nfeatures)
+            self.feature_cache[key] = (kp, des)
+        return self.feature_cache[key]
+
     def get_feature_num(self):
         """
         :return: keypoint number
@@ -104,4 +127,5 @@ class KeyFrame:
 
         keyframe_data['ptz'] = np.array([self.pan, self.tilt, self.f]).reshape(-1, 1)
 
+        import scipy.io as sio
         sio.savemat(path, mdict=keyframe_data)
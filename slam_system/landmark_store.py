@@ -0,0 +1,399 @@
+"""
+Storage for ray landmarks in PTZ SLAM.
+
+The rays, their descriptors and the EKF state covariance are kept in preallocated buffers.
+A ray lives in a slot. The slot is its global index in the tracker and in the covariance matrix
+(rows 3 + 2 * slot, 3 + 2 * slot + 1). Removed slots are reused by new rays.
+
+LandmarkStore keeps a dense covariance matrix, O(N^2) memory.
+BlockLandmarkStore only keeps the pose block, the pose-ray cross blocks and 2 x 2 ray blocks, O(N) memory.
+"""
+
+import numpy as np
+
+
+class LandmarkStore:
+    """
+    Capacity-managed storage of ray landmarks and state covariance.
+    Buffers grow by growth_factor when they are full, so adding a ray costs amortized O(N).
+    The dense covariance grows by growth_factor^2 in memory, so it uses 1.5 instead of 2
+    (doubling would make a [3 + 2N, 3 + 2N] matrix up to 4 times larger than needed).
+    Removing a ray only clears its covariance rows and columns, which is O(N).
+    """
+
+    growth_factor = 1.5
+
+    def __init__(self, capacity=256, descriptor_dim=128):
+        """
+        :param capacity: initial number of ray slots
+        :param descriptor_dim: descriptor length of each ray
+        """
+        self.capacity = capacity
+        self.descriptor_dim = descriptor_dim
+
+        # [capacity, 2] rays (theta, phi) and [capacity, descriptor_dim] descriptors
+        self.rays = np.zeros([capacity, 2])
+        self.des = np.zeros([capacity, descriptor_dim])
+
+        # covariance of camera pose (pan, tilt, focal length) and all ray slots
+        self._allocate_cov(capacity)
+
+        # whether a slot holds a live ray
+        self.active = np.zeros(capacity, dtype=bool)
+
+        # observation statistics for eviction: last observed frame and number of observations
+        self.last_observed = np.zeros(capacity, dtype=int)
+        self.observe_count = np.zeros(capacity, dtype=int)
+
+        # slots below size have been used at least once, free_slots are removed slots below size
+        self.size = 0
+        self.free_slots = []
+
+    def __len__(self):
+        return self.size - len(self.free_slots)
+
+    def _allocate_cov(self, capacity):
+        """
+        Allocate covariance buffer.
+        """
+        self.state_cov = np.zeros([3 + 2 * capacity, 3 + 2 * capacity])
+
+    def _copy_cov(self, capacity):
+        """
+        Allocate covariance buffer with a new capacity and copy used slots.
+        """
+        n = 3 + 2 * self.size
+        state_cov = self.state_cov
+        self._allocate_cov(capacity)
+        self.state_cov[0:n, 0:n] = state_cov[0:n, 0:n]
+
+    def _reset_cov(self, slots, var):
+        """
+        Initialize covariance of new slots. Their rows and cols are zero
+        (either never used or cleared by _clear_cov).
+        """
+        cov_index = 3 + 2 * slots.reshape(-1, 1) + np.array([0, 1])
+        self.state_cov[cov_index, cov_index] = var
+
+    def _clear_cov(self, slots):
+        """
+        Set covariance rows and cols of slots to zero.
+        """
+        n = 3 + 2 * self.size
+        cov_index = (3 + 2 * slots.reshape(-1, 1) + np.array([0, 1])).flatten()
+        self.state_cov[cov_index, 0:n] = 0
+        self.state_cov[0:n, cov_index] = 0
+
+    @property
+    def pose_cov(self):
+        """
+        [3, 3] covariance of camera pose (a view, can be modified in place).
+        """
+        return self.state_cov[0:3, 0:3]
+
+    def get_blocks(self, slots):
+        """
+        :param slots: [M] array of slots
+        :return: pose block [3, 3], pose-ray cross blocks [M, 2, 3], ray blocks [M, 2, 2]
+        """
+        ray_index = 3 + 2 * slots.reshape(-1, 1) + np.array([0, 1])
+        p_pp = self.state_cov[0:3, 0:3].copy()
+        p_rp = self.state_cov[ray_index, 0:3]
+        p_rr = self.state_cov[ray_index[:, :, None], ray_index[:, None, :]]
+        return p_pp, p_rp, p_rr
+
+    def set_blocks(self, slots, p_pp, p_rp, p_rr):
+        """
+        Write pose block, pose-ray cross blocks and ray blocks back.
+        :param slots: [M] array of slots
+        :param p_pp: [3, 3]
+        :param p_rp: [M, 2, 3]
+        :param p_rr: [M, 2, 2]
+        """
+        ray_index = 3 + 2 * slots.reshape(-1, 1) + np.array([0, 1])
+        self.state_cov[0:3, 0:3] = p_pp
+        self.state_cov[ray_index, 0:3] = p_rp
+        self.state_cov[0:3, ray_index] = p_rp.transpose(2, 0, 1)
+        self.state_cov[ray_index[:, :, None], ray_index[:, None, :]] = p_rr
+
+    def ray_variance(self, slots):
+        """
+        :param slots: [M] array of slots
+        :return: [M] trace of 2 x 2 ray covariance
+        """
+        cov_index = 3 + 2 * slots
+        return self.state_cov[cov_index, cov_index] + self.state_cov[cov_index + 1, cov_index + 1]
+
+    def clear(self):
+        """
+        Remove all rays and reset covariance matrix to zero (capacity is kept).
+        """
+        self._clear_cov(self.live_index())
+        self.pose_cov[:] = 0
+        self.active[:] = False
+        self.size = 0
+        self.free_slots = []
+
+    def live_index(self):
+        """
+        :return: sorted [N] array of slots of live rays
+        """
+        return np.flatnonzero(self.active[0:self.size])
+
+    def live_rays(self):
+        """
+        :return: live rays [N, 2] and their slots [N]
+        """
+        index = self.live_index()
+        return self.rays[index], index
+
+    def _grow(self, min_capacity):
+        """
+        Grow the capacity by growth_factor until it is no less than min_capacity and copy used part of buffers.
+        """
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity = max(capacity + 1, int(capacity * self.growth_factor))
+
+        rays = np.zeros([capacity, 2])
+        rays[0:self.size] = self.rays[0:self.size]
+
+        des = np.zeros([capacity, self.descriptor_dim], dtype=self.des.dtype)
+        des[0:self.size] = self.des[0:self.size]
+
+        self._copy_cov(capacity)
+
+        active = np.zeros(capacity, dtype=bool)
+        active[0:self.size] = self.active[0:self.size]
+
+        last_observed = np.zeros(capacity, dtype=int)
+        last_observed[0:self.size] = self.last_observed[0:self.size]
+
+        observe_count = np.zeros(capacity, dtype=int)
+        observe_count[0:self.size] = self.observe_count[0:self.size]
+
+        self.rays, self.des, self.active = rays, des, active
+        self.last_observed, self.observe_count = last_observed, observe_count
+        self.capacity = capacity
+
+    def add(self, rays, des, var, frame_index=0):
+        """
+        Add new rays. Free slots are used first.
+        :param rays: [K, 2] array of new rays
+        :param des: [K, descriptor_dim] array of descriptors
+        :param var: initial variance of ray angles
+        :param frame_index: frame where the rays are created (counted as the first observation)
+        :return: [K] array of slots for new rays
+        """
+        num = len(rays)
+        num_reused = min(num, len(self.free_slots))
+        reused = [self.free_slots.pop() for _ in range(num_reused)]
+
+        if self.size + num - num_reused > self.capacity:
+            self._grow(self.size + num - num_reused)
+
+        slots = np.array(reused + list(range(self.size, self.size + num - num_reused)), dtype=int)
+        self.size += num - num_reused
+
+        self.rays[slots] = rays
+        self.des[slots] = des
+        self.active[slots] = True
+        self.last_observed[slots] = frame_index
+        self.observe_count[slots] = 1
+
+        self._reset_cov(slots, var)
+
+        return slots
+
+    def remove(self, slots):
+        """
+        Remove rays and clear their covariance. The slots will be reused.
+        :param slots: array of slots to remove
+        """
+        slots = np.unique(np.asarray(slots, dtype=int))
+        slots = slots[self.active[slots]]
+        if len(slots) == 0:
+            return
+
+        self.active[slots] = False
+        self.free_slots.extend(slots.tolist())
+        self._clear_cov(slots)
+
+    def observe(self, slots, frame_index):
+        """
+        Record that rays are observed (matched) in a frame.
+        :param slots: array of observed slots
+        :param frame_index: index of the frame
+        """
+        self.last_observed[slots] = frame_index
+        self.observe_count[slots] += 1
+
+    def evict(self, num, policy='least_recent', protected_slots=None):
+        """
+        Remove at most num live rays by an eviction policy.
+        :param num: number of rays to remove
+        :param policy: 'least_recent': rays that are not observed for the longest time,
+        'fewest_observations': rays with the lowest observation count,
+        'largest_covariance': rays with the largest covariance trace.
+        :param protected_slots: slots that can not be removed (e.g. rays tracked in current frame)
+        :return: array of removed slots
+        """
+        assert policy in ('least_recent', 'fewest_observations', 'largest_covariance')
+
+        candidates = self.live_index()
+        if protected_slots is not None and len(protected_slots) > 0:
+            candidates = np.setdiff1d(candidates, protected_slots, assume_unique=True)
+
+        num = min(num, len(candidates))
+        if num <= 0:
+            return np.ndarray([0], dtype=int)
+
+        if policy == 'least_recent':
+            score = self.last_observed[candidates]
+        elif policy == 'fewest_observations':
+            score = self.observe_count[candidates]
+        else:
+            score = -self.ray_variance(candidates)
+
+        # lowest scores are removed
+        if num < len(candidates):
+            evicted = candidates[np.argpartition(score, num - 1)[0:num]]
+        else:
+            evicted = candidates
+        self.remove(evicted)
+        return evicted
+
+
+class BlockLandmarkStore(LandmarkStore):
+    """
+    Landmark storage with block covariance: pose block [3, 3], pose-ray cross blocks [N, 2, 3]
+    and ray blocks [N, 2, 2]. Covariance between two rays is not stored, so memory is O(N).
+    It works with the block EKF update in PtzSlam.
+    """
+
+    growth_factor = 2
+
+    def _allocate_cov(self, capacity):
+        self.pose_block = np.zeros([3, 3])
+        self.cross_blocks = np.zeros([capacity, 2, 3])
+        self.ray_blocks = np.zeros([capacity, 2, 2])
+
+    def _copy_cov(self, capacity):
+        cross_blocks = np.zeros([capacity, 2, 3])
+        cross_blocks[0:self.size] = self.cross_blocks[0:self.size]
+        ray_blocks = np.zeros([capacity, 2, 2])
+        ray_blocks[0:self.size] = self.ray_blocks[0:self.size]
+        self.cross_blocks, self.ray_blocks = cross_blocks, ray_blocks
+
+    def _reset_cov(self, slots, var):
+        self.cross_blocks[slots] = 0
+        self.ray_blocks[slots] = var * np.eye(2)
+
+    def _clear_cov(self, slots):
+        self.cross_blocks[slots] = 0
+        self.ray_blocks[slots] = 0
+
+    @property
+    def pose_cov(self):
+        return self.pose_block
+
+    def get_blocks(self, slots):
+        return self.pose_block.copy(), self.cross_blocks[slots], self.ray_blocks[slots]
+
+    def set_blocks(self, slots, p_pp, p_rp, p_rr):
+        self.pose_block[:] = p_pp
+        self.cross_blocks[slots] = p_rp
+        self.ray_blocks[slots] = p_rr
+
+    def ray_variance(self, slots):
+        return self.ray_blocks[slots, 0, 0] + self.ray_blocks[slots, 1, 1]
+
+
+def ut_landmark_store():
+    """
+    Compare add/remove with the row_stack/np.delete version of state storage.
+    """
+    store = LandmarkStore(capacity=4, descriptor_dim=2)
+    rays = np.ndarray([0, 2])
+    state_cov = np.zeros([3, 3])
+    slots = np.ndarray([0], dtype=int)
+
+    for i in range(50):
+        new_rays = np.random.uniform(-10, 10, [np.random.randint(1, 10), 2])
+        new_slots = store.add(new_rays, new_rays, 0.001)
+        rays = np.row_stack([rays, new_rays])
+        slots = np.concatenate([slots, new_slots])
+        for _ in range(len(new_rays)):
+            state_cov = np.row_stack([state_cov, np.zeros([2, state_cov.shape[1]])])
+            state_cov = np.column_stack([state_cov, np.zeros([state_cov.shape[0], 2])])
+            state_cov[-2, -2] = state_cov[-1, -1] = 0.001
+
+        remove = np.random.choice(len(rays), np.random.randint(0, len(rays) // 2 + 1), replace=False)
+        store.remove(slots[remove])
+        cov_remove = (3 + 2 * remove.reshape(-1, 1) + np.array([0, 1])).flatten()
+        rays = np.delete(rays, remove, axis=0)
+        slots = np.delete(slots, remove)
+        state_cov = np.delete(np.delete(state_cov, cov_remove, axis=0), cov_remove, axis=1)
+
+        assert len(store) == len(rays)
+        assert np.array_equal(store.rays[slots], rays)
+        cov_index = np.concatenate([[0, 1, 2], (3 + 2 * slots.reshape(-1, 1) + np.array([0, 1])).flatten()])
+        assert np.array_equal(store.state_cov[np.ix_(cov_index, cov_index)], state_cov)
+
+    print("capacity %d, live rays %d" % (store.capacity, len(store)))
+
+
+def ut_evict():
+    """
+    Evict rays by each policy and check the order.
+    """
+    for policy in ['least_recent', 'fewest_observations', 'largest_covariance']:
+        store = LandmarkStore(capacity=16, descriptor_dim=2)
+        slots = store.add(np.zeros([10, 2]), np.zeros([10, 2]), 0.001, frame_index=0)
+        for i in range(10):
+            store.observe(slots[i:], i + 1)
+            store.state_cov[3 + 2 * slots[i], 3 + 2 * slots[i]] += 0.001 * (10 - i)
+
+        evicted = store.evict(3, policy, protected_slots=slots[0:1])
+        assert np.array_equal(np.sort(evicted), slots[1:4]), policy
+        assert len(store) == 7
+        print(policy, evicted)
+
+
+def ut_block_landmark_store():
+    """
+    Blocks of BlockLandmarkStore should be the same as the blocks of dense LandmarkStore.
+    """
+    dense_store = LandmarkStore(capacity=4, descriptor_dim=2)
+    block_store = BlockLandmarkStore(capacity=4, descriptor_dim=2)
+
+    for i in range(30):
+        new_rays = np.random.uniform(-10, 10, [np.random.randint(1, 10), 2])
+        for store in [dense_store, block_store]:
+            slots = store.add(new_rays, new_rays, 0.001)
+
+        live_index = dense_store.live_index()
+        p_pp = np.diag(np.random.uniform(0.1, 1, 3))
+        p_rp = np.random.uniform(-0.01, 0.01, [len(live_index), 2, 3])
+        p_rr = np.random.uniform(0.001, 0.002, [len(live_index), 2, 2])
+        for store in [dense_store, block_store]:
+            store.set_blocks(live_index, p_pp, p_rp, p_rr)
+
+        remove = np.random.choice(live_index, np.random.randint(0, len(live_index) // 2 + 1), replace=False)
+        for store in [dense_store, block_store]:
+            store.remove(remove)
+
+        live_index = dense_store.live_index()
+        assert np.array_equal(live_index, block_store.live_index())
+        for dense_block, block in zip(dense_store.get_blocks(live_index), block_store.get_blocks(live_index)):
+            assert np.array_equal(dense_block, block)
+
+    print("dense covariance %d bytes, block covariance %d bytes" %
+          (dense_store.state_cov.nbytes,
+           block_store.pose_block.nbytes + block_store.cross_blocks.nbytes + block_store.ray_blocks.nbytes))
+
+
+if __name__ == '__main__':
+    ut_landmark_store()
+    # ut_evict()
+    # ut_block_landmark_store()
@@ -6,7 +6,6 @@ A nearest neighbor search based relocalization solution.
 
 import numpy as np
 import pyflann
-import scipy.io as sio
 import cv2 as cv
 
 from scene_map import Map
@@ -72,16 +71,23 @@ class NNBasedMap(Map):
         :return: reprojection error of these points
         """
 
+        reproject_x, reproject_y = TransFunction.from_ray_to_image_array(u, v, pose[2], pose[0], pose[1],
+                                                                         rays[:, 0], rays[:, 1])
         residual = np.ndarray([2 * len(rays)])
-
-        for i in range(len(rays)):
-            reproject_x, reproject_y = TransFunction.from_ray_to_image(u, v, pose[2], pose[0], pose[1], rays[i, 0],
-                                                                       rays[i, 1])
-            residual[2 * i] = reproject_x - points[i, 0]
-            residual[2 * i + 1] = reproject_y - points[i, 1]
+        residual[0::2] = reproject_x - points[:, 0]
+        residual[1::2] = reproject_y - points[:, 1]
 
         return residual
 
+    @staticmethod
+    def compute_jacobian(pose, rays, points, u, v):
+        """
+        jacobian of compute_residual
+        :return: [2 * N, 3] array
+        """
+        return TransFunction.from_ray_to_image_pose_jacobian(pose[2], pose[0], pose[1],
+                                                             rays[:, 0], rays[:, 1]).reshape(-1, 3)
+
 
     def relocalize(self, keyframe):
         keypoint_index, ray_index = self.find_nearest(keyframe.feature_des)
@@ -94,11 +100,13 @@ class NNBasedMap(Map):
 
         # fuck = self.compute_residual(pose, rays, keyframe.feature_pts, keyframe.u, keyframe.v)
 
-        optimized_pose = least_squares(NNBasedMap.compute_residual, pose, verbose=2, x_scale='jac', ftol=1e-4, method='trf',
+        optimized_pose = least_squares(NNBasedMap.compute_residual, pose, jac=NNBasedMap.compute_jacobian, verbose=2,
+                                       x_scale='jac', ftol=1e-4, method='trf',
                                        args=(rays, keyframe.feature_pts[keypoint_index], keyframe.u, keyframe.v))
 
 
         # save to mat
+        import scipy.io as sio
         keyframe_data = dict()
 
         keyframe_data['rays'] = rays
@@ -135,8 +143,8 @@ def ut_estimateCameraRANSAC():
         rays = data['rays']
         keypoints = data['keypoints']
 
-        optimized_pose = least_squares(NNBasedMap.compute_residual, init_ptz, verbose=0, x_scale='jac', ftol=1e-4, method='trf',
-                                       args=(rays, keypoints, 640, 360))
+        optimized_pose = least_squares(NNBasedMap.compute_residual, init_ptz, jac=NNBasedMap.compute_jacobian, verbose=0,
+                                       x_scale='jac', ftol=1e-4, method='trf', args=(rays, keypoints, 640, 360))
 
 
         print('estimated ptz is {}'.format(optimized_pose.x))
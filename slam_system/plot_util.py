@@ -0,0 +1,78 @@
+"""
+Plotting functions.
+
+They are split from util.py so that the tracking modules do not import matplotlib
+(and select a GUI backend) at startup. Import this module only to draw figures.
+
+Create by Jimmy, 2018.9
+"""
+
+import numpy as np
+
+from sys import platform as sys_pf
+
+import matplotlib
+
+if sys_pf == 'darwin':
+    matplotlib.use("TkAgg")
+elif sys_pf == 'win32':
+    matplotlib.use('Qt4Agg')
+
+import matplotlib.pyplot as plt
+
+
+def draw_camera_plot(ground_truth_pan, ground_truth_tilt, ground_truth_f,
+                     estimate_pan, estimate_tilt, estimate_f):
+    """
+    draw plot for ground truth and estimated camera pose.
+    """
+
+    sequence_length = len(ground_truth_pan)
+
+    plt.figure("pan percentage error")
+    x = np.array([i for i in range(sequence_length)])
+    plt.plot(x, (estimate_pan - ground_truth_pan) / ground_truth_pan * 100, 'b', label='predict')
+    plt.xlabel("frame")
+    plt.ylabel("error %")
+    plt.legend(loc="best")
+
+    plt.figure("tilt percentage error")
+    x = np.array([i for i in range(sequence_length)])
+    plt.plot(x, (estimate_tilt - ground_truth_tilt) / ground_truth_tilt * 100, 'b', label='predict')
+    plt.xlabel("frame")
+    plt.ylabel("error %")
+    plt.legend(loc="best")
+
+    plt.figure("f percentage error")
+    x = np.array([i for i in range(sequence_length)])
+    plt.plot(x, (estimate_f - ground_truth_f) / ground_truth_f * 100, 'b', label='predict')
+    plt.xlabel("frame")
+    plt.ylabel("error %")
+    plt.legend(loc="best")
+
+    """absolute value"""
+    plt.figure("pan")
+    x = np.array([i for i in range(sequence_length)])
+    plt.plot(x, ground_truth_pan, 'r', label='ground truth')
+    plt.plot(x, estimate_pan, 'b', label='predict')
+    plt.xlabel("frame")
+    plt.ylabel("pan angle")
+    plt.legend(loc="best")
+
+    plt.figure("tilt")
+    x = np.array([i for i in range(sequence_length)])
+    plt.plot(x, ground_truth_tilt, 'r', label='ground truth')
+    plt.plot(x, estimate_tilt, 'b', label='predict')
+    plt.xlabel("frame")
+    plt.ylabel("tilt angle")
+    plt.legend(loc="best")
+
+    plt.figure("f")
+    x = np.array([i for i in range(sequence_length)])
+    plt.plot(x, ground_truth_f, 'r', label='ground truth')
+    plt.plot(x, estimate_f, 'b', label='predict')
+    plt.xlabel("frame")
+    plt.ylabel("f")
+    plt.legend(loc="best")
+
+    plt.show()
@@ -7,9 +7,9 @@ Created by Luke, 2018.9
 
 import numpy as np
 import math
+import time
 import cv2 as cv
 
-import scipy.io as sio
 from scipy.optimize import least_squares
 
 
@@ -209,6 +209,43 @@ class PTZCamera:
 
         return img_p[0] / img_p[2], img_p[1] / img_p[2]
 
+    def project_ray_array(self, rays, height=0, width=0):
+        """
+        Project a array of rays to image in one pass (vectorized version of project_ray).
+        K, pan-tilt rotation and displacement are computed once for all rays.
+        :param rays: [n, 2] array of n rays in tripod coordinates.
+        :param height: height of image.
+        :param width: width of image.
+        :return: projected points ([n, 2] array) and in-image mask ([n] bool array).
+        If height or width is 0, all points are in the mask.
+        """
+        rays = np.asarray(rays, dtype=np.float64).reshape(-1, 2)
+
+        K = self.compute_camera_matrix()
+        pan_tilt_rotation = np.dot(self.compute_tilt_matrix(), self.compute_pan_matrix())
+        disp = self.compute_dispalcement()
+
+        tan_theta = np.tan(np.radians(rays[:, 0]))
+        tan_phi = np.tan(np.radians(rays[:, 1]))
+
+        ray_p = np.empty((len(rays), 3))
+        ray_p[:, 0] = tan_theta
+        ray_p[:, 1] = -tan_phi * np.sqrt(tan_theta * tan_theta + 1)
+        ray_p[:, 2] = 1
+
+        # [n, 3] rows of K * (R * ray + disp)
+        img_p = np.dot(np.dot(ray_p, pan_tilt_rotation.T) + disp, K.T)
+        assert np.all(img_p[:, 2] != 0.0)
+
+        points = img_p[:, 0:2] / img_p[:, 2:3]
+
+        if height != 0 and width != 0:
+            mask = (0 < points[:, 0]) & (points[:, 0] < width) & (0 < points[:, 1]) & (points[:, 1] < height)
+        else:
+            mask = np.ones(len(points), dtype=bool)
+
+        return points, mask
+
     def project_rays(self, rays, height=0, width=0):
         """
         Project a array of rays to image.
@@ -217,21 +254,73 @@ class PTZCamera:
         :param width: width of image.
         :return: projected points in image range ([m, 2] array) and its index in ps
         """
-        points = np.ndarray([0, 2], np.float32)
-        index = np.ndarray([0])
+        points, mask = self.project_ray_array(rays, height, width)
 
         if height != 0 and width != 0:
-            for j in range(len(rays)):
-                tmp = self.project_ray(rays[j])
-                if 0 < tmp[0] < width and 0 < tmp[1] < height:
-                    points = np.row_stack([points, np.asarray(tmp)])
-                    index = np.concatenate([index, [j]], axis=0)
+            index = np.flatnonzero(mask)
+            return points[index], index
         else:
-            for j in range(len(rays)):
-                tmp = self.project_ray(rays[j])
-                points = np.row_stack([points, np.asarray(tmp)])
+            return points, np.ndarray([0])
 
-        return points, index
+    def project_ray_jacobian(self, rays):
+        """
+        Closed-form Jacobian of project_ray for a array of rays.
+        Angles (camera pan, tilt and ray theta, phi) are in degree.
+        :param rays: [n, 2] array of n rays in tripod coordinates.
+        :return: pose block [n, 2, 3] (d(x, y) / d(pan, tilt, focal_length)),
+        ray block [n, 2, 2] (d(x, y) / d(theta, phi) of the ray itself)
+        """
+        rays = np.asarray(rays, dtype=np.float64).reshape(-1, 2)
+        n = len(rays)
+
+        fl = self.focal_length
+        pan = math.radians(self.pan)
+        tilt = math.radians(self.tilt)
+
+        tilt_rot = self.compute_tilt_matrix()
+        pan_rot = self.compute_pan_matrix()
+        pan_tilt_rotation = np.dot(tilt_rot, pan_rot)
+        d_pan_rot = np.array([[-math.sin(pan), 0, -math.cos(pan)],
+                              [0, 0, 0],
+                              [math.cos(pan), 0, -math.sin(pan)]])
+        d_tilt_rot = np.array([[0, 0, 0],
+                               [0, -math.sin(tilt), math.cos(tilt)],
+                               [0, -math.cos(tilt), -math.sin(tilt)]])
+
+        tan_theta = np.tan(np.radians(rays[:, 0]))
+        tan_phi = np.tan(np.radians(rays[:, 1]))
+        norm = np.sqrt(tan_theta * tan_theta + 1)
+
+        ray_p = np.column_stack([tan_theta, -tan_phi * norm, np.ones(n)])
+
+        # derivative of ray_p to theta and phi (in radian)
+        d_ray_theta = np.column_stack([norm * norm, -tan_phi * tan_theta * norm, np.zeros(n)])
+        d_ray_phi = np.column_stack([np.zeros(n), -(1 + tan_phi * tan_phi) * norm, np.zeros(n)])
+
+        # q = R * ray + disp, image point is (f * q_x / q_z + u, f * q_y / q_z + v)
+        q = np.dot(ray_p, pan_tilt_rotation.T) + self.compute_dispalcement()
+
+        # each derivative of q is [n, 3], stacked to [n, 3, 5]: pan, tilt, f, theta, phi
+        dq = np.empty((n, 3, 5))
+        dq[:, :, 0] = np.dot(ray_p, np.dot(tilt_rot, d_pan_rot).T)
+        dq[:, :, 1] = np.dot(ray_p, np.dot(d_tilt_rot, pan_rot).T)
+        dq[:, :, 2] = self.displacement[3:6]
+        dq[:, :, 3] = np.dot(d_ray_theta, pan_tilt_rotation.T)
+        dq[:, :, 4] = np.dot(d_ray_phi, pan_tilt_rotation.T)
+
+        # angles are in degree
+        dq[:, :, [0, 1, 3, 4]] *= math.pi / 180.0
+
+        inv_qz = 1.0 / q[:, 2]
+        jacobi = np.empty((n, 2, 5))
+        jacobi[:, 0, :] = fl * inv_qz[:, None] * (dq[:, 0, :] - (q[:, 0] * inv_qz)[:, None] * dq[:, 2, :])
+        jacobi[:, 1, :] = fl * inv_qz[:, None] * (dq[:, 1, :] - (q[:, 1] * inv_qz)[:, None] * dq[:, 2, :])
+
+        # focal length also scales the normalized point
+        jacobi[:, 0, 2] += q[:, 0] * inv_qz
+        jacobi[:, 1, 2] += q[:, 1] * inv_qz
+
+        return jacobi[:, :, 0:3], jacobi[:, :, 3:5]
 
     def back_project_to_3d_point(self, x, y):
         """
@@ -275,13 +364,22 @@ class PTZCamera:
     def back_project_to_3d_points(self, keypoints):
         """
         Back project a bunch of image points to 3d points.
+        The inverse of K * R is computed once for all points.
         :param keypoints: [n, 2] array of a array of points on image.
         :return: [n, 3] array of corresponding 3d point.
         """
-        points_3d = np.ndarray([0, 3])
-        for i in range(len(keypoints)):
-            point_3d = self.back_project_to_3d_point(keypoints[i, 0], keypoints[i, 1])
-            points_3d = np.row_stack([points_3d, point_3d])
+        keypoints = np.asarray(keypoints, dtype=np.float64).reshape(-1, 2)
+
+        # set z(3d point) here.
+        z = 0
+
+        inv_mat = np.linalg.inv(np.dot(self.compute_camera_matrix(), self.compute_rotation_matrix()))
+
+        im_pos = np.column_stack([keypoints, np.ones(len(keypoints))])
+        direction = np.dot(im_pos, inv_mat.T)
+
+        coe = (z - self.camera_center[2]) / direction[:, 2]
+        points_3d = coe.reshape(-1, 1) * direction + np.asarray(self.camera_center)
         return points_3d
 
     def back_project_to_ray(self, x, y):
@@ -314,14 +412,24 @@ class PTZCamera:
     def back_project_to_rays(self, points):
         """
         Back project a bunch of image points to rays.
+        The inverse of K and pan-tilt rotation are computed once for all points.
         :param points: [n, 2] array of image points.
         :return: [n, 2] array of corresponding rays.
         """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+        disp = self.compute_dispalcement()
+        invK = np.linalg.inv(self.compute_camera_matrix())
+        pan_tilt_R = np.dot(self.compute_tilt_matrix(), self.compute_pan_matrix())
+        pan_tilt_R_inv = np.linalg.inv(pan_tilt_R)
+
+        im_pos = np.column_stack([points, np.ones(len(points))])
+        relative_pos = np.dot(np.dot(im_pos, invK.T) - disp, pan_tilt_R_inv.T)
+        x3d, y3d, z3d = relative_pos[:, 0], relative_pos[:, 1], relative_pos[:, 2]
 
-        rays = np.ndarray([0, 2])
-        for i in range(len(points)):
-            angles = self.back_project_to_ray(points[i, 0], points[i, 1])
-            rays = np.row_stack([rays, angles])
+        rays = np.empty((len(points), 2))
+        rays[:, 0] = np.degrees(np.arctan(x3d / z3d))
+        rays[:, 1] = np.degrees(np.arctan(-y3d / np.sqrt(x3d * x3d + z3d * z3d)))
         return rays
 
 
@@ -385,6 +493,8 @@ def estimate_camera_from_homography(homography, camera, points3d_on_field):
 
 
 def ut_broadcast_camera_model():
+    import scipy.io as sio
+
     hockey_model = sio.loadmat("../../ice_hockey_1/ice_hockey_model.mat")
     points = hockey_model['points']
     line_index = hockey_model['line_segment_index']
@@ -433,6 +543,8 @@ def ut_broadcast_camera_model():
 
 
 def ut_ray_project():
+    import scipy.io as sio
+
     annotation = sio.loadmat("../../ice_hockey_1/olympic_2010_reference_frame.mat")
     filename = annotation["images"]
     ptzs = annotation["opt_ptzs"]
@@ -450,6 +562,29 @@ def ut_ray_project():
     print(camera.back_project_to_ray(0, 320))
 
 
+def ut_project_ray_array():
+    """
+    Compare vectorized ray projection with the per-ray projection (result and speed).
+    """
+    camera = PTZCamera((640, 360), np.array([52, -45, 17]), np.array([1.58, 0, 0]),
+                       np.array([1e-3, -2e-3, 3e-3, 1e-7, -2e-7, 3e-7]))
+    camera.set_ptz((10, -8, 3000))
+
+    for n in [1000, 10000, 100000]:
+        rays = np.column_stack([np.random.uniform(-5, 25, n), np.random.uniform(-20, 4, n)])
+
+        t0 = time.time()
+        scalar_points = np.array([camera.project_ray(rays[i]) for i in range(n)])
+        t1 = time.time()
+        points, mask = camera.project_ray_array(rays, 720, 1280)
+        t2 = time.time()
+
+        assert np.allclose(points, scalar_points)
+        print("%d rays: scalar %.4f s, vectorized %.4f s, speedup %.1fx, %d in image" %
+              (n, t1 - t0, t2 - t1, (t1 - t0) / max(t2 - t1, 1e-9), np.sum(mask)))
+
+
 if __name__ == '__main__':
     ut_broadcast_camera_model()
     # ut_ray_project()
+    # ut_project_ray_array()
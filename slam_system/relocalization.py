@@ -10,6 +10,8 @@ Created by Luke, 2018.9
 
 import numpy as np
 import cv2 as cv
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from scene_map import Map
 from image_process import *
 from sequence_manager import SequenceManager
@@ -17,6 +19,7 @@ from transformation import TransFunction
 from key_frame import KeyFrame
 from scipy.optimize import least_squares
 from util import *
+from vocabulary import VocabularyTree
 
 
 def _compute_residual(pose, rays, points, u, v):
@@ -29,17 +32,24 @@ def _compute_residual(pose, rays, points, u, v):
     :return: reprojection error of these points
     """
 
+    reproject_x, reproject_y = TransFunction.from_ray_to_image_array(u, v, pose[2], pose[0], pose[1],
+                                                                     rays[:, 0], rays[:, 1])
     residual = np.ndarray([2 * len(rays)])
-
-    for i in range(len(rays)):
-        reproject_x, reproject_y = TransFunction.from_ray_to_image(u, v, pose[2], pose[0], pose[1], rays[i, 0],
-                                                                     rays[i, 1])
-        residual[2 * i] = reproject_x - points[i, 0]
-        residual[2 * i + 1] = reproject_y - points[i, 1]
+    residual[0::2] = reproject_x - points[:, 0]
+    residual[1::2] = reproject_y - points[:, 1]
 
     return residual
 
 
+def _compute_jacobian(pose, rays, points, u, v):
+    """
+    jacobian of _compute_residual
+    :return: [2 * N, 3] array
+    """
+    return TransFunction.from_ray_to_image_pose_jacobian(pose[2], pose[0], pose[1],
+                                                         rays[:, 0], rays[:, 1]).reshape(-1, 3)
+
+
 def _recompute_matching_ray(keyframe, img, feature_method):
     """
     :param keyframe: keyframe object to match
@@ -47,12 +57,11 @@ def _recompute_matching_ray(keyframe, img, feature_method):
     :return: points [N, 2] array in img, rays [N, 2] array in keyframe
     """
 
-    bounding_box = np.ones([720, 1280])
-    bounding_box[13:51, 303:976] = 0
+    bounding_box = _relocalization_bounding_box()
 
     if feature_method == 'sift':
         kp, des = detect_compute_sift_array(img, 1000, norm=False)
-        keyframe_kp, keyframe_des = detect_compute_sift_array(keyframe.img, 1000, norm=False)
+        keyframe_kp, keyframe_des = keyframe.get_features('sift', 1000, pts_array=True)
 
         bounding_box_mask_index = keypoints_masking(kp, bounding_box)
         kp = kp[bounding_box_mask_index]
@@ -71,11 +80,11 @@ def _recompute_matching_ray(keyframe, img, feature_method):
         pt1, index1, pt2, index2 = match_sift_features(kp, des, keyframe_kp, keyframe_des, pts_array=True)
     elif feature_method == 'orb':
         kp, des = detect_compute_orb(img, 6000)
-        keyframe_kp, keyframe_des = detect_compute_orb(keyframe.img, 6000)
+        keyframe_kp, keyframe_des = keyframe.get_features('orb', 6000)
         pt1, index1, pt2, index2 = match_orb_features(kp, des, keyframe_kp, keyframe_des)
     elif feature_method == 'latch':
         kp, des = detect_compute_latch(img, 5000)
-        keyframe_kp, keyframe_des = detect_compute_latch(keyframe.img, 5000)
+        keyframe_kp, keyframe_des = keyframe.get_features('latch', 5000)
         pt1, index1, pt2, index2 = match_latch_features(kp, des, keyframe_kp, keyframe_des)
     else:
         assert False
@@ -93,16 +102,138 @@ def _recompute_matching_ray(keyframe, img, feature_method):
     return pt1, rays
 
 
-def relocalization_camera(map, img, pose):
+def _relocalization_bounding_box():
+    """
+    :return: mask that removes the score board
+    """
+    bounding_box = np.ones([720, 1280])
+    bounding_box[13:51, 303:976] = 0
+    return bounding_box
+
+
+def _keyframe_features(keyframe, feature_method):
+    """
+    keyframe features for keyframe selection in relocalization, detected once and cached in the keyframe
+    :return: keypoints, descriptors
+    """
+    if feature_method == 'sift':
+        keyframe_kp, keyframe_des = keyframe.get_features('sift', 300, pts_array=True)
+
+        bounding_box_mask_index = keypoints_masking(keyframe_kp, _relocalization_bounding_box())
+        keyframe_kp = keyframe_kp[bounding_box_mask_index]
+        keyframe_des = keyframe_des[bounding_box_mask_index]
+
+    elif feature_method == 'orb':
+        keyframe_kp, keyframe_des = keyframe.get_features('orb', 6000)
+    elif feature_method == 'latch':
+        keyframe_kp, keyframe_des = keyframe.get_features('latch', 5000)
+    else:
+        assert False
+
+    return keyframe_kp, keyframe_des
+
+
+def prepare_relocalization_features(keyframe, map):
+    """
+    detect and cache the keyframe features used by relocalization_camera, so that relocalization only
+    detects features of the lost image. The keyframe is added to the vocabulary of the map if it has one.
+    :param keyframe: keyframe object
+    :param map: object of class Map
+    """
+    _, keyframe_des = _keyframe_features(keyframe, map.feature_method)
+    if map.feature_method == 'sift':
+        keyframe.get_features('sift', 1000, pts_array=True)
+
+    if map.vocabulary is not None:
+        map.vocabulary.add(keyframe.img_index, keyframe_des)
+
+
+def build_vocabulary(map, branch_factor=8, depth=3):
+    """
+    train a vocabulary tree from keyframe descriptors of the map and add the keyframes to it.
+    Keyframes added later are added to the vocabulary without training.
+    :param map: object of class Map
+    :param branch_factor:
+    :param depth:
+    :return: vocabulary tree, also set to map.vocabulary
+    """
+    descriptors = [_keyframe_features(keyframe, map.feature_method)[1] for keyframe in map.keyframe_list]
+
+    vocabulary = VocabularyTree(branch_factor, depth)
+    vocabulary.train(np.vstack(descriptors))
+    for keyframe, des in zip(map.keyframe_list, descriptors):
+        vocabulary.add(keyframe.img_index, des)
+
+    map.vocabulary = vocabulary
+    return vocabulary
+
+
+def _candidate_keyframes(map, des, candidate_num, pose=None, search_radius=None):
+    """
+    :return: index of keyframes in map.keyframe_list for geometric verification
+    """
+    keyframe_index = range(len(map.keyframe_list))
+
+    # pose prior: only keyframes around the lost pose
+    if search_radius is not None:
+        near_index = map.keyframes_near_pose(pose, search_radius)
+        if len(near_index) > 0:
+            keyframe_index = near_index
+        else:
+            print("Warning: no keyframe around the lost pose, search all keyframes.")
+
+    if map.vocabulary is None:
+        return keyframe_index
+
+    # keyframes are added to the vocabulary when they are mapped (prepare_relocalization_features)
+    keys, _ = map.vocabulary.query(des, [map.keyframe_list[i].img_index for i in keyframe_index], candidate_num)
+    list_index = {map.keyframe_list[i].img_index: i for i in keyframe_index}
+    return [list_index[key] for key in keys]
+
+
+def _verify_keyframe(keyframe, kp, des, feature_method):
+    """
+    match the lost image with a keyframe
+    :return: number of matches that pass the homography ransac
+    """
+    keyframe_kp, keyframe_des = _keyframe_features(keyframe, feature_method)
+
+    if len(keyframe_kp) == 0:
+        return 0
+
+    if feature_method == 'sift':
+        pt1, index1, pt2, index2 = match_sift_features(keyframe_kp, keyframe_des, kp, des, pts_array=True)
+    elif feature_method == 'orb':
+        pt1, index1, pt2, index2 = match_orb_features(keyframe_kp, keyframe_des, kp, des)
+    elif feature_method == 'latch':
+        pt1, index1, pt2, index2 = match_latch_features(keyframe_kp, keyframe_des, kp, des)
+    else:
+        assert False
+
+    if index1 is None:
+        return 0
+    return len(index1)
+
+
+def relocalization_camera(map, img, pose, candidate_num=5, search_radius=None,
+                          num_threads=1, inlier_threshold=None, deadline=None):
     """
     :param map: object of class Map
     :param img: lost image
     :param pose: lost camera pose: array [3]
+    :param candidate_num: number of keyframes retrieved by the vocabulary tree of the map for
+    geometric verification. All keyframes are verified if the map has no vocabulary.
+    :param search_radius: pan angle (degree) around the lost pose to search keyframes, None for all keyframes.
+    See Map.keyframes_near_pose
+    :param num_threads: number of threads to verify keyframes (OpenCV matching and RANSAC release the GIL)
+    :param inlier_threshold: stop verification when a keyframe has this number of matches, None to verify all
+    :param deadline: time (seconds) from the start of relocalization to stop verification, None for no limit.
+    The best verified keyframe is used.
     :return: corrected camera pose: array [3]
     """
+    start_time = time.time()
 
-    bounding_box = np.ones([720, 1280])
-    bounding_box[13:51, 303:976] = 0
+    bounding_box = _relocalization_bounding_box()
 
     if map.feature_method == 'sift':
         kp, des = detect_compute_sift_array(img, 300, norm=False)
@@ -119,50 +250,44 @@ def relocalization_camera(map, img, pose):
     else:
         assert False
 
-    nearest_keyframe = -1
-    max_matched_num = 0
-
-    matched_keyframe_pt = None
-    matched_keyframe_index = None
-    matched_cur_frame_pt = None
-
-    for i in range(len(map.keyframe_list)):
-        keyframe = map.keyframe_list[i]
-        # keyframe_kp, keyframe_des = keyframe.feature_pts, keyframe.feature_des
-
-        if map.feature_method == 'sift':
-            # keyframe_kp, keyframe_des = keyframe.feature_pts, keyframe.feature_des
-            keyframe_kp, keyframe_des = detect_compute_sift_array(keyframe.img, 300, norm=False)
-
-            bounding_box_mask_index = keypoints_masking(keyframe_kp, bounding_box)
-            keyframe_kp = keyframe_kp[bounding_box_mask_index]
-            keyframe_des = keyframe_des[bounding_box_mask_index]
-
-        elif map.feature_method == 'orb':
-            keyframe_kp, keyframe_des = detect_compute_orb(keyframe.img, 6000)
-        elif map.feature_method == 'latch':
-            keyframe_kp, keyframe_des = detect_compute_latch(keyframe.img, 5000)
-        else:
-            assert False
-
-        if len(keyframe_kp) == 0:
-            continue
-
-        print("number", len(keyframe_kp), len(kp))
-
-        if map.feature_method == 'sift':
-            pt1, index1, pt2, index2 = match_sift_features(keyframe_kp, keyframe_des, kp, des, pts_array=True)
-        elif map.feature_method == 'orb':
-            pt1, index1, pt2, index2 = match_orb_features(keyframe_kp, keyframe_des, kp, des)
-        elif map.feature_method == 'latch':
-            pt1, index1, pt2, index2 = match_latch_features(keyframe_kp, keyframe_des, kp, des)
-        else:
-            assert False
+    candidates = list(_candidate_keyframes(map, des, candidate_num, pose, search_radius))
+
+    # best keyframe: most matches, the first candidate for the same number of matches
+    best = [-1, 0, len(candidates)]  # keyframe index, matched number, candidate rank
+
+    def update_best(rank, matched_num):
+        if matched_num > best[1] or (matched_num == best[1] and matched_num > 0 and rank < best[2]):
+            best[:] = candidates[rank], matched_num, rank
+        return inlier_threshold is not None and best[1] >= inlier_threshold
+
+    if num_threads > 1 and len(candidates) > 1:
+        executor = ThreadPoolExecutor(num_threads)
+        futures = {executor.submit(_verify_keyframe, map.keyframe_list[i], kp, des, map.feature_method): rank
+                   for rank, i in enumerate(candidates)}
+        pending = set(futures)
+        try:
+            while len(pending) > 0:
+                timeout = None if deadline is None else max(0, deadline - (time.time() - start_time))
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    print("Warning: relocalization deadline, %d keyframes are not verified." % len(pending))
+                    break
+                if any([update_best(futures[future], future.result()) for future in done]):
+                    break
+        finally:
+            # also stop the remaining jobs when a verification raises
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+    else:
+        for rank, i in enumerate(candidates):
+            if deadline is not None and time.time() - start_time > deadline:
+                print("Warning: relocalization deadline, %d keyframes are not verified." % (len(candidates) - rank))
+                break
+            if update_best(rank, _verify_keyframe(map.keyframe_list[i], kp, des, map.feature_method)):
+                break
 
-        if index1 is not None:
-            if len(index1) > max_matched_num:
-                max_matched_num = len(index1)
-                nearest_keyframe = i
+    nearest_keyframe = best[0]
 
     # cannot find a good key frame
     if nearest_keyframe == -1:
@@ -183,8 +308,8 @@ def relocalization_camera(map, img, pose):
         v = keyframe.v
 
         # optimized the camera pose
-        optimized_pose = least_squares(_compute_residual, pose, verbose=2, x_scale='jac', ftol=1e-4, method='trf',
-                                       args=(rays, points, u, v))
+        optimized_pose = least_squares(_compute_residual, pose, jac=_compute_jacobian, verbose=2, x_scale='jac',
+                                       ftol=1e-4, method='trf', args=(rays, points, u, v))
 
         return optimized_pose.x
 
@@ -8,6 +8,7 @@
 
 #include "bt_dt_regressor.h"
 #include <string>
+#include <string.h>
 #include "bt_dtr_node.h"
 #include "yael_io.h"
 #include "dt_util.hpp"
@@ -139,6 +140,53 @@ bool BTDTRegressor::predict(const Eigen::VectorXf & feature,
     return predictions.size() == maxTreeNum;
 }
 
+bool BTDTRegressor::predict(const vector<Eigen::VectorXf> & features,
+                            const int maxCheck,
+                            vector<vector<Eigen::VectorXf> > & predictions,
+                            vector<vector<float> > & dists,
+                            const int num_threads) const
+{
+    assert(trees_.size() > 0);
+    
+    const int feature_num = (int)features.size();
+    const int tree_num = (int)trees_.size();
+    
+    // Step 1: predict from each tree, a (feature, tree) pair is a job
+    // so that a few features still use all threads
+    vector<Eigen::VectorXf> tree_predictions(feature_num * tree_num);
+    vector<float> tree_dists(feature_num * tree_num, 0.0f);
+    vector<char> tree_is_pred(feature_num * tree_num, 0);
+    DTUtil::parallelFor(feature_num * tree_num, num_threads, [&](int k) {
+        const int i = k / tree_num;
+        const int t = k % tree_num;
+        tree_is_pred[k] = trees_[t]->predict(features[i], maxCheck, tree_predictions[k], tree_dists[k]);
+    });
+    
+    // Step 2: ordered by local patch feature distance
+    predictions.resize(feature_num);
+    dists.resize(feature_num);
+    vector<char> is_pred(feature_num, 0);
+    DTUtil::parallelFor(feature_num, num_threads, [&](int i) {
+        vector<Eigen::VectorXf> unordered_predictions;
+        vector<float> unordered_dists;
+        for (int k = i * tree_num; k < (i + 1) * tree_num; k++) {
+            if (tree_is_pred[k]) {
+                unordered_predictions.push_back(tree_predictions[k]);
+                unordered_dists.push_back(tree_dists[k]);
+            }
+        }
+        vector<size_t> sortIndexes = dt::sortIndices<float>(unordered_dists);
+        predictions[i].clear();
+        dists[i].clear();
+        for (int j = 0; j<sortIndexes.size(); j++) {
+            predictions[i].push_back(unordered_predictions[sortIndexes[j]]);
+            dists[i].push_back(unordered_dists[sortIndexes[j]]);
+        }
+        is_pred[i] = predictions[i].size() == tree_num;
+    });
+    return std::find(is_pred.begin(), is_pred.end(), 0) == is_pred.end();
+}
+
 bool BTDTRegressor::saveModel(const char *file_name) const
 {
     assert(trees_.size() > 0);
@@ -228,6 +276,7 @@ bool BTDTRegressor::load(const char *fileName)
         }
     }
     trees_.clear();
+    mapped_file_.reset();
     
     // read each tree
     for (int i = 0; i<treeFiles.size(); i++) {
@@ -255,3 +304,328 @@ bool BTDTRegressor::load(const char *fileName)
     return true;
     
 }
+
+// binary model, native byte order
+// BinaryModelHeader | tree 0 | tree 1 | ...
+// tree: BinaryTreeHeader | BinaryNode x node_num (pre-order) | label mean | label stddev | leaf node descriptor
+// label mean, stddev: leaf_node_num x label_dim, descriptor: leaf_node_num x feature_dim, float
+// each tree starts at an 8-byte aligned offset
+namespace {
+    const char binary_model_magic[8] = {'B', 'T', 'D', 'T', 'R', 'M', 'A', 'P'};
+    const int binary_model_version = 1;
+    
+    struct BinaryModelHeader {
+        char magic[8];
+        int version;
+        int feature_dim;
+        int label_dim;
+        int tree_num;
+        // BTDTRTreeParameter
+        int max_tree_depth;
+        int max_balanced_depth;
+        int max_sample_num;
+        int min_leaf_node;
+        int min_split_node;
+        int candidate_dim_num;
+        int candidate_threshold_num;
+        int verbose;
+        double min_split_node_std_dev;
+        int verbose_leaf;
+        int reserved;
+    };
+    
+    struct BinaryTreeHeader {
+        int node_num;
+        int leaf_node_num;
+    };
+    
+    struct BinaryNode {
+        int depth;
+        int is_leaf;
+        int split_dim;
+        int left;         // node index, -1 for no child
+        int right;
+        int leaf_index;   // -1 for internal node
+        int sample_num;
+        float split_threshold;
+        double sample_percentage;
+    };
+    
+    static_assert(sizeof(BinaryModelHeader) == 72, "unexpected padding in BinaryModelHeader");
+    static_assert(sizeof(BinaryNode) == 40, "unexpected padding in BinaryNode");
+    
+    size_t alignedOffset(const size_t offset)
+    {
+        return (offset + 7) / 8 * 8;
+    }
+    
+    // return index of the node in nodes, -1 for NULL node
+    int flattenNode(const BTDTRNode* node, vector<BinaryNode> & nodes)
+    {
+        if (node == NULL) {
+            return -1;
+        }
+        const int index = (int)nodes.size();
+        BinaryNode bn;
+        memset(&bn, 0, sizeof(bn));
+        bn.depth = node->depth_;
+        bn.is_leaf = node->is_leaf_;
+        bn.split_dim = node->split_param_.split_dim_;
+        bn.split_threshold = node->split_param_.split_threshold_;
+        bn.leaf_index = node->is_leaf_ ? node->index_ : -1;
+        bn.sample_num = node->sample_num_;
+        bn.sample_percentage = node->sample_percentage_;
+        nodes.push_back(bn);
+        
+        const int left = flattenNode(node->left_child_, nodes);
+        const int right = flattenNode(node->right_child_, nodes);
+        nodes[index].left = left;
+        nodes[index].right = right;
+        return index;
+    }
+    
+    // return NULL if the node array is broken
+    BTDTRNode* unflattenNode(const BinaryNode* nodes, const int node_num, const int index,
+                             const float* label_mean, const float* label_stddev,
+                             const int feature_dim, const int label_dim, const int leaf_node_num)
+    {
+        const BinaryNode & bn = nodes[index];
+        if (bn.is_leaf && (bn.leaf_index < 0 || bn.leaf_index >= leaf_node_num)) {
+            return NULL;
+        }
+        if (!bn.is_leaf && (bn.split_dim < 0 || bn.split_dim >= feature_dim)) {
+            return NULL;
+        }
+        
+        BTDTRNode* node = new BTDTRNode(bn.depth);
+        node->is_leaf_ = bn.is_leaf != 0;
+        node->split_param_.split_dim_ = bn.split_dim;
+        node->split_param_.split_threshold_ = bn.split_threshold;
+        node->sample_num_ = bn.sample_num;
+        node->sample_percentage_ = bn.sample_percentage;
+        if (node->is_leaf_) {
+            node->index_ = bn.leaf_index;
+            node->label_mean_ = Eigen::Map<const VectorXf>(label_mean + (size_t)bn.leaf_index * label_dim, label_dim);
+            node->label_stddev_ = Eigen::Map<const VectorXf>(label_stddev + (size_t)bn.leaf_index * label_dim, label_dim);
+        }
+        
+        // children are after the parent in pre-order
+        const int children[2] = {bn.left, bn.right};
+        BTDTRNode** child_nodes[2] = {&node->left_child_, &node->right_child_};
+        for (int i = 0; i<2; i++) {
+            if (children[i] == -1) {
+                continue;
+            }
+            if (children[i] <= index || children[i] >= node_num) {
+                delete node;
+                return NULL;
+            }
+            *child_nodes[i] = unflattenNode(nodes, node_num, children[i], label_mean, label_stddev,
+                                            feature_dim, label_dim, leaf_node_num);
+            if (*child_nodes[i] == NULL) {
+                delete node;
+                return NULL;
+            }
+        }
+        return node;
+    }
+    
+    void writePadding(FILE *pf)
+    {
+        const long pos = ftell(pf);
+        const char zeros[8] = {0};
+        fwrite(zeros, 1, alignedOffset(pos) - pos, pf);
+    }
+}
+
+bool BTDTRegressor::saveBinaryModel(const char *file_name) const
+{
+    assert(trees_.size() > 0);
+    FILE *pf = fopen(file_name, "wb");
+    if (!pf) {
+        printf("Error: can not open file %s\n", file_name);
+        return false;
+    }
+    
+    BinaryModelHeader header;
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, binary_model_magic, sizeof(header.magic));
+    header.version = binary_model_version;
+    header.feature_dim = feature_dim_;
+    header.label_dim = label_dim_;
+    header.tree_num = (int)trees_.size();
+    header.max_tree_depth = reg_tree_param_.max_tree_depth_;
+    header.max_balanced_depth = reg_tree_param_.max_balanced_depth_;
+    header.max_sample_num = reg_tree_param_.max_sample_num_;
+    header.min_leaf_node = reg_tree_param_.min_leaf_node_;
+    header.min_split_node = reg_tree_param_.min_split_node_;
+    header.candidate_dim_num = reg_tree_param_.candidate_dim_num_;
+    header.candidate_threshold_num = reg_tree_param_.candidate_threshold_num_;
+    header.verbose = reg_tree_param_.verbose_;
+    header.min_split_node_std_dev = reg_tree_param_.min_split_node_std_dev_;
+    header.verbose_leaf = reg_tree_param_.verbose_leaf_;
+    fwrite(&header, sizeof(header), 1, pf);
+    
+    for (int i = 0; i<trees_.size(); i++) {
+        BTDTRTree* tree = trees_[i];
+        assert(tree && tree->leaf_node_num_ == tree->leaf_nodes_.size());
+        
+        vector<BinaryNode> nodes;
+        flattenNode(tree->root_, nodes);
+        
+        const int leaf_node_num = tree->leaf_node_num_;
+        Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> label_mean, label_stddev, descriptors;
+        label_mean = Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>::Zero(leaf_node_num, label_dim_);
+        label_stddev = label_mean;
+        for (int j = 0; j<leaf_node_num; j++) {
+            const BTDTRNode* leaf = tree->leaf_nodes_[j];
+            if (leaf->label_mean_.size() == label_dim_) {
+                label_mean.row(j) = leaf->label_mean_;
+            }
+            if (leaf->label_stddev_.size() == label_dim_) {
+                label_stddev.row(j) = leaf->label_stddev_;
+            }
+        }
+        tree->getLeafNodeDescriptor(descriptors);
+        assert(descriptors.rows() == leaf_node_num && descriptors.cols() == feature_dim_);
+        
+        BinaryTreeHeader tree_header;
+        tree_header.node_num = (int)nodes.size();
+        tree_header.leaf_node_num = leaf_node_num;
+        fwrite(&tree_header, sizeof(tree_header), 1, pf);
+        fwrite(nodes.data(), sizeof(BinaryNode), nodes.size(), pf);
+        fwrite(label_mean.data(), sizeof(float), label_mean.size(), pf);
+        fwrite(label_stddev.data(), sizeof(float), label_stddev.size(), pf);
+        fwrite(descriptors.data(), sizeof(float), descriptors.size(), pf);
+        writePadding(pf);
+    }
+    
+    bool is_write = ferror(pf) == 0;
+    fclose(pf);
+    if (!is_write) {
+        printf("Error: can not write file %s\n", file_name);
+    }
+    return is_write;
+}
+
+bool BTDTRegressor::isBinaryModel(const char *file_name)
+{
+    char magic[sizeof(binary_model_magic)] = {0};
+    FILE *pf = fopen(file_name, "rb");
+    if (!pf) {
+        return false;
+    }
+    size_t num = fread(magic, 1, sizeof(magic), pf);
+    fclose(pf);
+    return num == sizeof(magic) && memcmp(magic, binary_model_magic, sizeof(magic)) == 0;
+}
+
+bool BTDTRegressor::loadBinaryModel(const char *file_name)
+{
+    std::shared_ptr<DTMappedFile> mapped_file(new DTMappedFile());
+    if (!mapped_file->open(file_name)) {
+        return false;
+    }
+    const char* data = mapped_file->data();
+    const size_t size = mapped_file->size();
+    
+    BinaryModelHeader header;
+    if (size < sizeof(header)) {
+        printf("Error: %s is not a binary model\n", file_name);
+        return false;
+    }
+    memcpy(&header, data, sizeof(header));
+    if (memcmp(header.magic, binary_model_magic, sizeof(header.magic)) != 0 ||
+        header.version != binary_model_version) {
+        printf("Error: %s is not a binary model of version %d\n", file_name, binary_model_version);
+        return false;
+    }
+    if (header.tree_num <= 0 || header.feature_dim <= 0 || header.label_dim <= 0) {
+        printf("Error: broken binary model %s\n", file_name);
+        return false;
+    }
+    
+    BTDTRTreeParameter tree_param;
+    tree_param.tree_num_ = header.tree_num;
+    tree_param.max_tree_depth_ = header.max_tree_depth;
+    tree_param.max_balanced_depth_ = header.max_balanced_depth;
+    tree_param.max_sample_num_ = header.max_sample_num;
+    tree_param.min_leaf_node_ = header.min_leaf_node;
+    tree_param.min_split_node_ = header.min_split_node;
+    tree_param.candidate_dim_num_ = header.candidate_dim_num;
+    tree_param.candidate_threshold_num_ = header.candidate_threshold_num;
+    tree_param.verbose_ = header.verbose != 0;
+    tree_param.min_split_node_std_dev_ = header.min_split_node_std_dev;
+    tree_param.verbose_leaf_ = header.verbose_leaf != 0;
+    
+    // nodes are created, leaf node descriptors are used in place
+    vector<BTDTRTree*> trees;
+    size_t offset = alignedOffset(sizeof(header));
+    bool is_read = true;
+    for (int i = 0; i<header.tree_num && is_read; i++) {
+        BinaryTreeHeader tree_header;
+        if (offset + sizeof(tree_header) > size) {
+            is_read = false;
+            break;
+        }
+        memcpy(&tree_header, data + offset, sizeof(tree_header));
+        offset += sizeof(tree_header);
+        
+        const size_t node_num = tree_header.node_num;
+        const size_t leaf_node_num = tree_header.leaf_node_num;
+        const size_t tree_size = node_num * sizeof(BinaryNode) +
+                                 leaf_node_num * (2 * header.label_dim + header.feature_dim) * sizeof(float);
+        if (tree_header.node_num <= 0 || tree_header.leaf_node_num <= 0 || offset + tree_size > size) {
+            is_read = false;
+            break;
+        }
+        const BinaryNode* nodes = (const BinaryNode*)(data + offset);
+        const float* label_mean = (const float*)(data + offset + node_num * sizeof(BinaryNode));
+        const float* label_stddev = label_mean + leaf_node_num * header.label_dim;
+        const float* descriptors = label_stddev + leaf_node_num * header.label_dim;
+        
+        int leaf_count = 0;
+        for (int j = 0; j<tree_header.node_num; j++) {
+            leaf_count += nodes[j].is_leaf != 0;
+        }
+        if (leaf_count != tree_header.leaf_node_num) {
+            is_read = false;
+            break;
+        }
+        
+        BTDTRNode* root = unflattenNode(nodes, tree_header.node_num, 0, label_mean, label_stddev,
+                                        header.feature_dim, header.label_dim, tree_header.leaf_node_num);
+        if (root == NULL) {
+            is_read = false;
+            break;
+        }
+        
+        BTDTRTree* tree = new BTDTRTree();
+        tree->root_ = root;
+        tree->setTreeParameter(tree_param);
+        tree->leaf_node_num_ = tree_header.leaf_node_num;
+        tree->hashLeafNode();
+        tree->leaf_descriptors_ = descriptors;
+        tree->descriptor_dim_ = header.feature_dim;
+        trees.push_back(tree);
+        
+        offset = alignedOffset(offset + tree_size);
+    }
+    if (!is_read) {
+        printf("Error: broken binary model %s\n", file_name);
+        for (int i = 0; i<trees.size(); i++) {
+            delete trees[i];
+        }
+        return false;
+    }
+    
+    for (int i = 0; i<trees_.size(); i++) {
+        delete trees_[i];
+    }
+    trees_ = trees;
+    feature_dim_ = header.feature_dim;
+    label_dim_ = header.label_dim;
+    reg_tree_param_ = tree_param;
+    mapped_file_ = mapped_file;
+    return true;
+}
@@ -7,7 +7,9 @@
 
 #include <stdio.h>
 #include <vector>
+#include <memory>
 #include "bt_dtr_tree.h"
+#include "dt_mapped_file.hpp"
 
 using std::vector;
 
@@ -24,6 +26,9 @@ private:
     int feature_dim_;       // feature dimension
     int label_dim_;
     
+    // binary model file, leaf node descriptors are read from it
+    std::shared_ptr<DTMappedFile> mapped_file_;
+    
 public:
     BTDTRegressor(){feature_dim_ = 0; label_dim_ = 0;}
     ~BTDTRegressor();
@@ -57,10 +62,28 @@ public:
                  vector<float> & dists) const;
     
     
+    // predict a batch of features in parallel
+    // predictions, dists: predictions and distances of each feature, see above
+    // num_threads: number of threads, features and trees are split among threads
+    bool predict(const vector<Eigen::VectorXf> & features,
+                 const int maxCheck,
+                 vector<vector<Eigen::VectorXf> > & predictions,
+                 vector<vector<float> > & dists,
+                 const int num_threads) const;
+    
+    
     bool saveModel(const char *file_name) const;
     bool load(const char *file_name);
     
-    int treeNum(void){return (int)trees_.size();}    
+    // binary model: a single file that is memory-mapped in loading
+    // leaf node descriptors are not copied, so the model file is shared by processes
+    // convert a text model: load() then saveBinaryModel()
+    bool saveBinaryModel(const char *file_name) const;
+    bool loadBinaryModel(const char *file_name);
+    
+    static bool isBinaryModel(const char *file_name);
+    
+    int treeNum(void) const {return (int)trees_.size();}    
 };
 
 
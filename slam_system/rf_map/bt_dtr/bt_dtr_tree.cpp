@@ -7,7 +7,6 @@
 #include "bt_dtr_util.h"
 #include "dt_util.hpp"
 #include <iostream>
-#include "dt_random.hpp"
 
 
 
@@ -18,6 +17,8 @@ BTDTRTree::BTDTRTree()
 {
     root_ = NULL;
     leaf_node_num_ = 0;
+    leaf_descriptors_ = NULL;
+    descriptor_dim_ = 0;
 }
 
 BTDTRTree::~BTDTRTree()
@@ -34,10 +35,18 @@ BTDTRTree::BTDTRTree(const BTDTRTree & other)
     root_ = other.root_;
     tree_param_ = other.tree_param_;
     leaf_node_num_ = other.leaf_node_num_;
+    leaf_descriptors_ = other.leaf_descriptors_;
+    descriptor_dim_ = other.descriptor_dim_;
+    rng_ = other.rng_;
     
     std::copy(other.leaf_nodes_.begin(), other.leaf_nodes_.end(), leaf_nodes_.begin());
 }
 
+void BTDTRTree::setRandomSeed(const unsigned int seed)
+{
+    rng_.seed(seed);
+}
+
 bool BTDTRTree::buildTree(const vector<VectorXf> & features,
                const vector<VectorXf> & labels,
                const vector<unsigned int> & indices,
@@ -72,6 +81,8 @@ bool BTDTRTree::updateTree(const vector<VectorXf> & features,
     assert(features.size() == labels.size());
     assert(indices.size() <= features.size());
     
+    this->copyLeafNodeDescriptor();
+    
     tree_param_ = param;
     leaf_node_num_ = 0;
     
@@ -95,6 +106,7 @@ static bool bestSplitDimension(const vector<VectorXf> & features,
                                const vector<unsigned int> & indices,
                                const BTDTRTreeParameter & tree_param,
                                const int depth,
+                               std::mt19937 & rng,
                                BTDTRSplitParameter & split_param,
                                vector<unsigned int> & left_indices,
                                vector<unsigned int> & right_indices)
@@ -118,7 +130,12 @@ static bool bestSplitDimension(const vector<VectorXf> & features,
         return false;
     }
     
-    vector<double> rnd_split_values = DTRandom::generateRandomNumber(min_v, max_v, threshold_num);
+    // thresholds are from the generator of the tree, so that trees can be built in parallel
+    vector<double> rnd_split_values;
+    std::uniform_real_distribution<double> random_value(min_v, max_v);
+    for (int i = 0; i<threshold_num; i++) {
+        rnd_split_values.push_back(random_value(rng));
+    }
     
     bool is_use_balance = false;
     if (depth <= tree_param.max_balanced_depth_) {
@@ -209,7 +226,7 @@ bool BTDTRTree::configureNode(const vector<VectorXf> & features,
     
     // randomly select a subset of dimensions
     assert(dims_.size() == dim);
-    std::random_shuffle(dims_.begin(), dims_.end());
+    std::shuffle(dims_.begin(), dims_.end(), rng_);
     vector<unsigned int> random_dim(dims_.begin(), dims_.begin() + candidate_dim_num);
     assert(random_dim.size() > 0 && random_dim.size() <= dims_.size());
     
@@ -229,7 +246,7 @@ bool BTDTRTree::configureNode(const vector<VectorXf> & features,
         vector<unsigned int> cur_left_indices;
         vector<unsigned int> cur_right_indices;
         
-        bool cur_is_split = bestSplitDimension(features, labels, indices, tree_param_, depth,
+        bool cur_is_split = bestSplitDimension(features, labels, indices, tree_param_, depth, rng_,
                                                cur_split_param,
                                                cur_left_indices,
                                                cur_right_indices);
@@ -461,7 +478,13 @@ void BTDTRTree::searchLevel(flann::ResultSet<DistanceType>  & result_set, const
         checkCount++;
         
         // squared distance
-        DistanceType dist = distance_(node->feat_mean_.data(), vec, node->feat_mean_.size());
+        DistanceType dist = 0;
+        if (leaf_descriptors_) {
+            dist = distance_(leaf_descriptors_ + (size_t)index * descriptor_dim_, vec, descriptor_dim_);
+        }
+        else {
+            dist = distance_(node->feat_mean_.data(), vec, node->feat_mean_.size());
+        }
         result_set.addPoint(dist, index);
         return;
     }
@@ -520,6 +543,11 @@ void BTDTRTree::getLeafNodeDescriptor(Eigen::Matrix<float, Eigen::Dynamic, Eigen
     assert(leaf_node_num_ > 0);
     assert(leaf_node_num_ == leaf_nodes_.size());
     
+    if (leaf_descriptors_) {
+        data = Eigen::Map<const Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> >(leaf_descriptors_, leaf_node_num_, descriptor_dim_);
+        return;
+    }
+    
     const int rows = leaf_node_num_;
     const int cols = (int)leaf_nodes_[0]->feat_mean_.size();
     
@@ -539,6 +567,19 @@ void BTDTRTree::setLeafNodeDescriptor(const Eigen::Matrix<float, Eigen::Dynamic,
     for (int i = 0; i<leaf_nodes_.size(); i++) {
         leaf_nodes_[i]->feat_mean_ = data.row(i);
     }
+    leaf_descriptors_ = NULL;
+}
+
+void BTDTRTree::copyLeafNodeDescriptor()
+{
+    if (!leaf_descriptors_) {
+        return;
+    }
+    assert(leaf_node_num_ == leaf_nodes_.size());
+    for (int i = 0; i<leaf_nodes_.size(); i++) {
+        leaf_nodes_[i]->feat_mean_ = Eigen::Map<const VectorXf>(leaf_descriptors_ + (size_t)i * descriptor_dim_, descriptor_dim_);
+    }
+    leaf_descriptors_ = NULL;
 }
 
 const BTDTRTreeParameter & BTDTRTree::getTreeParameter(void) const
@@ -13,6 +13,7 @@
 #include <vector>
 #include <Eigen/Dense>
 #include <algorithm>
+#include <random>
 #include "bt_dtr_util.h"
 
 #include "flann/util/heap.h"
@@ -47,7 +48,13 @@ class BTDTRTree
     int leaf_node_num_;   // total leaf node number
     vector<NodePtr> leaf_nodes_;   // leaf node for back tracking    
     
+    // leaf node descriptors in a read-only model file, leaf_node_num_ x descriptor_dim_, row major
+    // NULL: descriptors are in leaf nodes
+    const float* leaf_descriptors_;
+    int descriptor_dim_;
+    
     vector<int> dims_;             // candidate split dimension, only used in training
+    std::mt19937 rng_;             // random split dimension and threshold, see setRandomSeed
     
 public:
     BTDTRTree();
@@ -56,6 +63,10 @@ public:
     
     BTDTRTree(const BTDTRTree & other);
     
+    // random number generator of the split dimensions, set before training
+    // trees built in different threads should have their own seeds
+    void setRandomSeed(const unsigned int seed);
+    
     // features:
     // labels: regression label
     // indices:
@@ -104,6 +115,9 @@ private:
     // record leaf node in an array for O(1) access
     void hashLeafNode();
     
+    // copy descriptors from the model file to leaf nodes, before the tree is changed
+    void copyLeafNodeDescriptor();
+    
     // set leaf node
     void setLeafNode(const vector<VectorXf> & features,
                      const vector<VectorXf> & labels,
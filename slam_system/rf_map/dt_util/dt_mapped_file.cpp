@@ -0,0 +1,95 @@
+//
+//  dt_mapped_file.cpp
+//  Classifer_RF
+//
+//  Created by jimmy on 2019-07-20.
+//  Copyright (c) 2019 Nowhere Planet. All rights reserved.
+//
+
+#include "dt_mapped_file.hpp"
+#include <stdlib.h>
+
+#ifndef _WIN32
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#endif
+
+DTMappedFile::DTMappedFile()
+{
+    data_ = NULL;
+    size_ = 0;
+    is_mapped_ = false;
+}
+
+DTMappedFile::~DTMappedFile()
+{
+    this->close();
+}
+
+bool DTMappedFile::open(const char* file_name)
+{
+    this->close();
+#ifndef _WIN32
+    int fd = ::open(file_name, O_RDONLY);
+    if (fd < 0) {
+        printf("Error: can not open file %s\n", file_name);
+        return false;
+    }
+    struct stat st;
+    if (fstat(fd, &st) != 0 || st.st_size == 0) {
+        printf("Error: can not read file %s\n", file_name);
+        ::close(fd);
+        return false;
+    }
+    void* p = mmap(NULL, (size_t)st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    ::close(fd);  // the mapping is kept after the file is closed
+    if (p == MAP_FAILED) {
+        printf("Error: can not map file %s\n", file_name);
+        return false;
+    }
+    data_ = (const char*)p;
+    size_ = (size_t)st.st_size;
+    is_mapped_ = true;
+    return true;
+#else
+    FILE *pf = fopen(file_name, "rb");
+    if (!pf) {
+        printf("Error: can not open file %s\n", file_name);
+        return false;
+    }
+    fseek(pf, 0, SEEK_END);
+    long size = ftell(pf);
+    fseek(pf, 0, SEEK_SET);
+    char* buf = size > 0 ? (char*)malloc(size) : NULL;
+    if (!buf || fread(buf, 1, size, pf) != (size_t)size) {
+        printf("Error: can not read file %s\n", file_name);
+        free(buf);
+        fclose(pf);
+        return false;
+    }
+    fclose(pf);
+    data_ = buf;
+    size_ = (size_t)size;
+    is_mapped_ = false;
+    return true;
+#endif
+}
+
+void DTMappedFile::close()
+{
+    if (data_ == NULL) {
+        return;
+    }
+#ifndef _WIN32
+    if (is_mapped_) {
+        munmap((void*)data_, size_);
+    }
+#else
+    free((void*)data_);
+#endif
+    data_ = NULL;
+    size_ = 0;
+    is_mapped_ = false;
+}
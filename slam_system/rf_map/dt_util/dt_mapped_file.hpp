@@ -0,0 +1,39 @@
+//
+//  dt_mapped_file.hpp
+//  Classifer_RF
+//
+//  Created by jimmy on 2019-07-20.
+//  Copyright (c) 2019 Nowhere Planet. All rights reserved.
+//
+
+#ifndef __Classifer_RF__dt_mapped_file__
+#define __Classifer_RF__dt_mapped_file__
+
+#include <stdio.h>
+#include <stddef.h>
+
+// read-only file mapped to memory
+// pages are shared by all processes that map the same file
+// On Windows, the file is read to a buffer
+class DTMappedFile
+{
+    const char* data_;
+    size_t size_;
+    bool is_mapped_;
+    
+public:
+    DTMappedFile();
+    ~DTMappedFile();
+    
+    bool open(const char* file_name);
+    void close();
+    
+    const char* data() const {return data_;}
+    size_t size() const {return size_;}
+    
+private:
+    DTMappedFile(const DTMappedFile& other);
+    DTMappedFile& operator=(const DTMappedFile& other);
+};
+
+#endif /* defined(__Classifer_RF__dt_mapped_file__) */
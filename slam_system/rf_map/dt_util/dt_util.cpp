@@ -10,6 +10,8 @@
 #include <Eigen/QR>
 #include <iostream>
 #include <map>
+#include <thread>
+#include <atomic>
 
 using std::cout;
 using std::endl;
@@ -241,6 +243,32 @@ namespace dt {
 
 
 
+void DTUtil::parallelFor(const int n, const int num_threads, const std::function<void(int)> & func)
+{
+    const int thread_num = std::min(num_threads, n);
+    if (thread_num <= 1) {
+        for (int i = 0; i<n; i++) {
+            func(i);
+        }
+        return;
+    }
+    
+    std::atomic<int> next_index(0);
+    auto worker = [&]() {
+        for (int i = next_index++; i < n; i = next_index++) {
+            func(i);
+        }
+    };
+    vector<std::thread> threads;
+    for (int i = 0; i<thread_num - 1; i++) {
+        threads.push_back(std::thread(worker));
+    }
+    worker();
+    for (auto& t: threads) {
+        t.join();
+    }
+}
+
 vector<unsigned int> DTUtil::randomDimensions(const int dimension, const int candidate_dimension)
 {
     assert(dimension > 0);
@@ -15,6 +15,7 @@
 #include <Eigen/Dense>
 #include <unordered_map>
 #include <string>
+#include <functional>
 
 using std::vector;
 using std::string;
@@ -76,6 +77,10 @@ public:
     // randomly generate a subset of dimensions
     static vector<unsigned int> randomDimensions(const int dimension, const int ccandidate_dimension);
     
+    // call func(i) for i in [0, n) on num_threads threads, items are taken in order by idle threads
+    // num_threads <= 1: run in the calling thread
+    static void parallelFor(const int n, const int num_threads, const std::function<void(int)> & func);
+    
     template <class T>
     static double spatialVariance(const vector<T> & labels, const vector<unsigned int> & indices);
     
@@ -30,57 +30,67 @@ void OnlineRFMapBuilder::setTreeParameter(const TreeParameter& param)
     tree_param_.base_tree_param_.tree_num_ = 0; // initialization
 }
 
+const OnlineRFMapBuilder::TreeParameter & OnlineRFMapBuilder::getTreeParameter() const
+{
+    return tree_param_;
+}
+
+void OnlineRFMapBuilder::readSamples(const string & feature_label_file,
+                                     vector<btdtr_ptz_util::PTZTrainingSample> & samples) const
+{
+    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    Eigen::Vector3f dummy_ptz;  // not used
+    btdtr_ptz_util::generatePTZSampleWithFeature(feature_label_file.c_str(), pp, dummy_ptz, samples);
+}
+
 bool OnlineRFMapBuilder::addTree(BTDTRegressor& model,
                               const string & feature_label_file,
                               const char *model_file_name,
                               bool verbose)
 {
-    // 1. get unique files
-    unordered_set<string> all_files;
-    for (const auto& files: tree_feature_label_files_) {
-        for (const string& f:files) {
-            all_files.insert(f);
-        }
-    }
-    vector<string> unique_files;
-    for (const auto&f: all_files) {
-        unique_files.push_back(f);
-    }
+    vector<btdtr_ptz_util::PTZTrainingSample> samples;
+    this->readSamples(feature_label_file, samples);
+    return this->addTree(model, samples, model_file_name, verbose);
+}
+
+bool OnlineRFMapBuilder::addTree(BTDTRegressor& model,
+                                 const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
+                                 const char *model_file_name,
+                                 bool verbose)
+{
+    // 1. previous keyframes are all in trees
+    const int frame_num = (int)keyframe_samples_.size();
+    keyframe_samples_.push_back(samples);
     
-    // 2. sample training files
-    const int frame_num = (int)unique_files.size();
+    // 2. sample training keyframes
     const int sampled_frame_num = std::min(frame_num, tree_param_.sampled_frame_num_) - 1;
-    vector<string> sampled_files;
+    vector<int> sampled_keyframes;
     for (int j = 0; j<sampled_frame_num; j++) {
-        int index = rand()%frame_num;
-        sampled_files.push_back(unique_files[index]);
+        sampled_keyframes.push_back(rand()%frame_num);
     }
-    sampled_files.push_back(feature_label_file);
+    sampled_keyframes.push_back(frame_num);
     
-    return this->addTree(model, sampled_files, model_file_name, verbose);
+    return this->addTree(model, sampled_keyframes, model_file_name, verbose);
 }
 
 bool OnlineRFMapBuilder::addTree(BTDTRegressor& model,
-                              const vector<string> & feature_label_files,
+                              const vector<int> & keyframe_indices,
                               const char *model_file_name,
                               bool verbose)
 {
-    assert(feature_label_files.size() > 0);
-    assert(model.trees_.size() == tree_feature_label_files_.size());
+    assert(keyframe_indices.size() > 0);
+    assert(model.trees_.size() == tree_keyframes_.size());
     
-    // book keep feature label files
+    // book keep keyframes
     tree_param_.base_tree_param_.tree_num_ += 1;
-    tree_feature_label_files_.push_back(feature_label_files);
+    tree_keyframes_.push_back(keyframe_indices);
     model.reg_tree_param_ = tree_param_.base_tree_param_;
     
-    // 1. read training examples
-    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    // 1. collect training examples
     vector<VectorXf> features;
     vector<VectorXf> labels;
-    for (int j = 0; j<feature_label_files.size(); j++) {
-        vector<btdtr_ptz_util::PTZTrainingSample> samples;
-        Eigen::Vector3f dummy_ptz;  // not used
-        btdtr_ptz_util::generatePTZSampleWithFeature(feature_label_files[j].c_str(), pp, dummy_ptz, samples);
+    for (int j = 0; j<keyframe_indices.size(); j++) {
+        const vector<btdtr_ptz_util::PTZTrainingSample> & samples = keyframe_samples_[keyframe_indices[j]];
         for (int k = 0; k< samples.size(); k++) {
             features.push_back(samples[k].descriptor_);
             labels.push_back(samples[k].pan_tilt_);
@@ -96,6 +106,7 @@ bool OnlineRFMapBuilder::addTree(BTDTRegressor& model,
     
     TreePtr pTree = new TreeType();
     assert(pTree);
+    pTree->setRandomSeed(rand());
     double tt = clock();
     pTree->buildTree(features, labels, indices, tree_param_.base_tree_param_);
     
@@ -144,28 +155,53 @@ bool OnlineRFMapBuilder::updateTree(BTDTRegressor& model,
                                     const string & feature_label_file,
                                     const char *model_file_name,
                                     bool verbose)
+{
+    vector<btdtr_ptz_util::PTZTrainingSample> samples;
+    this->readSamples(feature_label_file, samples);
+    return this->updateTree(model, samples, model_file_name, verbose);
+}
+
+bool OnlineRFMapBuilder::canUpdateTree() const
+{
+    for (const auto& keyframes: tree_keyframes_) {
+        if ((int)keyframes.size() < this->maxTreeKeyframeNum()) {
+            return true;
+        }
+    }
+    return false;
+}
+
+bool OnlineRFMapBuilder::updateTree(BTDTRegressor& model,
+                                    const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
+                                    const char *model_file_name,
+                                    bool verbose)
 {
     assert(model.trees_.size() > 0);
+    assert(this->canUpdateTree());
     
-    const int tree_index = rand()%model.trees_.size();
+    // randomly select a tree that is not full
+    vector<int> candidate_trees;
+    for (int i = 0; i<tree_keyframes_.size(); i++) {
+        if ((int)tree_keyframes_[i].size() < this->maxTreeKeyframeNum()) {
+            candidate_trees.push_back(i);
+        }
+    }
+    const int tree_index = candidate_trees[rand()%candidate_trees.size()];
     
-    // add new file to book-keeper
-    tree_feature_label_files_[tree_index].push_back(feature_label_file);
+    // add new keyframe to book-keeper
+    keyframe_samples_.push_back(samples);
+    tree_keyframes_[tree_index].push_back((int)keyframe_samples_.size() - 1);
     const int tree_num = model.treeNum();
     assert(tree_index < tree_num);
     
-    // 1. read training examples
-    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    // 1. collect training examples
     vector<VectorXf> features;
     vector<VectorXf> labels;
-    for (int j = 0; j<tree_feature_label_files_[tree_index].size(); j++) {
-        vector<btdtr_ptz_util::PTZTrainingSample> samples;
-        Eigen::Vector3f dummy_ptz;  // not used
-        btdtr_ptz_util::generatePTZSampleWithFeature(tree_feature_label_files_[tree_index][j].c_str(),
-                                                     pp, dummy_ptz, samples);
-        for (int k = 0; k< samples.size(); k++) {
-            features.push_back(samples[k].descriptor_);
-            labels.push_back(samples[k].pan_tilt_);
+    for (int j = 0; j<tree_keyframes_[tree_index].size(); j++) {
+        const vector<btdtr_ptz_util::PTZTrainingSample> & cur_samples = keyframe_samples_[tree_keyframes_[tree_index][j]];
+        for (int k = 0; k< cur_samples.size(); k++) {
+            features.push_back(cur_samples[k].descriptor_);
+            labels.push_back(cur_samples[k].pan_tilt_);
         }
     }
     assert(features.size() == labels.size());
@@ -178,6 +214,7 @@ bool OnlineRFMapBuilder::updateTree(BTDTRegressor& model,
     
     TreePtr pTree = model.trees_[tree_index];
     assert(pTree);
+    pTree->setRandomSeed(rand());
     double tt = clock();
     pTree->updateTree(features, labels, indices, tree_param_.base_tree_param_);
     printf("update a tree cost %lf seconds\n", (clock()-tt)/CLOCKS_PER_SEC );
@@ -240,9 +277,19 @@ bool OnlineRFMapBuilder::isAddTree(const BTDTRegressor & model,
                                          const string & feature_label_file,
                                          const double error_threshold,
                                          const double percentage_threshold)
+{
+    vector<btdtr_ptz_util::PTZTrainingSample> samples;
+    this->readSamples(feature_label_file, samples);
+    return this->isAddTree(model, samples, error_threshold, percentage_threshold);
+}
+
+bool OnlineRFMapBuilder::isAddTree(const BTDTRegressor & model,
+                                   const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
+                                   const double error_threshold,
+                                   const double percentage_threshold)
 {
     vector<float> errors;
-    this->computePredictionError(model, feature_label_file, errors);
+    this->computePredictionError(model, samples, errors);
     
     double ratio = 0;
     for (const auto& e:errors) {
@@ -261,17 +308,11 @@ bool OnlineRFMapBuilder::isAddTree(const BTDTRegressor & model,
 }
 
 void OnlineRFMapBuilder::computePredictionError(const BTDTRegressor & model,
-                                               const string & feature_label_file,
+                                               const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
                                                vector<float> & prediction_error)
 {
-    // 1. read training examples
-    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
     vector<VectorXf> features;
     vector<VectorXf> labels;
-    vector<btdtr_ptz_util::PTZTrainingSample> samples;
-    
-    Eigen::Vector3f dummy_ptz;  // not used
-    btdtr_ptz_util::generatePTZSampleWithFeature(feature_label_file.c_str(), pp, dummy_ptz, samples);
     for (const auto &s:samples) {
         features.push_back(s.descriptor_);
         labels.push_back(s.pan_tilt_);
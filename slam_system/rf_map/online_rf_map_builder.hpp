@@ -24,8 +24,11 @@ class OnlineRFMapBuilder {
 private:
     TreeParameter tree_param_;
     
-    // feature label files in each tree
-    vector<vector<string> > tree_feature_label_files_;
+    // training samples of each keyframe, in adding order
+    vector<vector<btdtr_ptz_util::PTZTrainingSample> > keyframe_samples_;
+    
+    // keyframe indices in each tree
+    vector<vector<int> > tree_keyframes_;
     
 public:
     OnlineRFMapBuilder();
@@ -51,14 +54,40 @@ public:
                         const double error_threshold,
                         const double percentage_threshold);
     
+    // in-memory version, samples: training samples of the new keyframe
+    bool addTree(BTDTRegressor& model,
+                 const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
+                 const char *model_file_name,
+                 bool verbose = true);
+    
+    bool updateTree(BTDTRegressor& model,
+                    const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
+                    const char *model_file_name,
+                    bool verbose = true);
+    
+    bool isAddTree(const BTDTRegressor & model,
+                   const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
+                   const double error_threshold,
+                   const double percentage_threshold);
+    
+    // a tree has at most maxTreeKeyframeNum() keyframes, so that the cost of updating a tree is bounded
+    // return false if every tree is full, a new tree should be added
+    bool canUpdateTree() const;
+    
+    const TreeParameter & getTreeParameter() const;
+    
 private:
+    // up to sampled_frame_num keyframes are used to create a tree,
+    // the same number of new keyframes can be inserted to it
+    int maxTreeKeyframeNum() const {return 2 * tree_param_.sampled_frame_num_;}
+    
     // Add one tree to the init model
-    // using files from all feature_label_files and part of init_feature_label_files
+    // using the last keyframe and part of previous keyframes
     // model: input and output
-    // feature_label_files: new added files
+    // keyframe_indices: keyframes of the new tree
     // model_file_name: output, new model
     bool addTree(BTDTRegressor& model,
-                 const vector<string> & feature_label_files,
+                 const vector<int> & keyframe_indices,
                  const char *model_file_name,
                  bool verbose = true);
     
@@ -67,8 +96,11 @@ private:
                          const int sample_frame_num = 10) const;
     
     void computePredictionError(const BTDTRegressor & model,
-                                const string & feature_label_file,
+                                const vector<btdtr_ptz_util::PTZTrainingSample> & samples,
                                 vector<float> & prediction_error);
+    
+    void readSamples(const string & feature_label_file,
+                     vector<btdtr_ptz_util::PTZTrainingSample> & samples) const;
 };
 
 
@@ -7,11 +7,15 @@
 //
 
 #include "online_rf_map.hpp"
-#include "ptz_pose_estimation.h"
+#include "rf_map.hpp"
+
+// a new tree is added when less than half of the new samples are predicted within 0.1 degree
+static const double error_threshold = 0.1;
+static const double percentage_threshold = 0.5;
 
 OnlineRFMap::OnlineRFMap()
 {
-    
+    num_threads_ = 1;
 }
 
 OnlineRFMap::~OnlineRFMap()
@@ -35,9 +39,8 @@ void OnlineRFMap::createMap(const char * feature_label_file,
 void OnlineRFMap::updateMap(const char * feature_label_file,
                           const char * model_name)
 {
-    const double error_threshold = 0.1;
-    const double percentage_threshold = 0.5;
-    bool is_add = builder_.isAddTree(model_, string(feature_label_file),
+    bool is_add = !builder_.canUpdateTree() ||
+                  builder_.isAddTree(model_, string(feature_label_file),
                                      error_threshold, percentage_threshold);
     if (is_add) {
         builder_.addTree(model_, feature_label_file, model_name, false);
@@ -53,61 +56,69 @@ void OnlineRFMap::relocalizeCamera(const char* feature_location_file_name,
                                  const char* test_parameter_file,
                                  double* pan_tilt_zoom)
 {
-    //@todo the same code as in RFMap
-    int max_check = 4;
-    double distance_threshold = 0.2;
     Eigen::Vector2f pp(1280/2.0, 720/2.0);
-    ptz_pose_opt::PTZPreemptiveRANSACParameter ransac_param;
-    ransac_param.reprojection_error_threshold_ = 2.0;
-    ransac_param.sample_number_ = 32;
-    
     vector<btdtr_ptz_util::PTZSample> samples;
     btdtr_ptz_util::generatePTZSampleWithFeature(feature_location_file_name,
                                                  pp, samples);
     printf("feature number is %lu\n", samples.size());
     
-    vector<Eigen::Vector2d> image_points;
-    vector<vector<Eigen::Vector2d> > candidate_pan_tilt;
-    Eigen::Vector3d estimated_ptz(pan_tilt_zoom[0], pan_tilt_zoom[1], pan_tilt_zoom[2]);
-    // predict from observation (descriptors)
-    double tt = clock();
-    for (int j = 0; j<samples.size(); j++) {
-        btdtr_ptz_util::PTZSample s = samples[j];
-        Eigen::VectorXf feat = s.descriptor_;
-        vector<Eigen::VectorXf> cur_predictions;
-        vector<float> cur_dists;
-        model_.predict(feat, max_check, cur_predictions, cur_dists);
-        assert(cur_predictions.size() == cur_dists.size());
-        
-        //cout<<"minimum feature distance "<<cur_dists[0]<<endl;
-        if (cur_dists[0] < distance_threshold) {
-            image_points.push_back(Eigen::Vector2d(s.loc_.x(), s.loc_.y()));
-            vector<Eigen::Vector2d> cur_candidate;
-            for (int k = 0; k<cur_predictions.size(); k++) {
-                assert(cur_predictions[k].size() == 2);
-                if (cur_dists[k] < distance_threshold) {
-                    cur_candidate.push_back(Eigen::Vector2d(cur_predictions[k][0], cur_predictions[k][1]));
-                }
-            }
-            //printf("min feature distance is %lf\n", cur_dists[0]);
-            candidate_pan_tilt.push_back(cur_candidate);
-        }
+    RFMap::relocalizeCamera(model_, samples, pp, pan_tilt_zoom, num_threads_);
+}
+
+void OnlineRFMap::setNumThreads(const int num_threads)
+{
+    num_threads_ = std::max(num_threads, 1);
+}
+
+bool OnlineRFMap::setTreeParameter(const char * model_parameter_file)
+{
+    btdtr_ptz_util::PTZTreeParameter tree_param;
+    bool is_read = tree_param.readFromFile(model_parameter_file);
+    builder_.setTreeParameter(tree_param);
+    return is_read;
+}
+
+bool OnlineRFMap::isAddTree(const vector<btdtr_ptz_util::PTZTrainingSample> & samples)
+{
+    if (model_.treeNum() == 0 || !builder_.canUpdateTree()) {
+        return true;
     }
-    printf("candidate point number %lu\n", candidate_pan_tilt.size());
-    // estimate camera pose
-    bool is_opt = ptz_pose_opt::preemptiveRANSACOneToMany(image_points, candidate_pan_tilt,
-                                                          pp.cast<double>(),
-                                                          ransac_param, estimated_ptz, false);
-    printf("Prediction and camera pose estimation cost time: %f seconds.\n", (clock() - tt)/CLOCKS_PER_SEC);
-    if (!is_opt) {
-        printf("-------------------------------------------- Optimize PTZ failed.\n");
-        printf("valid feature number is %lu\n\n", image_points.size());
+    return builder_.isAddTree(model_, samples, error_threshold, percentage_threshold);
+}
+
+bool OnlineRFMap::addKeyframe(const double* keypoints,
+                              const float* descriptors,
+                              const int n,
+                              const int dim,
+                              const double* pan_tilt_zoom)
+{
+    const btdtr_ptz_util::PTZTreeParameter & tree_param = builder_.getTreeParameter();
+    const Eigen::Vector2f pp(tree_param.pp_x_, tree_param.pp_y_);
+    const Eigen::Vector3f ptz(pan_tilt_zoom[0], pan_tilt_zoom[1], pan_tilt_zoom[2]);
+    vector<btdtr_ptz_util::PTZTrainingSample> samples;
+    btdtr_ptz_util::generatePTZSampleWithFeature(keypoints, descriptors, n, dim, pp, ptz, samples);
+    
+    bool is_add = this->isAddTree(samples);
+    if (is_add) {
+        builder_.addTree(model_, samples, NULL, false);
     }
     else {
-        pan_tilt_zoom[0] = estimated_ptz[0];
-        pan_tilt_zoom[1] = estimated_ptz[1];
-        pan_tilt_zoom[2] = estimated_ptz[2];
+        builder_.updateTree(model_, samples, NULL, false);
     }
+    return is_add;
+}
+
+bool OnlineRFMap::relocalizeCamera(const double* keypoints,
+                                   const float* descriptors,
+                                   const int n,
+                                   const int dim,
+                                   double* pan_tilt_zoom)
+{
+    const btdtr_ptz_util::PTZTreeParameter & tree_param = builder_.getTreeParameter();
+    const Eigen::Vector2f pp(tree_param.pp_x_, tree_param.pp_y_);
+    vector<btdtr_ptz_util::PTZSample> samples;
+    btdtr_ptz_util::generatePTZSampleWithFeature(keypoints, descriptors, n, dim, samples);
+    return RFMap::relocalizeCamera(model_, samples, pp, pan_tilt_zoom, num_threads_);
 }
 
 
@@ -150,3 +161,45 @@ EXPORTIT void relocalizeCameraOnline(OnlineRFMap* ol_rf_map,
     assert(ol_rf_map != nullptr);
     ol_rf_map->relocalizeCamera(feature_location_file_name, test_parameter_file, pan_tilt_zoom);
 }
+
+EXPORTIT void setOnlineNumThreads(OnlineRFMap* ol_rf_map,
+                                  const int num_threads)
+{
+    assert(ol_rf_map != nullptr);
+    ol_rf_map->setNumThreads(num_threads);
+}
+
+EXPORTIT bool setOnlineTreeParameter(OnlineRFMap* ol_rf_map,
+                                     const char * model_parameter_file)
+{
+    assert(ol_rf_map != nullptr);
+    return ol_rf_map->setTreeParameter(model_parameter_file);
+}
+
+EXPORTIT bool addOnlineKeyframe(OnlineRFMap* ol_rf_map,
+                                const double* keypoints,
+                                const float* descriptors,
+                                const int n,
+                                const int dim,
+                                const double* pan_tilt_zoom)
+{
+    assert(ol_rf_map != nullptr);
+    return ol_rf_map->addKeyframe(keypoints, descriptors, n, dim, pan_tilt_zoom);
+}
+
+EXPORTIT bool relocalizeCameraOnlineArray(OnlineRFMap* ol_rf_map,
+                                          const double* keypoints,
+                                          const float* descriptors,
+                                          const int n,
+                                          const int dim,
+                                          double* pan_tilt_zoom)
+{
+    assert(ol_rf_map != nullptr);
+    return ol_rf_map->relocalizeCamera(keypoints, descriptors, n, dim, pan_tilt_zoom);
+}
+
+EXPORTIT int onlineTreeNum(OnlineRFMap* ol_rf_map)
+{
+    assert(ol_rf_map != nullptr);
+    return ol_rf_map->model_.treeNum();
+}
@@ -22,6 +22,10 @@ class OnlineRFMap {
 public:
     OnlineRFMapBuilder builder_;
     BTDTRegressor model_;
+    
+private:
+    int num_threads_;   // threads used to predict features
+    
 public:
     OnlineRFMap();
     ~OnlineRFMap();
@@ -42,7 +46,36 @@ public:
     // pan_tilt_zoom: input output
     void relocalizeCamera(const char* feature_location_file_name,
                           const char* test_parameter_file,
-                          double* pan_tilt_zoom);    
+                          double* pan_tilt_zoom);
+    
+    // num_threads: 1 (default) runs in the calling thread
+    void setNumThreads(const int num_threads);
+    
+    // in-memory interface, no file is read or written
+    // model_parameter_file: read once before adding keyframes
+    bool setTreeParameter(const char * model_parameter_file);
+    
+    // insert a keyframe to the map, only one tree is added or updated
+    // keypoints: n x 2, row major
+    // descriptors: n x dim, row major
+    // pan_tilt_zoom: pan, tilt and focal length of the keyframe
+    // return true if a new tree is added
+    bool addKeyframe(const double* keypoints,
+                     const float* descriptors,
+                     const int n,
+                     const int dim,
+                     const double* pan_tilt_zoom);
+    
+    // pan_tilt_zoom: input output
+    bool relocalizeCamera(const double* keypoints,
+                          const float* descriptors,
+                          const int n,
+                          const int dim,
+                          double* pan_tilt_zoom);
+    
+private:
+    // add a tree or update a tree by the prediction error of new samples
+    bool isAddTree(const vector<btdtr_ptz_util::PTZTrainingSample> & samples);
 };
 
 extern "C" {
@@ -63,6 +96,29 @@ extern "C" {
                                    const char* feature_location_file_name,
                                    const char* test_parameter_file,
                                    double* pan_tilt_zoom);
+    
+    EXPORTIT void setOnlineNumThreads(OnlineRFMap* ol_rf_map,
+                                      const int num_threads);
+    
+    // in-memory interface
+    EXPORTIT bool setOnlineTreeParameter(OnlineRFMap* ol_rf_map,
+                                         const char * model_parameter_file);
+    
+    EXPORTIT bool addOnlineKeyframe(OnlineRFMap* ol_rf_map,
+                                    const double* keypoints,
+                                    const float* descriptors,
+                                    const int n,
+                                    const int dim,
+                                    const double* pan_tilt_zoom);
+    
+    EXPORTIT bool relocalizeCameraOnlineArray(OnlineRFMap* ol_rf_map,
+                                              const double* keypoints,
+                                              const float* descriptors,
+                                              const int n,
+                                              const int dim,
+                                              double* pan_tilt_zoom);
+    
+    EXPORTIT int onlineTreeNum(OnlineRFMap* ol_rf_map);
 }
 
 #endif /* online_rf_map_hpp */
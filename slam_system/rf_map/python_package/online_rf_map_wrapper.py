@@ -1,30 +1,29 @@
 # online random forest as map
 import numpy as np
-from ctypes import cdll
-from ctypes import c_int
 from ctypes import c_void_p
-from ctypes import c_char_p
-from ctypes import Structure
-from ctypes import POINTER
 import platform
+import time
 
-system = platform.system()
+try:
+    from .rf_map_lib import get_lib
+except ImportError:
+    # run as a script in this folder
+    from rf_map_lib import get_lib
 
-#@todo hardcode library
-if system == "Windows":
-    lib = cdll.LoadLibrary('C:/graduate_design/Pan-tilt-zoom-SLAM/slam_system/rf_map/build/x64/Debug/rf_map_python.dll')
-else:
-    lib = cdll.LoadLibrary('/Users/jimmy/Code/ptz_slam/Pan-tilt-zoom-SLAM/slam_system/rf_map/build/librf_map_python.dylib')
+system = platform.system()
 
 
 class OnlineRFMap:
     def __init__(self, rf_file):
         self.rf_file = rf_file
 
-        lib.OnlineRFMap_new.restype = c_void_p
-        self.rf_map = lib.OnlineRFMap_new()
+        self.rf_map = get_lib().OnlineRFMap_new()
         #print('rf_map value 1 {}'.format(self.rf_map))
 
+        # wall time (seconds) of each add_keyframe and whether a new tree was added
+        self.update_time = []
+        self.update_add_tree = []
+
     def create_map(self, feature_label_file, tree_param_file):
         """
         :param feature_label_file: a .mat file has 'keypoint', 'descriptor' and 'ptz'
@@ -35,11 +34,10 @@ class OnlineRFMap:
         fl_file = feature_label_file.encode('utf-8')
         tr_file = tree_param_file.encode('utf-8')
         rf_file = self.rf_file.encode('utf-8')
-        lib.createOnlineMap.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
 
         # print('rf_map point in python {}'.format(self.rf_map))
         #print('rf_map value 2 {}'.format(self.rf_map))
-        lib.createOnlineMap(self.rf_map, fl_file, tr_file, rf_file)
+        get_lib().createOnlineMap(self.rf_map, fl_file, tr_file, rf_file)
 
     def update_map(self, feature_label_file):
         """
@@ -51,8 +49,7 @@ class OnlineRFMap:
         fl_file = feature_label_file.encode('utf-8')
         rf_file = self.rf_file.encode('utf-8')
 
-        lib.updateOnlineMap.argtypes = [c_void_p, c_char_p, c_char_p]
-        lib.updateOnlineMap(self.rf_map, fl_file, rf_file)
+        get_lib().updateOnlineMap(self.rf_map, fl_file, rf_file)
 
 
     def relocalization(self, feature_location_file, init_pan_tilt_zoom):
@@ -67,15 +64,75 @@ class OnlineRFMap:
         for i in range(3):
             pan_tilt_zoom[i] = init_pan_tilt_zoom[i]
 
-        lib.relocalizeCameraOnline.argtypes = [c_void_p, c_char_p, c_char_p, c_void_p]
-
         #print('rf_map value 4 {}'.format(self.rf_map))
-        lib.relocalizeCameraOnline(self.rf_map,
-                                feature_location_file,
-                                test_parameter_file,
-                                c_void_p(pan_tilt_zoom.ctypes.data))
+        get_lib().relocalizeCameraOnline(self.rf_map,
+                                      feature_location_file,
+                                      test_parameter_file,
+                                      c_void_p(pan_tilt_zoom.ctypes.data))
+        return pan_tilt_zoom
+
+    def set_num_threads(self, num_threads):
+        """
+        threads used to predict features, 1 (default) runs in the calling thread
+        :param num_threads: number of threads
+        """
+        get_lib().setOnlineNumThreads(self.rf_map, int(num_threads))
+
+    def set_tree_parameter(self, tree_param_file):
+        """
+        read the tree parameter, call once before add_keyframe
+        :param tree_param_file:
+        :return: True if the file is read
+        """
+        return get_lib().setOnlineTreeParameter(self.rf_map, tree_param_file.encode('utf-8'))
+
+    def add_keyframe(self, keypoints, descriptors, ptz):
+        """
+        insert a keyframe to the in-memory map. Only one tree is added or updated,
+        previous keyframes are not trained again. No file is written.
+        :param keypoints: [N, 2] keypoint locations
+        :param descriptors: [N, D] descriptors
+        :param ptz: [3], pan, tilt and focal length of the keyframe
+        :return: True if a new tree is added, False if a tree is updated
+        """
+        keypoints = np.ascontiguousarray(keypoints, dtype=np.float64).reshape(-1, 2)
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        ptz = np.ascontiguousarray(ptz, dtype=np.float64).ravel()
+        assert keypoints.shape[0] == descriptors.shape[0] and ptz.shape[0] == 3
+
+        start = time.time()
+        is_add = get_lib().addOnlineKeyframe(self.rf_map,
+                                             c_void_p(keypoints.ctypes.data),
+                                             c_void_p(descriptors.ctypes.data),
+                                             keypoints.shape[0], descriptors.shape[1],
+                                             c_void_p(ptz.ctypes.data))
+        self.update_time.append(time.time() - start)
+        self.update_add_tree.append(is_add)
+        return is_add
+
+    def relocalize(self, keypoints, descriptors, init_pan_tilt_zoom):
+        """
+        relocalize a camera by the in-memory model
+        :param keypoints: [N, 2] keypoint locations
+        :param descriptors: [N, D] descriptors
+        :param init_pan_tilt_zoom: 3 x 1, initial camera parameter
+        :return: 3 x 1 camera parameter, the initial one if relocalization fails
+        """
+        keypoints = np.ascontiguousarray(keypoints, dtype=np.float64).reshape(-1, 2)
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        assert keypoints.shape[0] == descriptors.shape[0]
+        pan_tilt_zoom = np.array(init_pan_tilt_zoom, dtype=np.float64).reshape(3, 1)
+
+        get_lib().relocalizeCameraOnlineArray(self.rf_map,
+                                              c_void_p(keypoints.ctypes.data),
+                                              c_void_p(descriptors.ctypes.data),
+                                              keypoints.shape[0], descriptors.shape[1],
+                                              c_void_p(pan_tilt_zoom.ctypes.data))
         return pan_tilt_zoom
 
+    def tree_num(self):
+        return get_lib().onlineTreeNum(self.rf_map)
+
 def ut_create_update_map():
     rf_map = OnlineRFMap('debug.txt')
 
@@ -107,6 +164,30 @@ def ut_create_update_map():
     estimated_ptz = rf_map.relocalization(feature_location_file, init_ptz)
     print('estimated ptz is {}'.format(estimated_ptz))
 
+def ut_add_keyframe_timing():
+    """
+    insert keyframes one by one from arrays, the time of each update should not grow with the map size
+    """
+    import scipy.io as sio
+
+    if system == "Windows":
+        tree_param_file = 'C:/graduate_design/random_forest/two_point_method_world_cup_dataset/ptz_tree_param.txt'
+        feature_label_files = 'C:/graduate_design/random_forest/two_point_method_world_cup_dataset/train_feature_file.txt'
+    else:
+        tree_param_file = '/Users/jimmy/Code/ptz_slam/dataset/two_point_method_world_cup_dataset/ptz_tree_param.txt'
+        feature_label_files = '/Users/jimmy/Code/ptz_slam/dataset/two_point_method_world_cup_dataset/train_feature_file.txt'
+
+    with open(feature_label_files, 'r') as f:
+        feature_label_files = f.read().splitlines()
+
+    rf_map = OnlineRFMap('debug.txt')
+    rf_map.set_tree_parameter(tree_param_file)
+    for i, file_name in enumerate(feature_label_files):
+        data = sio.loadmat(file_name)
+        is_add = rf_map.add_keyframe(data['keypoint'], data['descriptor'], data['ptz'])
+        print('keyframe %d, %s a tree, %.3f seconds' % (i, 'add' if is_add else 'update', rf_map.update_time[-1]))
+    print('tree number %d' % rf_map.tree_num())
+
 
 if __name__ == '__main__':
     ut_create_update_map()
@@ -9,16 +9,18 @@
 #include <string>
 #include <vector>
 #include <fstream>
+#include <chrono>
 #include "rf_map.hpp"
 #include "rf_map_builder.hpp"
 #include "btdtr_ptz_util.h"
 #include "ptz_pose_estimation.h"
+#include "dt_util.hpp"
 
 using namespace std;
 
 RFMap::RFMap()
 {
-    
+    num_threads_ = 1;
 }
 
 RFMap::~RFMap()
@@ -45,6 +47,7 @@ void RFMap::createMap(const char * feature_label_file,
     
     RFMapBuilder builder;
     builder.setTreeParameter(tree_param);
+    builder.setNumThreads(num_threads_);
     
     //printf("start build model\n");
     
@@ -60,34 +63,76 @@ void RFMap::relocalizeCamera(const char* feature_location_file_name,
                             const char* test_parameter_file,
                             double* pan_tilt_zoom)
 {
-    int max_check = 4;
-    double distance_threshold = 0.2;
     Eigen::Vector2f pp(1280/2.0, 720/2.0);
-    ptz_pose_opt::PTZPreemptiveRANSACParameter ransac_param;
-    ransac_param.reprojection_error_threshold_ = 2.0;
-    ransac_param.sample_number_ = 32;
-    
     vector<btdtr_ptz_util::PTZSample> samples;
     btdtr_ptz_util::generatePTZSampleWithFeature(feature_location_file_name,
                                                  pp, samples);
     printf("feature number is %lu\n", samples.size());
     
+    RFMap::relocalizeCamera(model_, samples, pp, pan_tilt_zoom, num_threads_);
+}
+
+bool RFMap::loadMap(const char * model_name)
+{
+    if (BTDTRegressor::isBinaryModel(model_name)) {
+        return model_.loadBinaryModel(model_name);
+    }
+    return model_.load(model_name);
+}
+
+bool RFMap::saveBinaryMap(const char * model_name) const
+{
+    if (model_.treeNum() == 0) {
+        printf("Warning: the map is empty\n");
+        return false;
+    }
+    return model_.saveBinaryModel(model_name);
+}
+
+bool RFMap::convertMap(const char * text_model_name,
+                       const char * binary_model_name)
+{
+    BTDTRegressor model;
+    if (!model.load(text_model_name)) {
+        return false;
+    }
+    return model.saveBinaryModel(binary_model_name);
+}
+
+// relocalization parameters
+static const int max_check = 4;
+static const double distance_threshold = 0.2;
+
+static ptz_pose_opt::PTZPreemptiveRANSACParameter ransacParameter()
+{
+    ptz_pose_opt::PTZPreemptiveRANSACParameter ransac_param;
+    ransac_param.reprojection_error_threshold_ = 2.0;
+    ransac_param.sample_number_ = 32;
+    return ransac_param;
+}
+
+bool RFMap::estimateCamera(const vector<Eigen::Vector2f> & locations,
+                           const vector<vector<Eigen::VectorXf> > & predictions,
+                           const vector<vector<float> > & dists,
+                           const int start,
+                           const int end,
+                           const Eigen::Vector2f & pp,
+                           Eigen::Vector3d & ptz,
+                           int & inlier_num,
+                           std::mt19937 & rng)
+{
+    const ptz_pose_opt::PTZPreemptiveRANSACParameter ransac_param = ransacParameter();
+    
+    // features that are close to leaf nodes in feature space
     vector<Eigen::Vector2d> image_points;
     vector<vector<Eigen::Vector2d> > candidate_pan_tilt;
-    Eigen::Vector3d estimated_ptz(pan_tilt_zoom[0], pan_tilt_zoom[1], pan_tilt_zoom[2]);
-    // predict from observation (descriptors)
-    double tt = clock();
-    for (int j = 0; j<samples.size(); j++) {
-        btdtr_ptz_util::PTZSample s = samples[j];
-        Eigen::VectorXf feat = s.descriptor_;
-        vector<Eigen::VectorXf> cur_predictions;
-        vector<float> cur_dists;
-        model_.predict(feat, max_check, cur_predictions, cur_dists);
+    for (int j = start; j<end; j++) {
+        const vector<Eigen::VectorXf> & cur_predictions = predictions[j];
+        const vector<float> & cur_dists = dists[j];
         assert(cur_predictions.size() == cur_dists.size());
         
-        //cout<<"minimum feature distance "<<cur_dists[0]<<endl;
-        if (cur_dists[0] < distance_threshold) {
-            image_points.push_back(Eigen::Vector2d(s.loc_.x(), s.loc_.y()));
+        if (cur_dists.size() > 0 && cur_dists[0] < distance_threshold) {
+            image_points.push_back(Eigen::Vector2d(locations[j].x(), locations[j].y()));
             vector<Eigen::Vector2d> cur_candidate;
             for (int k = 0; k<cur_predictions.size(); k++) {
                 assert(cur_predictions[k].size() == 2);
@@ -95,25 +140,105 @@ void RFMap::relocalizeCamera(const char* feature_location_file_name,
                     cur_candidate.push_back(Eigen::Vector2d(cur_predictions[k][0], cur_predictions[k][1]));
                 }
             }
-            //printf("min feature distance is %lf\n", cur_dists[0]);
             candidate_pan_tilt.push_back(cur_candidate);
         }
     }
-    printf("candidate point number %lu\n", candidate_pan_tilt.size());
+    
     // estimate camera pose
+    inlier_num = 0;
     bool is_opt = ptz_pose_opt::preemptiveRANSACOneToMany(image_points, candidate_pan_tilt,
                                                           pp.cast<double>(),
-                                                          ransac_param, estimated_ptz, false);
-    printf("Prediction and camera pose estimation cost time: %f seconds.\n", (clock() - tt)/CLOCKS_PER_SEC);
+                                                          ransac_param, ptz, rng, false);
+    if (is_opt) {
+        inlier_num = ptz_pose_opt::countInliers(image_points, candidate_pan_tilt,
+                                                pp.cast<double>(), ransac_param, ptz);
+    }
+    return is_opt;
+}
+
+bool RFMap::relocalizeCamera(const BTDTRegressor & model,
+                             const vector<btdtr_ptz_util::PTZSample> & samples,
+                             const Eigen::Vector2f & pp,
+                             double* pan_tilt_zoom,
+                             const int num_threads)
+{
+    vector<Eigen::Vector2f> locations;
+    vector<Eigen::VectorXf> features;
+    for (const auto& s: samples) {
+        locations.push_back(s.loc_);
+        features.push_back(s.descriptor_);
+    }
+    
+    // predict from observation (descriptors)
+    auto tt = std::chrono::steady_clock::now();
+    vector<vector<Eigen::VectorXf> > predictions;
+    vector<vector<float> > dists;
+    model.predict(features, max_check, predictions, dists, num_threads);
+    
+    Eigen::Vector3d estimated_ptz(pan_tilt_zoom[0], pan_tilt_zoom[1], pan_tilt_zoom[2]);
+    int inlier_num = 0;
+    std::mt19937 rng(rand());
+    bool is_opt = RFMap::estimateCamera(locations, predictions, dists, 0, (int)samples.size(),
+                                        pp, estimated_ptz, inlier_num, rng);
+    printf("Prediction and camera pose estimation cost time: %f seconds.\n",
+           std::chrono::duration<double>(std::chrono::steady_clock::now() - tt).count());
     if (!is_opt) {
         printf("-------------------------------------------- Optimize PTZ failed.\n");
-        printf("valid feature number is %lu\n\n", image_points.size());
     }
     else {
+        printf("inlier number %d\n", inlier_num);
         pan_tilt_zoom[0] = estimated_ptz[0];
         pan_tilt_zoom[1] = estimated_ptz[1];
         pan_tilt_zoom[2] = estimated_ptz[2];
     }
+    return is_opt;
+}
+
+void RFMap::relocalizeCameraBatch(const double* keypoints,
+                                  const float* descriptors,
+                                  const int* feature_num,
+                                  const int frame_num,
+                                  const int dim,
+                                  double* pan_tilt_zoom,
+                                  int* inlier_num,
+                                  const int num_threads) const
+{
+    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    
+    // features of all frames are predicted together
+    vector<int> frame_start(frame_num + 1, 0);
+    for (int i = 0; i<frame_num; i++) {
+        frame_start[i + 1] = frame_start[i] + feature_num[i];
+    }
+    vector<btdtr_ptz_util::PTZSample> samples;
+    btdtr_ptz_util::generatePTZSampleWithFeature(keypoints, descriptors, frame_start[frame_num], dim, samples);
+    
+    vector<Eigen::Vector2f> locations;
+    vector<Eigen::VectorXf> features;
+    for (const auto& s: samples) {
+        locations.push_back(s.loc_);
+        features.push_back(s.descriptor_);
+    }
+    
+    vector<vector<Eigen::VectorXf> > predictions;
+    vector<vector<float> > dists;
+    model_.predict(features, max_check, predictions, dists, num_threads);
+    
+    // frames are independent, each frame has its own random number generator so that
+    // the result does not depend on thread scheduling
+    const unsigned int seed = rand();
+    DTUtil::parallelFor(frame_num, num_threads, [&](int i) {
+        std::seed_seq frame_seed{seed, (unsigned int)i};
+        std::mt19937 rng(frame_seed);
+        Eigen::Vector3d ptz(pan_tilt_zoom[3 * i], pan_tilt_zoom[3 * i + 1], pan_tilt_zoom[3 * i + 2]);
+        bool is_opt = RFMap::estimateCamera(locations, predictions, dists, frame_start[i], frame_start[i + 1],
+                                            pp, ptz, inlier_num[i], rng);
+        if (is_opt) {
+            pan_tilt_zoom[3 * i] = ptz[0];
+            pan_tilt_zoom[3 * i + 1] = ptz[1];
+            pan_tilt_zoom[3 * i + 2] = ptz[2];
+        }
+    });
 }
 
 void RFMap::estimateCameraRANSAC(const char* pixel_ray_file_name,
@@ -155,6 +280,104 @@ void RFMap::estimateCameraRANSAC(const char* pixel_ray_file_name,
     }
 }
 
+void RFMap::estimateCameraRANSACBatch(const double* keypoints,
+                                      const double* rays,
+                                      const int* point_num,
+                                      const int frame_num,
+                                      double* pan_tilt_zoom,
+                                      int* inlier_num,
+                                      const int num_threads)
+{
+    const Eigen::Vector2d pp(1280/2.0, 720/2.0);
+    const ptz_pose_opt::PTZPreemptiveRANSACParameter ransac_param = ransacParameter();
+    
+    vector<int> frame_start(frame_num + 1, 0);
+    for (int i = 0; i<frame_num; i++) {
+        frame_start[i + 1] = frame_start[i] + point_num[i];
+    }
+    
+    // one random number generator for each frame, see relocalizeCamera
+    const unsigned int seed = rand();
+    DTUtil::parallelFor(frame_num, num_threads, [&](int i) {
+        std::seed_seq frame_seed{seed, (unsigned int)i};
+        std::mt19937 rng(frame_seed);
+        vector<Eigen::Vector2d> image_points;
+        vector<vector<Eigen::Vector2d> > candidate_pan_tilt;
+        for (int j = frame_start[i]; j<frame_start[i + 1]; j++) {
+            image_points.push_back(Eigen::Vector2d(keypoints[2 * j], keypoints[2 * j + 1]));
+            candidate_pan_tilt.push_back(vector<Eigen::Vector2d>(1, Eigen::Vector2d(rays[2 * j], rays[2 * j + 1])));
+        }
+        
+        Eigen::Vector3d ptz(pan_tilt_zoom[3 * i], pan_tilt_zoom[3 * i + 1], pan_tilt_zoom[3 * i + 2]);
+        inlier_num[i] = 0;
+        bool is_opt = ptz_pose_opt::preemptiveRANSACOneToMany(image_points, candidate_pan_tilt, pp,
+                                                              ransac_param, ptz, rng, false);
+        if (is_opt) {
+            inlier_num[i] = ptz_pose_opt::countInliers(image_points, candidate_pan_tilt, pp, ransac_param, ptz);
+            pan_tilt_zoom[3 * i] = ptz[0];
+            pan_tilt_zoom[3 * i + 1] = ptz[1];
+            pan_tilt_zoom[3 * i + 2] = ptz[2];
+        }
+    });
+}
+
+void RFMap::setNumThreads(const int num_threads)
+{
+    num_threads_ = std::max(num_threads, 1);
+}
+
+bool RFMap::setTreeParameter(const char * model_parameter_file)
+{
+    return tree_param_.readFromFile(model_parameter_file);
+}
+
+void RFMap::addKeyframe(const double* keypoints,
+                        const float* descriptors,
+                        const int n,
+                        const int dim,
+                        const double* pan_tilt_zoom)
+{
+    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    const Eigen::Vector3f ptz(pan_tilt_zoom[0], pan_tilt_zoom[1], pan_tilt_zoom[2]);
+    vector<btdtr_ptz_util::PTZTrainingSample> samples;
+    btdtr_ptz_util::generatePTZSampleWithFeature(keypoints, descriptors, n, dim, pp, ptz, samples);
+    keyframe_samples_.push_back(samples);
+}
+
+void RFMap::clearKeyframes()
+{
+    keyframe_samples_.clear();
+}
+
+int RFMap::keyframeNum() const
+{
+    return (int)keyframe_samples_.size();
+}
+
+bool RFMap::buildMap()
+{
+    if (keyframe_samples_.size() == 0) {
+        printf("Warning: no keyframe in the map\n");
+        return false;
+    }
+    RFMapBuilder builder;
+    builder.setTreeParameter(tree_param_);
+    builder.setNumThreads(num_threads_);
+    return builder.buildModel(model_, keyframe_samples_, NULL, false);
+}
+
+bool RFMap::relocalizeCamera(const double* keypoints,
+                             const float* descriptors,
+                             const int n,
+                             const int dim,
+                             double* pan_tilt_zoom)
+{
+    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    vector<btdtr_ptz_util::PTZSample> samples;
+    btdtr_ptz_util::generatePTZSampleWithFeature(keypoints, descriptors, n, dim, samples);
+    return RFMap::relocalizeCamera(model_, samples, pp, pan_tilt_zoom, num_threads_);
+}
+
 /******************-----------C inter face--------------******************/
 EXPORTIT RFMap* RFMap_new()
 {
@@ -195,3 +418,97 @@ EXPORTIT void estimateCameraRANSAC(const char* pixel_ray_file_name,
 {
     RFMap::estimateCameraRANSAC(pixel_ray_file_name, pan_tilt_zoom);
 }
+
+EXPORTIT bool loadMap(RFMap* rf_map,
+                      const char * model_name)
+{
+    assert(rf_map != nullptr);
+    return rf_map->loadMap(model_name);
+}
+
+EXPORTIT bool saveBinaryMap(RFMap* rf_map,
+                            const char * model_name)
+{
+    assert(rf_map != nullptr);
+    return rf_map->saveBinaryMap(model_name);
+}
+
+EXPORTIT bool convertMap(const char * text_model_name,
+                         const char * binary_model_name)
+{
+    return RFMap::convertMap(text_model_name, binary_model_name);
+}
+
+EXPORTIT void setNumThreads(RFMap* rf_map,
+                            const int num_threads)
+{
+    assert(rf_map != nullptr);
+    rf_map->setNumThreads(num_threads);
+}
+
+EXPORTIT bool setTreeParameter(RFMap* rf_map,
+                               const char * model_parameter_file)
+{
+    assert(rf_map != nullptr);
+    return rf_map->setTreeParameter(model_parameter_file);
+}
+
+EXPORTIT void addKeyframe(RFMap* rf_map,
+                          const double* keypoints,
+                          const float* descriptors,
+                          const int n,
+                          const int dim,
+                          const double* pan_tilt_zoom)
+{
+    assert(rf_map != nullptr);
+    rf_map->addKeyframe(keypoints, descriptors, n, dim, pan_tilt_zoom);
+}
+
+EXPORTIT void clearKeyframes(RFMap* rf_map)
+{
+    assert(rf_map != nullptr);
+    rf_map->clearKeyframes();
+}
+
+EXPORTIT bool buildMap(RFMap* rf_map)
+{
+    assert(rf_map != nullptr);
+    return rf_map->buildMap();
+}
+
+EXPORTIT bool relocalizeCameraArray(RFMap* rf_map,
+                                    const double* keypoints,
+                                    const float* descriptors,
+                                    const int n,
+                                    const int dim,
+                                    double* pan_tilt_zoom)
+{
+    assert(rf_map != nullptr);
+    return rf_map->relocalizeCamera(keypoints, descriptors, n, dim, pan_tilt_zoom);
+}
+
+EXPORTIT void relocalizeCameraBatch(RFMap* rf_map,
+                                    const double* keypoints,
+                                    const float* descriptors,
+                                    const int* feature_num,
+                                    const int frame_num,
+                                    const int dim,
+                                    double* pan_tilt_zoom,
+                                    int* inlier_num,
+                                    const int num_threads)
+{
+    assert(rf_map != nullptr);
+    rf_map->relocalizeCameraBatch(keypoints, descriptors, feature_num, frame_num, dim,
+                                  pan_tilt_zoom, inlier_num, num_threads);
+}
+
+EXPORTIT void estimateCameraRANSACBatch(const double* keypoints,
+                                        const double* rays,
+                                        const int* point_num,
+                                        const int frame_num,
+                                        double* pan_tilt_zoom,
+                                        int* inlier_num,
+                                        const int num_threads)
+{
+    RFMap::estimateCameraRANSACBatch(keypoints, rays, point_num, frame_num, pan_tilt_zoom, inlier_num, num_threads);
+}
@@ -10,7 +10,10 @@
 #define rf_map_hpp
 
 #include <stdio.h>
+#include <vector>
+#include <random>
 #include "bt_dt_regressor.h"
+#include "btdtr_ptz_util.h"
 
 #ifdef _WIN32
 #define EXPORTIT __declspec( dllexport )
@@ -22,6 +25,13 @@ class RFMap {
 public:
     BTDTRegressor model_;
     
+private:
+    // used by the in-memory interface
+    btdtr_ptz_util::PTZTreeParameter tree_param_;
+    vector<vector<btdtr_ptz_util::PTZTrainingSample> > keyframe_samples_;
+    
+    int num_threads_;   // threads used to build the model and predict features
+    
 public:
     RFMap();
     ~RFMap();
@@ -37,10 +47,100 @@ public:
                           const char* test_parameter_file,
                           double* pan_tilt_zoom);
     
+    // load a model from a text or binary model file
+    // the binary model is memory-mapped, processes loading the same file share it
+    bool loadMap(const char * model_name);
+    
+    // save the model as a binary model file
+    bool saveBinaryMap(const char * model_name) const;
+    
+    // convert a text model file to a binary model file
+    static bool convertMap(const char * text_model_name,
+                           const char * binary_model_name);
+    
     // estimate camera pose by given pixel-ray correcpondence
     static void estimateCameraRANSAC(const char* pixel_ray_file_name,
                                     double* pan_tilt_zoom);
     
+    // num_threads: 1 (default) runs in the calling thread
+    void setNumThreads(const int num_threads);
+    
+    // in-memory interface, the model is kept in this object and no file is read or written
+    // model_parameter_file: read once
+    bool setTreeParameter(const char * model_parameter_file);
+    
+    // keypoints: n x 2, row major
+    // descriptors: n x dim, row major
+    // pan_tilt_zoom: pan, tilt and focal length of the keyframe
+    void addKeyframe(const double* keypoints,
+                     const float* descriptors,
+                     const int n,
+                     const int dim,
+                     const double* pan_tilt_zoom);
+    
+    void clearKeyframes();
+    
+    int keyframeNum() const;
+    
+    // build the model from added keyframes
+    bool buildMap();
+    
+    // pan_tilt_zoom: input output
+    // return false if the camera pose is not estimated
+    bool relocalizeCamera(const double* keypoints,
+                          const float* descriptors,
+                          const int n,
+                          const int dim,
+                          double* pan_tilt_zoom);
+    
+    // relocalize many frames, features of all frames are concatenated
+    // keypoints: N x 2, descriptors: N x dim, row major
+    // feature_num: frame_num, feature number of each frame
+    // pan_tilt_zoom: frame_num x 3, input output
+    // inlier_num: frame_num, output, 0 if the camera pose is not estimated
+    // num_threads: features and frames are processed on num_threads threads
+    void relocalizeCameraBatch(const double* keypoints,
+                               const float* descriptors,
+                               const int* feature_num,
+                               const int frame_num,
+                               const int dim,
+                               double* pan_tilt_zoom,
+                               int* inlier_num,
+                               const int num_threads) const;
+    
+    // estimate camera poses of many frames by given pixel-ray correspondences
+    // keypoints, rays: N x 2, row major, correspondences of all frames are concatenated
+    // point_num: frame_num, correspondence number of each frame
+    static void estimateCameraRANSACBatch(const double* keypoints,
+                                          const double* rays,
+                                          const int* point_num,
+                                          const int frame_num,
+                                          double* pan_tilt_zoom,
+                                          int* inlier_num,
+                                          const int num_threads);
+    
+    // predict pan, tilt of samples and estimate camera pose
+    // shared by file and in-memory interfaces
+    // num_threads: threads used in the prediction
+    static bool relocalizeCamera(const BTDTRegressor & model,
+                                 const vector<btdtr_ptz_util::PTZSample> & samples,
+                                 const Eigen::Vector2f & pp,
+                                 double* pan_tilt_zoom,
+                                 const int num_threads = 1);
+    
+private:
+    // estimate camera pose from predictions of features in [start, end)
+    // ptz: input output
+    // inlier_num: output
+    static bool estimateCamera(const vector<Eigen::Vector2f> & locations,
+                               const vector<vector<Eigen::VectorXf> > & predictions,
+                               const vector<vector<float> > & dists,
+                               const int start,
+                               const int end,
+                               const Eigen::Vector2f & pp,
+                               Eigen::Vector3d & ptz,
+                               int & inlier_num,
+                               std::mt19937 & rng);
 };
 
 
@@ -61,6 +161,58 @@ extern "C" {
     
     EXPORTIT void estimateCameraRANSAC(const char* pixel_ray_file_name,
                                        double* pan_tilt_zoom);
+    
+    EXPORTIT bool loadMap(RFMap* rf_map,
+                          const char * model_name);
+    
+    EXPORTIT bool saveBinaryMap(RFMap* rf_map,
+                                const char * model_name);
+    
+    EXPORTIT bool convertMap(const char * text_model_name,
+                             const char * binary_model_name);
+    
+    EXPORTIT void setNumThreads(RFMap* rf_map,
+                                const int num_threads);
+    
+    // in-memory interface
+    EXPORTIT bool setTreeParameter(RFMap* rf_map,
+                                   const char * model_parameter_file);
+    
+    EXPORTIT void addKeyframe(RFMap* rf_map,
+                              const double* keypoints,
+                              const float* descriptors,
+                              const int n,
+                              const int dim,
+                              const double* pan_tilt_zoom);
+    
+    EXPORTIT void clearKeyframes(RFMap* rf_map);
+    
+    EXPORTIT bool buildMap(RFMap* rf_map);
+    
+    EXPORTIT bool relocalizeCameraArray(RFMap* rf_map,
+                                        const double* keypoints,
+                                        const float* descriptors,
+                                        const int n,
+                                        const int dim,
+                                        double* pan_tilt_zoom);
+    
+    EXPORTIT void relocalizeCameraBatch(RFMap* rf_map,
+                                        const double* keypoints,
+                                        const float* descriptors,
+                                        const int* feature_num,
+                                        const int frame_num,
+                                        const int dim,
+                                        double* pan_tilt_zoom,
+                                        int* inlier_num,
+                                        const int num_threads);
+    
+    EXPORTIT void estimateCameraRANSACBatch(const double* keypoints,
+                                            const double* rays,
+                                            const int* point_num,
+                                            const int frame_num,
+                                            double* pan_tilt_zoom,
+                                            int* inlier_num,
+                                            const int num_threads);
 }
 
 
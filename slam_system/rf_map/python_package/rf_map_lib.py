@@ -0,0 +1,88 @@
+# load the random forest map library (built by rf_map/CMakeLists.txt) on first use
+import os
+import platform
+from ctypes import cdll
+from ctypes import c_int
+from ctypes import c_void_p
+from ctypes import c_char_p
+from ctypes import c_bool
+
+# environment variable of the library path, it overrides the default locations
+LIBRARY_PATH_VARIABLE = 'RF_MAP_LIB'
+
+# default locations, relative to the rf_map folder
+_build_dirs = ['build', 'build/Release', 'build/Debug', 'build/x64/Release', 'build/x64/Debug']
+_library_names = {'Windows': 'rf_map_python.dll', 'Darwin': 'librf_map_python.dylib'}
+
+# function name: (argument types, return type), void* is an object pointer or array data
+_signatures = {
+    # rf_map.hpp
+    'RFMap_new': ([], c_void_p),
+    'RFMap_delete': ([c_void_p], None),
+    'createMap': ([c_void_p, c_char_p, c_char_p, c_char_p], None),
+    'relocalizeCamera': ([c_void_p, c_char_p, c_char_p, c_void_p], None),
+    'estimateCameraRANSAC': ([c_char_p, c_void_p], None),
+    'loadMap': ([c_void_p, c_char_p], c_bool),
+    'saveBinaryMap': ([c_void_p, c_char_p], c_bool),
+    'convertMap': ([c_char_p, c_char_p], c_bool),
+    'setNumThreads': ([c_void_p, c_int], None),
+    'setTreeParameter': ([c_void_p, c_char_p], c_bool),
+    'addKeyframe': ([c_void_p, c_void_p, c_void_p, c_int, c_int, c_void_p], None),
+    'clearKeyframes': ([c_void_p], None),
+    'buildMap': ([c_void_p], c_bool),
+    'relocalizeCameraArray': ([c_void_p, c_void_p, c_void_p, c_int, c_int, c_void_p], c_bool),
+    'relocalizeCameraBatch': ([c_void_p, c_void_p, c_void_p, c_void_p, c_int, c_int, c_void_p, c_void_p, c_int],
+                              None),
+    'estimateCameraRANSACBatch': ([c_void_p, c_void_p, c_void_p, c_int, c_void_p, c_void_p, c_int], None),
+
+    # online_rf_map.hpp
+    'OnlineRFMap_new': ([], c_void_p),
+    'OnlineRFMap_delete': ([c_void_p], None),
+    'createOnlineMap': ([c_void_p, c_char_p, c_char_p, c_char_p], None),
+    'updateOnlineMap': ([c_void_p, c_char_p, c_char_p], None),
+    'relocalizeCameraOnline': ([c_void_p, c_char_p, c_char_p, c_void_p], None),
+    'setOnlineNumThreads': ([c_void_p, c_int], None),
+    'setOnlineTreeParameter': ([c_void_p, c_char_p], c_bool),
+    'addOnlineKeyframe': ([c_void_p, c_void_p, c_void_p, c_int, c_int, c_void_p], c_bool),
+    'relocalizeCameraOnlineArray': ([c_void_p, c_void_p, c_void_p, c_int, c_int, c_void_p], c_bool),
+    'onlineTreeNum': ([c_void_p], c_int),
+}
+
+_lib = None
+
+
+def library_candidates():
+    """
+    :return: library paths in search order
+    """
+    candidates = []
+    if os.environ.get(LIBRARY_PATH_VARIABLE):
+        candidates.append(os.environ[LIBRARY_PATH_VARIABLE])
+
+    rf_map_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    name = _library_names.get(platform.system(), 'librf_map_python.so')
+    for build_dir in _build_dirs:
+        candidates.append(os.path.join(rf_map_dir, build_dir, name))
+    return candidates
+
+
+def get_lib():
+    """
+    load the library and declare function signatures, only once in a process
+    :return: ctypes library
+    """
+    global _lib
+    if _lib is None:
+        candidates = library_candidates()
+        path = next((p for p in candidates if os.path.isfile(p)), None)
+        if path is None:
+            raise OSError('random forest map library is not found. Build rf_map or set {} to the library path. '
+                          'Searched: {}'.format(LIBRARY_PATH_VARIABLE, ', '.join(candidates)))
+
+        lib = cdll.LoadLibrary(path)
+        for name, (argtypes, restype) in _signatures.items():
+            function = getattr(lib, name)
+            function.argtypes = argtypes
+            function.restype = restype
+        _lib = lib
+    return _lib
@@ -1,27 +1,21 @@
 # random forest as map
 import numpy as np
-from ctypes import cdll
-from ctypes import c_int
 from ctypes import c_void_p
-from ctypes import c_char_p
-from ctypes import Structure
-from ctypes import POINTER
 import platform
 
-system = platform.system()
+try:
+    from .rf_map_lib import get_lib
+except ImportError:
+    # run as a script in this folder
+    from rf_map_lib import get_lib
 
-#@todo hardcode library
-if system == "Windows":
-    lib = cdll.LoadLibrary('C:/graduate_design/Pan-tilt-zoom-SLAM/slam_system/rf_map/build/x64/Debug/rf_map_python.dll')
-else:
-    lib = cdll.LoadLibrary('/Users/jimmy/Code/ptz_slam/Pan-tilt-zoom-SLAM/slam_system/rf_map/build/librf_map_python.dylib')
+system = platform.system()
 
 class RFMap:
     def __init__(self, rf_file):
         self.rf_file = rf_file
 
-        lib.RFMap_new.restype = c_void_p
-        self.rf_map = lib.RFMap_new()
+        self.rf_map = get_lib().RFMap_new()
         print('rf_map value 1 {}'.format(self.rf_map))
 
     def create_map(self, feature_label_files, tree_param_file):
@@ -33,11 +27,10 @@ class RFMap:
         fl_file = feature_label_files.encode('utf-8')
         tr_file = tree_param_file.encode('utf-8')
         rf_file = self.rf_file.encode('utf-8')
-        lib.createMap.argtypes = [c_void_p, c_char_p, c_char_p, c_char_p]
 
         #print('rf_map point in python {}'.format(self.rf_map))
         print('rf_map value 2 {}'.format(self.rf_map))
-        lib.createMap(self.rf_map, fl_file, tr_file, rf_file)
+        get_lib().createMap(self.rf_map, fl_file, tr_file, rf_file)
         print('rf_map value 3 {}'.format(self.rf_map))
 
     def relocalization(self, feature_location_file, init_pan_tilt_zoom):
@@ -52,15 +45,159 @@ class RFMap:
         for i in range(3):
             pan_tilt_zoom[i] = init_pan_tilt_zoom[i]
 
-        lib.relocalizeCamera.argtypes = [c_void_p, c_char_p, c_char_p, c_void_p]
-
         print('rf_map value 4 {}'.format(self.rf_map))
-        lib.relocalizeCamera(self.rf_map,
-                             feature_location_file,
-                             test_parameter_file,
-                             c_void_p(pan_tilt_zoom.ctypes.data))
+        get_lib().relocalizeCamera(self.rf_map,
+                                   feature_location_file,
+                                   test_parameter_file,
+                                   c_void_p(pan_tilt_zoom.ctypes.data))
+        return pan_tilt_zoom
+
+    def load_map(self, model_file=None):
+        """
+        load a saved model, e.g. in worker processes that share a map
+        A binary model is memory-mapped, so processes loading the same file share the memory.
+        :param model_file: text or binary model file, default self.rf_file
+        :return: True if the model is loaded
+        """
+        if model_file is None:
+            model_file = self.rf_file
+        return get_lib().loadMap(self.rf_map, model_file.encode('utf-8'))
+
+    def save_binary_map(self, model_file):
+        """
+        :param model_file: binary model file
+        :return: True if the model is saved
+        """
+        return get_lib().saveBinaryMap(self.rf_map, model_file.encode('utf-8'))
+
+    @staticmethod
+    def convert_model(text_model_file, binary_model_file):
+        """
+        convert a text model (from create_map) to a binary model
+        :param text_model_file: .txt file
+        :param binary_model_file:
+        :return: True if the model is converted
+        """
+        return get_lib().convertMap(text_model_file.encode('utf-8'), binary_model_file.encode('utf-8'))
+
+    def set_num_threads(self, num_threads):
+        """
+        threads used to build the map and predict features, 1 (default) runs in the calling thread
+        :param num_threads: number of threads
+        """
+        get_lib().setNumThreads(self.rf_map, int(num_threads))
+
+    def set_tree_parameter(self, tree_param_file):
+        """
+        read the tree parameter once, used by the in-memory interface
+        :param tree_param_file:
+        :return: True if the file is read
+        """
+        return get_lib().setTreeParameter(self.rf_map, tree_param_file.encode('utf-8'))
+
+    def add_keyframe(self, keypoints, descriptors, ptz):
+        """
+        add a keyframe to the in-memory map, the map is not rebuilt
+        :param keypoints: [N, 2] keypoint locations
+        :param descriptors: [N, D] descriptors
+        :param ptz: [3], pan, tilt and focal length of the keyframe
+        """
+        keypoints = np.ascontiguousarray(keypoints, dtype=np.float64).reshape(-1, 2)
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        ptz = np.ascontiguousarray(ptz, dtype=np.float64).ravel()
+        assert keypoints.shape[0] == descriptors.shape[0] and ptz.shape[0] == 3
+
+        get_lib().addKeyframe(self.rf_map,
+                              c_void_p(keypoints.ctypes.data),
+                              c_void_p(descriptors.ctypes.data),
+                              keypoints.shape[0], descriptors.shape[1],
+                              c_void_p(ptz.ctypes.data))
+
+    def clear_keyframes(self):
+        get_lib().clearKeyframes(self.rf_map)
+
+    def build_map(self):
+        """
+        build the model from keyframes in memory, no file is written
+        :return: True if the model is built
+        """
+        return get_lib().buildMap(self.rf_map)
+
+    def relocalize(self, keypoints, descriptors, init_pan_tilt_zoom):
+        """
+        relocalize a camera by the in-memory model
+        :param keypoints: [N, 2] keypoint locations
+        :param descriptors: [N, D] descriptors
+        :param init_pan_tilt_zoom: 3 x 1, initial camera parameter
+        :return: 3 x 1 camera parameter, the initial one if relocalization fails
+        """
+        keypoints = np.ascontiguousarray(keypoints, dtype=np.float64).reshape(-1, 2)
+        descriptors = np.ascontiguousarray(descriptors, dtype=np.float32)
+        assert keypoints.shape[0] == descriptors.shape[0]
+        pan_tilt_zoom = np.array(init_pan_tilt_zoom, dtype=np.float64).reshape(3, 1)
+
+        get_lib().relocalizeCameraArray(self.rf_map,
+                                        c_void_p(keypoints.ctypes.data),
+                                        c_void_p(descriptors.ctypes.data),
+                                        keypoints.shape[0], descriptors.shape[1],
+                                        c_void_p(pan_tilt_zoom.ctypes.data))
         return pan_tilt_zoom
 
+    def relocalize_batch(self, keypoints_list, descriptors_list, init_ptzs, num_threads=4):
+        """
+        relocalize many frames in one call, e.g. offline processing of a sequence.
+        Features of all frames are predicted on num_threads threads.
+        :param keypoints_list: list of [N_i, 2] keypoint locations
+        :param descriptors_list: list of [N_i, D] descriptors
+        :param init_ptzs: [M, 3] initial camera parameters
+        :param num_threads: number of threads
+        :return: [M, 3] camera parameters (initial one if a frame fails), [M] inlier numbers (0 if a frame fails)
+        """
+        assert len(keypoints_list) == len(descriptors_list) == len(init_ptzs)
+        feature_num = np.array([len(kp) for kp in keypoints_list], dtype=np.int32)
+        keypoints = np.ascontiguousarray(np.vstack([np.reshape(kp, (-1, 2)) for kp in keypoints_list]), dtype=np.float64)
+        descriptors = np.ascontiguousarray(np.vstack(descriptors_list), dtype=np.float32)
+        assert keypoints.shape[0] == descriptors.shape[0]
+        pan_tilt_zoom = np.array(init_ptzs, dtype=np.float64).reshape(-1, 3)
+        inlier_num = np.zeros(len(feature_num), dtype=np.int32)
+
+        get_lib().relocalizeCameraBatch(self.rf_map,
+                                        c_void_p(keypoints.ctypes.data),
+                                        c_void_p(descriptors.ctypes.data),
+                                        c_void_p(feature_num.ctypes.data),
+                                        len(feature_num), descriptors.shape[1],
+                                        c_void_p(pan_tilt_zoom.ctypes.data),
+                                        c_void_p(inlier_num.ctypes.data),
+                                        num_threads)
+        return pan_tilt_zoom, inlier_num
+
+    @staticmethod
+    def estimate_camera_ransac_batch(keypoints_list, rays_list, init_ptzs, num_threads=4):
+        """
+        estimate camera parameters of many frames from pixel-ray correspondences
+        :param keypoints_list: list of [N_i, 2] keypoint locations
+        :param rays_list: list of [N_i, 2] pan, tilt of rays
+        :param init_ptzs: [M, 3] initial camera parameters
+        :param num_threads: number of threads
+        :return: [M, 3] camera parameters, [M] inlier numbers
+        """
+        assert len(keypoints_list) == len(rays_list) == len(init_ptzs)
+        point_num = np.array([len(kp) for kp in keypoints_list], dtype=np.int32)
+        keypoints = np.ascontiguousarray(np.vstack([np.reshape(kp, (-1, 2)) for kp in keypoints_list]), dtype=np.float64)
+        rays = np.ascontiguousarray(np.vstack([np.reshape(r, (-1, 2)) for r in rays_list]), dtype=np.float64)
+        assert keypoints.shape == rays.shape
+        pan_tilt_zoom = np.array(init_ptzs, dtype=np.float64).reshape(-1, 3)
+        inlier_num = np.zeros(len(point_num), dtype=np.int32)
+
+        get_lib().estimateCameraRANSACBatch(c_void_p(keypoints.ctypes.data),
+                                            c_void_p(rays.ctypes.data),
+                                            c_void_p(point_num.ctypes.data),
+                                            len(point_num),
+                                            c_void_p(pan_tilt_zoom.ctypes.data),
+                                            c_void_p(inlier_num.ctypes.data),
+                                            num_threads)
+        return pan_tilt_zoom, inlier_num
+
     @staticmethod
     def estimateCameraRANSAC(keypoint_ray_file_name, init_pan_tilt_zoom):
         """
@@ -74,10 +211,8 @@ class RFMap:
         for i in range(3):
             pan_tilt_zoom[i] = init_pan_tilt_zoom[i]
 
-        lib.estimateCameraRANSAC.argtypes = [c_char_p, c_void_p]
-
-        lib.estimateCameraRANSAC(keypoint_ray_file_name,
-                                 c_char_p(pan_tilt_zoom.ctypes.data))
+        get_lib().estimateCameraRANSAC(keypoint_ray_file_name,
+                                       c_void_p(pan_tilt_zoom.ctypes.data))
 
         return pan_tilt_zoom
 
@@ -101,6 +236,120 @@ def ut_create_map_relocalization():
     estimated_ptz = rf_map.relocalization(feature_location_file, init_ptz)
     print('estimated ptz is {}'.format(estimated_ptz))
 
+def ut_in_memory_map():
+    """
+    build a map and relocalize from arrays, no file is written
+    """
+    import scipy.io as sio
+
+    if system == "Windows":
+        tree_param_file = 'C:/graduate_design/random_forest/two_point_method_world_cup_dataset/ptz_tree_param.txt'
+        feature_label_files = 'C:/graduate_design/random_forest/two_point_method_world_cup_dataset/train_feature_file.txt'
+    else:
+        tree_param_file = '/Users/jimmy/Code/ptz_slam/dataset/two_point_method_world_cup_dataset/ptz_tree_param.txt'
+        feature_label_files = '/Users/jimmy/Code/ptz_slam/dataset/two_point_method_world_cup_dataset/train_feature_file.txt'
+
+    with open(feature_label_files, 'r') as f:
+        feature_label_files = f.read().splitlines()
+
+    rf_map = RFMap('debug.txt')
+    rf_map.set_tree_parameter(tree_param_file)
+    for file_name in feature_label_files:
+        data = sio.loadmat(file_name)
+        rf_map.add_keyframe(data['keypoint'], data['descriptor'], data['ptz'])
+    rf_map.build_map()
+
+    data = sio.loadmat(feature_label_files[0])
+    estimated_ptz = rf_map.relocalize(data['keypoint'], data['descriptor'], data['ptz'].ravel() + [1, 1, 50])
+    print('estimated ptz is {}'.format(estimated_ptz.ravel()))
+    print('ground truth ptz is {}'.format(data['ptz'].ravel()))
+
+def ut_binary_model():
+    """
+    convert a text model to a binary model, then load both and relocalize
+    """
+    import time
+    import scipy.io as sio
+
+    if system == "Windows":
+        dataset_dir = 'C:/graduate_design/random_forest/two_point_method_world_cup_dataset/'
+    else:
+        dataset_dir = '/Users/jimmy/Code/ptz_slam/dataset/two_point_method_world_cup_dataset/'
+    model_file = dataset_dir + 'debug.txt'
+    tree_param_file = dataset_dir + 'ptz_tree_param.txt'
+    feature_location_file = dataset_dir + 'test/bra_mex/17.mat'
+    binary_model_file = model_file[:-4] + '.bin'
+    RFMap.convert_model(model_file, binary_model_file)
+
+    data = sio.loadmat(feature_location_file)
+    init_ptz = np.asarray([11, -9, 3110])
+    for file_name in [model_file, binary_model_file]:
+        rf_map = RFMap(file_name)
+        t = time.time()
+        rf_map.load_map()
+        print('load {} cost {:.3f} seconds'.format(file_name, time.time() - t))
+        rf_map.set_tree_parameter(tree_param_file)
+        estimated_ptz = rf_map.relocalize(data['keypoint'], data['descriptor'], init_ptz)
+        print('estimated ptz is {}'.format(estimated_ptz.ravel()))
+
+def ut_thread_scaling():
+    """
+    time map building and batch relocalization with 1, 4, 8 and 16 threads
+    """
+    import os
+    import time
+    import scipy.io as sio
+
+    if system == "Windows":
+        tree_param_file = 'C:/graduate_design/random_forest/two_point_method_world_cup_dataset/ptz_tree_param.txt'
+        feature_label_files = 'C:/graduate_design/random_forest/two_point_method_world_cup_dataset/train_feature_file.txt'
+    else:
+        tree_param_file = '/Users/jimmy/Code/ptz_slam/dataset/two_point_method_world_cup_dataset/ptz_tree_param.txt'
+        feature_label_files = '/Users/jimmy/Code/ptz_slam/dataset/two_point_method_world_cup_dataset/train_feature_file.txt'
+
+    with open(feature_label_files, 'r') as f:
+        feature_label_files = f.read().splitlines()
+    data = [sio.loadmat(file_name) for file_name in feature_label_files]
+
+    rf_map = RFMap('debug.txt')
+    rf_map.set_tree_parameter(tree_param_file)
+    for d in data:
+        rf_map.add_keyframe(d['keypoint'], d['descriptor'], d['ptz'])
+
+    test_data = data[::max(len(data) // 20, 1)]
+    keypoints = [d['keypoint'] for d in test_data]
+    descriptors = [d['descriptor'] for d in test_data]
+    init_ptzs = np.array([d['ptz'].ravel() for d in test_data])
+
+    print('cpu number {}'.format(os.cpu_count()))
+    base_time = None
+    for num_threads in [1, 4, 8, 16]:
+        rf_map.set_num_threads(num_threads)
+        t0 = time.time()
+        rf_map.build_map()
+        t1 = time.time()
+        rf_map.relocalize_batch(keypoints, descriptors, init_ptzs, num_threads)
+        t2 = time.time()
+        if base_time is None:
+            base_time = (t1 - t0, t2 - t1)
+        print('threads {:2d}: build {:.2f} s ({:.1f}x), relocalize {} frames {:.2f} s ({:.1f}x)'.format(
+            num_threads, t1 - t0, base_time[0] / (t1 - t0), len(test_data), t2 - t1, base_time[1] / (t2 - t1)))
+
+def ut_estimate_camera_ransac_batch():
+    import scipy.io as sio
+
+    keypoints, rays, ptz_gt = [], [], []
+    for i in range(0, 3480, 120):
+        data = sio.loadmat('/Users/jimmy/Desktop/nn_test_data/outliers-50/{}.mat'.format(i))
+        keypoints.append(data['keypoints'])
+        rays.append(data['rays'])
+        ptz_gt.append(data['ptz'].ravel())
+
+    estimated_ptz, inlier_num = RFMap.estimate_camera_ransac_batch(keypoints, rays, np.zeros((len(keypoints), 3)), 4)
+    for i in range(len(keypoints)):
+        print('estimated ptz {}, ground truth {}, inliers {} / {}'.format(estimated_ptz[i], ptz_gt[i],
+                                                                         inlier_num[i], len(keypoints[i])))
+
 def ut_estimateCameraRANSAC():
     import scipy.io as sio
 
@@ -9,13 +9,14 @@
 #include "rf_map_builder.hpp"
 #include "dt_util.hpp"
 #include <iostream>
+#include <chrono>
 #include "mat_io.hpp"
 
 using namespace::std;
 
 RFMapBuilder::RFMapBuilder()
 {
-    
+    num_threads_ = 1;
 }
 
 RFMapBuilder::~RFMapBuilder()
@@ -28,18 +29,40 @@ void RFMapBuilder::setTreeParameter(const TreeParameter& param)
     tree_param_ = param;
 }
 
+void RFMapBuilder::setNumThreads(const int num_threads)
+{
+    num_threads_ = std::max(num_threads, 1);
+}
+
 bool  RFMapBuilder::buildModel(BTDTRegressor& model,
                              const vector<string> & feature_label_files,
                              const char *model_file_name,
                                bool verbose) const
 {
-    //printf("1 \n");
-    //printf("feature label file number %lu\n", feature_label_files.size());
     assert(feature_label_files.size() > 0);
     
-    //printf("tree number %lu \n 2 \n", model.trees_.size());
+    // read each file once, frames are sampled from memory
+    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    vector<vector<btdtr_ptz_util::PTZTrainingSample> > keyframe_samples(feature_label_files.size());
+    for (int i = 0; i<feature_label_files.size(); i++) {
+        Eigen::Vector3f dummy_ptz;  // not used
+        btdtr_ptz_util::generatePTZSampleWithFeature(feature_label_files[i].c_str(), pp, dummy_ptz, keyframe_samples[i]);
+    }
+    return this->buildModel(model, keyframe_samples, model_file_name, verbose);
+}
+
+bool  RFMapBuilder::buildModel(BTDTRegressor& model,
+                               const vector<vector<btdtr_ptz_util::PTZTrainingSample> > & keyframe_samples,
+                               const char *model_file_name,
+                               bool verbose) const
+{
+    assert(keyframe_samples.size() > 0);
+    
+    // the model may be rebuilt in memory, release old trees
+    for (int i = 0; i<model.trees_.size(); i++) {
+        delete model.trees_[i];
+    }
     model.trees_.clear();
-    //printf("3 \n");
     
     if (verbose) {
         tree_param_.printSelf();
@@ -47,29 +70,39 @@ bool  RFMapBuilder::buildModel(BTDTRegressor& model,
     
     model.reg_tree_param_ = tree_param_.base_tree_param_;
     
-    const int frame_num = (int)feature_label_files.size();
-    const int sampled_frame_num = std::min((int)feature_label_files.size(), tree_param_.sampled_frame_num_);
+    const int frame_num = (int)keyframe_samples.size();
+    const int sampled_frame_num = std::min(frame_num, tree_param_.sampled_frame_num_);
     const int tree_num = tree_param_.base_tree_param_.tree_num_;
     
-    const Eigen::Vector2f pp(tree_param_.pp_x_, tree_param_.pp_y_);
+    // randomly sample frames and tree seeds, in the calling thread so that rand() is called in order
+    vector<vector<int> > tree_frames(tree_num);
+    vector<unsigned int> tree_seeds(tree_num);
     for (int n = 0; n<tree_num; n++) {
-        // randomly sample frames
-        vector<string> sampled_files;
         for (int j = 0; j<sampled_frame_num; j++) {
-            int index = rand()%frame_num;
-            sampled_files.push_back(feature_label_files[index]);
+            tree_frames[n].push_back(rand()%frame_num);
         }
-        
-        if (verbose) {
-            printf("training from %lu frames\n", sampled_files.size());
+        tree_seeds[n] = rand();
+    }
+    
+    for (const auto& samples: keyframe_samples) {
+        if (samples.size() > 0) {
+            model.feature_dim_ = (int)samples[0].descriptor_.size();
+            model.label_dim_   = (int)samples[0].pan_tilt_.size();
+            break;
         }
+    }
+    
+    // trees are independent, build them in parallel
+    vector<TreePtr> trees(tree_num, NULL);
+    vector<Eigen::VectorXf> q1_errors(tree_num), q2_errors(tree_num), q3_errors(tree_num);
+    vector<double> build_time(tree_num, 0.0);
+    DTUtil::parallelFor(tree_num, num_threads_, [&](int n) {
         // sample from selected frames
+        const vector<int> & sampled_frames = tree_frames[n];
         vector<VectorXf> features;
         vector<VectorXf> labels;
-        for (int j = 0; j<sampled_files.size(); j++) {
-            vector<btdtr_ptz_util::PTZTrainingSample> samples;
-            Eigen::Vector3f dummy_ptz;  // not used
-            btdtr_ptz_util::generatePTZSampleWithFeature(sampled_files[j].c_str(), pp, dummy_ptz, samples);
+        for (int j = 0; j<sampled_frames.size(); j++) {
+            const vector<btdtr_ptz_util::PTZTrainingSample> & samples = keyframe_samples[sampled_frames[j]];
             for (int k = 0; k< samples.size(); k++) {
                 features.push_back(samples[k].descriptor_);
                 labels.push_back(samples[k].pan_tilt_);
@@ -77,49 +110,44 @@ bool  RFMapBuilder::buildModel(BTDTRegressor& model,
         }
         assert(features.size() == labels.size());
         
-        if (verbose) {
-            printf("training sample number is %lu\n", features.size());
-        }
-        
-        model.feature_dim_ = (int)features[0].size();
-        model.label_dim_   = (int)labels[0].size();
-        
         vector<unsigned int> indices = DTUtil::range<unsigned int>(0, (int)features.size(), 1);
         assert(indices.size() == features.size());
         
         TreePtr pTree = new TreeType();
         assert(pTree);
-        double tt = clock();
+        pTree->setRandomSeed(tree_seeds[n]);
+        auto tt = std::chrono::steady_clock::now();
         pTree->buildTree(features, labels, indices, tree_param_.base_tree_param_);
-        if (verbose) {
-            printf("build a tree cost %lf seconds\n", (clock()-tt)/CLOCKS_PER_SEC );
-        }       
+        build_time[n] = std::chrono::duration<double>(std::chrono::steady_clock::now() - tt).count();
         
         // test training error
-        vector<Eigen::VectorXf> errors;
-        for (int k = 0; k< features.size(); k++) {
-            Eigen::VectorXf feat = features[k];
-            Eigen::VectorXf label = labels[k];
-            Eigen::VectorXf pred;
-            float dist = 0.0f;
-            pTree->predict(feat, 1, pred, dist);
-            errors.push_back(pred - label);
-        }
-        Eigen::VectorXf q1_error, q2_error, q3_error;
-        DTUtil::quartileError(errors, q1_error, q2_error, q3_error);
         if (verbose) {
-            cout<<"Training first quartile error: \n"<<q1_error.transpose()<<endl;
-            cout<<"Training second quartile (median) error: \n"<<q2_error.transpose()<<endl;
-            cout<<"Training third quartile error: \n"<<q3_error.transpose()<<endl<<endl;
+            vector<Eigen::VectorXf> errors;
+            for (int k = 0; k< features.size(); k++) {
+                Eigen::VectorXf pred;
+                float dist = 0.0f;
+                pTree->predict(features[k], 1, pred, dist);
+                errors.push_back(pred - labels[k]);
+            }
+            DTUtil::quartileError(errors, q1_errors[n], q2_errors[n], q3_errors[n]);
         }
-        
-                
-        model.trees_.push_back(pTree);
-        if (model_file_name != NULL) {
-            model.saveModel(model_file_name);
+        trees[n] = pTree;
+    });
+    
+    for (int n = 0; n<tree_num; n++) {
+        if (verbose) {
+            printf("training from %lu frames\n", tree_frames[n].size());
+            printf("build a tree cost %lf seconds\n", build_time[n]);
+            cout<<"Training first quartile error: \n"<<q1_errors[n].transpose()<<endl;
+            cout<<"Training second quartile (median) error: \n"<<q2_errors[n].transpose()<<endl;
+            cout<<"Training third quartile error: \n"<<q3_errors[n].transpose()<<endl<<endl;
         }
-        //this->validationError(model, feature_label_files, std::min(4, frame_num));
+        model.trees_.push_back(trees[n]);
+    }
+    if (model_file_name != NULL) {
+        model.saveModel(model_file_name);
     }
+    //this->validationError(model, feature_label_files, std::min(4, frame_num));
     return true;
 }
 
@@ -23,6 +23,7 @@ class RFMapBuilder {
     
 private:
     TreeParameter tree_param_;
+    int num_threads_;       // trees are built on num_threads_ threads
     
 public:
     RFMapBuilder();
@@ -31,13 +32,23 @@ public:
     
     void setTreeParameter(const TreeParameter& param);
     
+    void setNumThreads(const int num_threads);
+    
     // build model from subset of images    
     // sift feature are precomputed to save time
     // feature_label_files: .mat file has ptz, keypoint location and descriptor
     bool buildModel(BTDTRegressor& model,
                     const vector<string> & feature_label_files,
                     const char *model_file_name,
-                    bool verbose = true) const;   
+                    bool verbose = true) const;
+    
+    // build model from samples in memory
+    // keyframe_samples: training samples of each keyframe
+    // model_file_name: NULL, the model is not saved
+    bool buildModel(BTDTRegressor& model,
+                    const vector<vector<btdtr_ptz_util::PTZTrainingSample> > & keyframe_samples,
+                    const char *model_file_name,
+                    bool verbose = true) const;
     
 private:    
     bool validationError(const BTDTRegressor & model,
@@ -251,7 +251,48 @@ void generatePTZTraingSample(const char* feature_file_name,
             samples.push_back(s);
         }
     }
-    
+
+    void generatePTZSampleWithFeature(const double * keypoints,
+                                      const float * descriptors,
+                                      const int n,
+                                      const int dim,
+                                      const Eigen::Vector2f& pp,
+                                      const Eigen::Vector3f& ptz,
+                                      vector<PTZTrainingSample> & samples)
+    {
+        assert(keypoints && descriptors);
+        samples.reserve(samples.size() + n);
+        for (int i = 0; i<n; i++) {
+            PTZTrainingSample s;
+            s.loc_[0] = keypoints[2 * i];
+            s.loc_[1] = keypoints[2 * i + 1];
+            Eigen::Vector2d pan_tilt = cvx_pgl::point2PanTilt(pp.cast<double>(),
+                                                              ptz.cast<double>(),
+                                                              s.loc_.cast<double>());
+            s.pan_tilt_[0] = pan_tilt[0];
+            s.pan_tilt_[1] = pan_tilt[1];
+            s.descriptor_ = Eigen::Map<const Eigen::VectorXf>(descriptors + (size_t)i * dim, dim);
+            samples.push_back(s);
+        }
+    }
+
+    void generatePTZSampleWithFeature(const double * keypoints,
+                                      const float * descriptors,
+                                      const int n,
+                                      const int dim,
+                                      vector<PTZSample> & samples)
+    {
+        assert(keypoints && descriptors);
+        samples.reserve(samples.size() + n);
+        for (int i = 0; i<n; i++) {
+            PTZSample s;
+            s.loc_[0] = keypoints[2 * i];
+            s.loc_[1] = keypoints[2 * i + 1];
+            s.descriptor_ = Eigen::Map<const Eigen::VectorXf>(descriptors + (size_t)i * dim, dim);
+            samples.push_back(s);
+        }
+    }
+
 void readSequenceData(const char * sequence_file_name,
                                         const char * sequence_base_directory,
                                         vector<string> & feature_files,
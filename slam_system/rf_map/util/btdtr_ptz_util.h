@@ -81,6 +81,25 @@ void generatePTZSampleWithFeature(const char * feature_ptz_file_name,
     void generatePTZSampleWithFeature(const char * feature_location_file_name,
                                       const Eigen::Vector2f& pp,
                                       vector<PTZSample> & samples);
+
+    // in-memory version, no file I/O
+    // keypoints: n x 2, row major
+    // descriptors: n x dim, row major
+    // ptz: pan, tilt and focal length of the image
+    void generatePTZSampleWithFeature(const double * keypoints,
+                                      const float * descriptors,
+                                      const int n,
+                                      const int dim,
+                                      const Eigen::Vector2f& pp,
+                                      const Eigen::Vector3f& ptz,
+                                      vector<PTZTrainingSample> & samples);
+
+    // in-memory version, no file I/O
+    void generatePTZSampleWithFeature(const double * keypoints,
+                                      const float * descriptors,
+                                      const int n,
+                                      const int dim,
+                                      vector<PTZSample> & samples);
   //?
 void readSequenceData(const char * sequence_file_name,
                       const char * sequence_base_directory,
@@ -98,6 +98,18 @@ namespace ptz_pose_opt {
                                    const PTZPreemptiveRANSACParameter & param,
                                    Eigen::Vector3d & ptz,
                                    bool verbose)
+    {
+        std::mt19937 rng(rand());
+        return preemptiveRANSACOneToMany(image_points, candidate_pan_tilt, pp, param, ptz, rng, verbose);
+    }
+    
+    bool preemptiveRANSACOneToMany(const vector<Eigen::Vector2d> & image_points,
+                                   const vector<vector<Eigen::Vector2d> > & candidate_pan_tilt,
+                                   const Eigen::Vector2d& pp,
+                                   const PTZPreemptiveRANSACParameter & param,
+                                   Eigen::Vector3d & ptz,
+                                   std::mt19937 & rng,
+                                   bool verbose)
     {
         assert(image_points.size() == candidate_pan_tilt.size());
         if (image_points.size() <= 12) {
@@ -109,6 +121,7 @@ namespace ptz_pose_opt {
         const int N = (int)image_points.size();
         const int B = param.sample_number_;
         double threshold = param.reprojection_error_threshold_;
+        std::uniform_int_distribution<int> random_index(0, N - 1);
         
         // step 1: sample hyperthesis
         vector<Hypothesis> hypotheses;
@@ -119,8 +132,8 @@ namespace ptz_pose_opt {
             int k1 = 0;
             int k2 = 0;
             do{
-                k1 = rand()%N;
-                k2 = rand()%N;
+                k1 = random_index(rng);
+                k2 = random_index(rng);
             }while (k1 == k2);
             
             const Eigen::Vector2d pan_tilt1 = candidate_pan_tilt[k1][0];
@@ -164,7 +177,7 @@ namespace ptz_pose_opt {
             vector<vector<Eigen::Vector2d> > sampled_pan_tilt;  // one camera point may have multiple pan, tilt correspondences
             vector<int> sampled_indices;
             for (int i =0; i<B; i++) {
-                int index = rand()%N;
+                int index = random_index(rng);
                 sampled_image_pts.push_back(image_points[index]);
                 sampled_pan_tilt.push_back(candidate_pan_tilt[index]);
                 sampled_indices.push_back(index);
@@ -237,4 +250,25 @@ namespace ptz_pose_opt {
         ptz = hypotheses[0].ptz_;
         return true;
     }
+    
+    int countInliers(const vector<Eigen::Vector2d> & image_points,
+                     const vector<vector<Eigen::Vector2d> > & candidate_pan_tilt,
+                     const Eigen::Vector2d& pp,
+                     const PTZPreemptiveRANSACParameter & param,
+                     const Eigen::Vector3d & ptz)
+    {
+        assert(image_points.size() == candidate_pan_tilt.size());
+        
+        vector<vector<Eigen::Vector2d> > projected_pan_tilt = projectPanTilt(ptz, pp, candidate_pan_tilt);
+        int inlier_num = 0;
+        for (int i = 0; i<projected_pan_tilt.size(); i++) {
+            for (int j = 0; j<projected_pan_tilt[i].size(); j++) {
+                if ((image_points[i] - projected_pan_tilt[i][j]).norm() < param.reprojection_error_threshold_) {
+                    inlier_num++;
+                    break;
+                }
+            }
+        }
+        return inlier_num;
+    }
 }
@@ -11,6 +11,7 @@
 
 #include <stdio.h>
 #include <vector>
+#include <random>
 #include <Eigen/Dense>
 
 using std::vector;
@@ -44,6 +45,23 @@ namespace ptz_pose_opt {
                                    Eigen::Vector3d & ptz,
                                    bool verbose = true);
     
+    // rng: random number generator of the samples, one for each thread
+    // the function above uses a generator seeded by rand()
+    bool preemptiveRANSACOneToMany(const vector<Eigen::Vector2d> & image_points,
+                                   const vector<vector<Eigen::Vector2d> > & candidate_pan_tilt,
+                                   const Eigen::Vector2d& principal_point,
+                                   const PTZPreemptiveRANSACParameter & param,
+                                   Eigen::Vector3d & ptz,
+                                   std::mt19937 & rng,
+                                   bool verbose = true);
+    
+    // number of image points that have a candidate pan, tilt within the reprojection error threshold
+    int countInliers(const vector<Eigen::Vector2d> & image_points,
+                     const vector<vector<Eigen::Vector2d> > & candidate_pan_tilt,
+                     const Eigen::Vector2d& principal_point,
+                     const PTZPreemptiveRANSACParameter & param,
+                     const Eigen::Vector3d & ptz);
+    
     //bool bundleAdjustment(
 }
 
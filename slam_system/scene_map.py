@@ -5,14 +5,18 @@ Create by Jimmy, 2018.9
 """
 
 import numpy as np
+import copy
+import random
 import time
-import scipy.io as sio
 
 from key_frame import KeyFrame
 from util import overlap_pan_angle
-from bundle_adjustment import bundle_adjustment
+from bundle_adjustment import bundle_adjustment, local_bundle_adjustment
+from image_process import match_features
+from transformation import TransFunction
 from sequence_manager import SequenceManager
-from rf_map.python_package.backup.rf_map import RFMap
+from rf_map.python_package.rf_map_wrapper import RFMap
+from rf_map.python_package.online_rf_map_wrapper import OnlineRFMap
 
 
 class Map:
@@ -28,6 +32,40 @@ class Map:
         # feature detection method. DoG + SIFT or FAST + ORB
         self.feature_method = feature_method
 
+        # optional vocabulary tree for keyframe retrieval in relocalization, see relocalization.build_vocabulary
+        self.vocabulary = None
+
+        # keyframe pan intervals for pose-prior search, see keyframes_near_pose
+        self._pose_index = None
+
+        # feature cache for incremental bundle adjustment, one item for each keyframe
+        # all detected keypoints, descriptors, [N, 2] keypoint locations
+        # and a dictionary from keypoint index to global_ray index
+        self.keypoints = []
+        self.descriptors = []
+        self.points = []
+        self.landmark_maps = []
+
+    def _reset_feature_cache(self):
+        self.keypoints = []
+        self.descriptors = []
+        self.points = []
+        self.landmark_maps = []
+
+    def _update_feature_cache(self):
+        """
+        detect features for keyframes that are not in the cache. Each keyframe is only detected once.
+        Landmarks of a keyframe (e.g. from the full bundle adjustment) are restored from its keypoint_index
+        and landmark_index.
+        """
+        for i in range(len(self.keypoints), len(self.keyframe_list)):
+            kp, des = self.keyframe_list[i].get_features(self.feature_method)
+            self.keypoints.append(kp)
+            self.descriptors.append(des)
+            self.points.append(np.array([p.pt for p in kp], dtype=np.float64).reshape(-1, 2))
+            self.landmark_maps.append({int(j): int(k) for j, k in zip(self.keyframe_list[i].keypoint_index,
+                                                                       self.keyframe_list[i].landmark_index)})
+
     def add_first_keyframe(self, keyframe, verbose=False):
         """
         add first key frame, no bundle adjustment
@@ -37,6 +75,9 @@ class Map:
         assert isinstance(keyframe, KeyFrame)
         self.keyframe_list = []
         self.keyframe_list.append(keyframe)
+        self.global_ray = np.ndarray([0, 2])
+        self._reset_feature_cache()
+        self._pose_index = None
         if verbose:
             print('first key frame is added, no bundle adjustment and landmark')
 
@@ -49,6 +90,7 @@ class Map:
         """
         assert isinstance(keyframe, KeyFrame)
         self.keyframe_list.append(keyframe)
+        self._pose_index = None
 
     def add_keyframe_with_ba(self, keyframe, save_path, verbose=False):
         """
@@ -77,12 +119,14 @@ class Map:
         N = len(self.keyframe_list)
         images = []
         image_indices = []
+        features = []
         initial_ptzs = np.zeros((N, 3))
 
         for i in range(N):
             keyframe = self.keyframe_list[i]
             images.append(keyframe.img)
             image_indices.append(keyframe.img_index)
+            features.append(keyframe.get_features(self.feature_method))
             initial_ptzs[i] = keyframe.pan, keyframe.tilt, keyframe.f
 
         # step 3: bundle adjustment
@@ -91,7 +135,12 @@ class Map:
         start = time.time()
 
         landmarks, keyframes = bundle_adjustment(images, image_indices, feature_method,
-                                                 initial_ptzs, camera_center, base_rotation, u, v, save_path, verbose)
+                                                 initial_ptzs, camera_center, base_rotation, u, v, save_path, verbose,
+                                                 features)
+
+        # bundle adjustment creates new keyframes, keep detected features of the same images
+        for i in range(N):
+            keyframes[i].feature_cache = self.keyframe_list[i].feature_cache
 
         end = time.time()
 
@@ -100,6 +149,8 @@ class Map:
 
         # check if keyframe has landmarks
         self.global_ray = landmarks
+        # keyframes are replaced, landmark_maps are restored from them in _update_feature_cache
+        self._reset_feature_cache()
         self.keyframe_list = []
         for i in range(len(keyframes)):
             keyframe = keyframes[i]
@@ -114,8 +165,205 @@ class Map:
 
         print("BA time", end - start)
 
+        self._pose_index = None
         return landmarks, self.keyframe_list
 
+    def add_keyframe_incremental(self, keyframe, window_size=5, verbose=False):
+        """
+        add one keyframe and do local bundle adjustment.
+        Only the new keyframe is matched (with overlapped keyframes). The new keyframe and
+        the most recent (window_size - 1) matched keyframes and their landmarks are optimized,
+        other keyframes and landmarks are fixed.
+        :param keyframe:
+        :param window_size: number of optimized keyframes
+        :param verbose:
+        :return: updated map, please note the original map is updated
+        """
+        assert isinstance(keyframe, KeyFrame)
+        assert len(self.keyframe_list) >= 1
+        assert window_size >= 1
+
+        ref_frame = self.keyframe_list[0]
+        u, v = ref_frame.u, ref_frame.v
+
+        start = time.time()
+
+        # step 1: detect features of the new keyframe
+        self.add_keyframe_without_ba(keyframe, False)
+        self._update_feature_cache()
+        N = len(self.keyframe_list)
+        new_index = N - 1
+
+        # step 2: match the new keyframe with overlapped keyframes and associate landmarks
+        overlap_angle_threshold = 5  # degrees
+        min_match_num = 20
+        max_match_num = 200
+
+        n_ray = len(self.global_ray)
+        new_rays = []
+        new_map = self.landmark_maps[new_index]
+        matched_frames = []
+        for i in range(new_index):
+            frame = self.keyframe_list[i]
+            angle = overlap_pan_angle(frame.f, frame.pan, keyframe.f, keyframe.pan, 1280)
+            if angle <= overlap_angle_threshold:
+                continue
+
+            pts1, index1, pts2, index2 = match_features(self.keypoints[i], self.descriptors[i],
+                                                        self.keypoints[new_index], self.descriptors[new_index],
+                                                        self.feature_method)
+            if len(index1) <= min_match_num:
+                if verbose:
+                    print("no enough matches between keyframe: %d and %d" % (i, new_index))
+                continue
+
+            # randomly remove some matches
+            if len(index1) > max_match_num:
+                rand_list = random.sample(range(len(index1)), max_match_num)
+                index1 = [index1[idx] for idx in rand_list]
+                index2 = [index2[idx] for idx in rand_list]
+
+            matched_frames.append(i)
+            old_map = self.landmark_maps[i]
+            for idx1, idx2 in zip(index1, index2):
+                if idx1 in old_map and idx2 in new_map:
+                    if old_map[idx1] != new_map[idx2]:
+                        print("Warning: in-consistent matching result! (%d %d) <--> (%d %d)" %
+                              (i, idx1, new_index, idx2))
+                elif idx1 in old_map:
+                    new_map[idx2] = old_map[idx1]
+                elif idx2 in new_map:
+                    old_map[idx1] = new_map[idx2]
+                else:
+                    # initialize the landmark from the existing keyframe
+                    x, y = self.points[i][idx1]
+                    new_rays.append(TransFunction.from_image_to_ray(u, v, frame.f, frame.pan, frame.tilt, x, y))
+                    old_map[idx1] = n_ray + len(new_rays) - 1
+                    new_map[idx2] = n_ray + len(new_rays) - 1
+
+            if verbose:
+                print("%d matches between keyframe: %d and %d" % (len(index1), i, new_index))
+
+        if len(matched_frames) == 0:
+            print('warning: key frame, image index %d is not included in the map' % keyframe.img_index)
+            self.keyframe_list.pop()
+            self.keypoints.pop()
+            self.descriptors.pop()
+            self.points.pop()
+            self.landmark_maps.pop()
+            self._pose_index = None
+            return self.global_ray, self.keyframe_list
+
+        landmarks = np.ndarray([0, 2])
+        if len(new_rays) > 0:
+            landmarks = np.array(new_rays).reshape(-1, 2)
+        landmarks = np.vstack([self.global_ray, landmarks])
+
+        # step 3: choose the window, the first keyframe is the reference and is never optimized
+        window = matched_frames[-(window_size - 1):] if window_size > 1 else []
+        pose_var_index = np.array([i for i in window + [new_index] if i != 0], dtype=np.int64)
+
+        landmark_var_index = set()
+        for i in pose_var_index:
+            landmark_var_index.update(self.landmark_maps[i].values())
+        landmark_var_index = np.array(sorted(landmark_var_index), dtype=np.int64)
+
+        # step 4: observations of optimized landmarks from all keyframes
+        is_var_landmark = np.zeros(len(landmarks), dtype=bool)
+        is_var_landmark[landmark_var_index] = True
+        obs_pose_index, obs_landmark_index, observations = [], [], []
+        for i in range(N):
+            landmark_map = self.landmark_maps[i]
+            local_index = np.fromiter(landmark_map.keys(), dtype=np.int64, count=len(landmark_map))
+            global_index = np.fromiter(landmark_map.values(), dtype=np.int64, count=len(landmark_map))
+            mask = is_var_landmark[global_index]
+            obs_pose_index.append(np.full(np.count_nonzero(mask), i, dtype=np.int64))
+            obs_landmark_index.append(global_index[mask])
+            observations.append(self.points[i][local_index[mask]])
+        obs_pose_index = np.concatenate(obs_pose_index)
+        obs_landmark_index = np.concatenate(obs_landmark_index)
+        observations = np.vstack(observations)
+
+        # step 5: local bundle adjustment
+        poses = np.array([[frame.pan, frame.tilt, frame.f] for frame in self.keyframe_list])
+        poses, landmarks = local_bundle_adjustment(poses, landmarks, pose_var_index, landmark_var_index,
+                                                   obs_pose_index, obs_landmark_index, observations,
+                                                   u, v, verbose)
+
+        # step 6: write result to the map
+        self.global_ray = landmarks
+        for i in pose_var_index:
+            frame = self.keyframe_list[i]
+            frame.pan, frame.tilt, frame.f = poses[i]
+
+        for i in matched_frames + [new_index]:
+            frame = self.keyframe_list[i]
+            landmark_map = self.landmark_maps[i]
+            local_index = sorted(landmark_map.keys())
+            frame.feature_pts = [self.keypoints[i][j] for j in local_index]
+            frame.feature_des = self.descriptors[i].take(local_index, axis=0)
+            frame.landmark_index = np.array([landmark_map[j] for j in local_index], dtype=np.int32)
+            frame.keypoint_index = np.array(local_index, dtype=np.int32)
+
+        end = time.time()
+
+        if verbose:
+            print('updated map, number of key frame: %d, number of landmark %d, optimized: %d key frames, %d landmarks' %
+                  (len(self.keyframe_list), len(self.global_ray), len(pose_var_index), len(landmark_var_index)))
+
+        print("local BA time", end - start)
+
+        self._pose_index = None
+        return self.global_ray, self.keyframe_list
+
+    def snapshot(self):
+        """
+        copy of the map for a reader in another thread. Keyframes are copied, images and features are shared.
+        :return: Map object
+        """
+        snapshot = Map(self.feature_method)
+        snapshot.global_ray = self.global_ray.copy()
+        snapshot.keyframe_list = [copy.copy(keyframe) for keyframe in self.keyframe_list]
+        snapshot.vocabulary = self.vocabulary
+        return snapshot
+
+    def _get_pose_index(self, im_width=1280):
+        """
+        pan interval (field of view) of keyframes sorted by lower bound. It is rebuilt after keyframes are changed.
+        :return: keyframe index [N], lower bound [N] (sorted), upper bound [N], tilt [N]
+        """
+        if self._pose_index is None or len(self._pose_index[0]) != len(self.keyframe_list) \
+                or self._pose_index[4] != im_width:
+            ptzs = np.array([[keyframe.pan, keyframe.tilt, keyframe.f] for keyframe in self.keyframe_list])
+            ptzs = ptzs.reshape(-1, 3)
+            half_fov = np.degrees(np.arctan(im_width / 2 / ptzs[:, 2]))
+            pan_min = ptzs[:, 0] - half_fov
+            order = np.argsort(pan_min, kind='stable')
+            self._pose_index = (order, pan_min[order], ptzs[order, 0] + half_fov[order], ptzs[order, 1], im_width)
+        return self._pose_index[0:4]
+
+    def keyframes_near_pose(self, ptz, pan_radius, tilt_radius=None, im_width=1280):
+        """
+        keyframes whose pan field of view overlaps with the field of view of ptz enlarged by pan_radius
+        :param ptz: array [3] camera pose
+        :param pan_radius: search radius of pan angle in degree
+        :param tilt_radius: optional search radius of tilt angle in degree
+        :param im_width: image with in pixel
+        :return: index array of keyframes in keyframe_list, in increasing order
+        """
+        order, pan_min, pan_max, tilt = self._get_pose_index(im_width)
+
+        half_fov = np.degrees(np.arctan(im_width / 2 / ptz[2]))
+        query_min = ptz[0] - half_fov - pan_radius
+        query_max = ptz[0] + half_fov + pan_radius
+
+        # keyframes with lower bound larger than query_max can not overlap
+        n = np.searchsorted(pan_min, query_max, side='right')
+        mask = pan_max[:n] >= query_min
+        if tilt_radius is not None:
+            mask &= np.abs(tilt[:n] - ptz[1]) <= tilt_radius
+        return np.sort(order[:n][mask])
+
     def good_new_keyframe(self, ptz, threshold1=5, threshold2=20, im_width=1280, verbose=False):
         """
         good or not as a new keyframe, small overlap with all existing keyframes
@@ -152,6 +400,8 @@ class Map:
         """
         Save the map to a .mat file.
         """
+        import scipy.io as sio
+
         keyframe_data = dict()
         keyframes = []
 
@@ -169,35 +419,58 @@ class Map:
 
 
 class RandomForestMap:
-    def __init__(self):
-        self.keyframe_location = "C:/graduate_design/Pan-tilt-zoom-SLAM/slam_system/random_forest/keyframes/"
-        self.mat_path_file = "C:/graduate_design/Pan-tilt-zoom-SLAM/slam_system/random_forest/train_feature_file.txt"
+    def __init__(self, online=True):
+        """
+        :param online: True, a new keyframe is inserted to one tree of the forest (update time does not grow
+        with the map size). Keyframes in the forest can not be changed, so there is no bundle adjustment.
+        False, keyframes are bundle adjusted and the forest is trained again from all keyframes.
+        """
         self.tree_param_file = "C:/graduate_design/Pan-tilt-zoom-SLAM/slam_system/random_forest/ptz_tree_param.txt"
         self.map_file = "C:/graduate_design/Pan-tilt-zoom-SLAM/slam_system/random_forest/rf_save/debug.txt"
-        self.relocalize_file = 'C:/graduate_design/Pan-tilt-zoom-SLAM/slam_system/random_forest/relocalize.mat'
 
         self.keyframe_list = []
         self.feature_method = 'sift'
 
-    def add_keyframe(self, keyframe):
+        # persistent in-memory model, keyframes and the model are passed as arrays without file I/O
+        self.online = online
+        self.rf_map = None
 
-        self.keyframe_list.append(keyframe)
+    def _get_rf_map(self):
+        if self.rf_map is None:
+            if self.online:
+                self.rf_map = OnlineRFMap(self.map_file)
+            else:
+                self.rf_map = RFMap(self.map_file)
+            self.rf_map.set_tree_parameter(self.tree_param_file)
+        return self.rf_map
 
-        if len(self.keyframe_list) > 1:
-            self.bundle_adjustment_processing()
-            # for each in self.keyframe_list:
-            #     each.convert_keypoint_to_array()
+    @staticmethod
+    def _add_to_rf_map(rf_map, frame):
+        if type(frame.feature_pts) == list:
+            frame.convert_keypoint_to_array()
+        return rf_map.add_keyframe(frame.feature_pts, frame.feature_des, [frame.pan, frame.tilt, frame.f])
 
-        f = open(self.mat_path_file, 'w')
-        for frame in self.keyframe_list:
-            mat_path = self.keyframe_location + str(frame.img_index) + ".mat"
-            f.write(mat_path + "\n")
-            frame.save_to_mat(mat_path)
+    def add_keyframe(self, keyframe):
 
-        f.close()
+        self.keyframe_list.append(keyframe)
 
-        rf_map = RFMap(self.map_file)
-        rf_map.createMap(self.mat_path_file, self.tree_param_file)
+        rf_map = self._get_rf_map()
+        if self.online:
+            # previous keyframes are already in the forest, only the new keyframe is inserted.
+            # Bundle adjustment would change the ptz of keyframes in the forest, their labels would be stale,
+            # so the keyframe is inserted with the pose and features from tracking
+            self._add_to_rf_map(rf_map, keyframe)
+        else:
+            if len(self.keyframe_list) > 1:
+                self.bundle_adjustment_processing()
+                # for each in self.keyframe_list:
+                #     each.convert_keypoint_to_array()
+
+            # bundle adjustment changes the ptz of keyframes, so all keyframes are added again
+            rf_map.clear_keyframes()
+            for frame in self.keyframe_list:
+                self._add_to_rf_map(rf_map, frame)
+            rf_map.build_map()
 
     def bundle_adjustment_processing(self):
         # step 1: get common camera parameters from the first frame
@@ -257,11 +530,11 @@ class RandomForestMap:
         # rf_map.createMap(self.mat_path_file, self.tree_param_file)
 
     def relocalize(self, relocalize_frame, init_ptz):
-        rf_map = RFMap(self.map_file)
+        if type(relocalize_frame.feature_pts) == list:
+            relocalize_frame.convert_keypoint_to_array()
 
-        relocalize_frame.save_to_mat(self.relocalize_file)
-
-        estimated_ptz = rf_map.relocalization(self.relocalize_file, init_ptz)
+        estimated_ptz = self._get_rf_map().relocalize(relocalize_frame.feature_pts, relocalize_frame.feature_des,
+                                                      init_ptz)
 
         estimated_ptz = estimated_ptz.ravel()
 
@@ -271,19 +544,13 @@ class RandomForestMap:
         # check parameter
         assert ptz.shape[0] == 3
 
-        with open(self.mat_path_file, 'r') as f:
-            keyframe_list = f.read().splitlines()
-
-        N = len(keyframe_list)
+        N = len(self.keyframe_list)
         if N == 0:
             print("Warning: Not existing keyframes")
 
         map_ptzs = np.zeros((N, 3))
-        for i, keyframe in enumerate(keyframe_list):
-            data = sio.loadmat(keyframe)
-            gt_ptz = data['ptz']
-            gt_ptz = gt_ptz.ravel()
-            map_ptzs[i][0:3] = gt_ptz
+        for i, keyframe in enumerate(self.keyframe_list):
+            map_ptzs[i][0:3] = keyframe.pan, keyframe.tilt, keyframe.f
 
         pan_angle_overlaps = np.zeros(N)
         for i in range(N):
@@ -377,7 +644,31 @@ def ut_add_keyframe_with_ba():
     print('number of keyframe is %d' % (len(a_map.keyframe_list)))
 
 
+def ut_keyframes_near_pose():
+    """
+    Compare keyframes_near_pose with overlap_pan_angle of all keyframes.
+    """
+    a_map = Map('sift')
+    for i in range(500):
+        keyframe = KeyFrame(None, i, np.zeros(3), np.eye(3), 640, 360,
+                            np.random.uniform(-60, 60), np.random.uniform(-15, -5), np.random.uniform(1500, 4000))
+        a_map.add_keyframe_without_ba(keyframe)
+
+    ptz = np.array([10, -10, 3000])
+    pan_radius = 5
+    start = time.time()
+    near_index = a_map.keyframes_near_pose(ptz, pan_radius)
+    print("%d of %d keyframes, query time %.5f s" % (len(near_index), len(a_map.keyframe_list), time.time() - start))
+
+    brute_force_index = [i for i, keyframe in enumerate(a_map.keyframe_list)
+                         if overlap_pan_angle(ptz[2], ptz[0] - pan_radius, keyframe.f, keyframe.pan, 1280) > 0 or
+                         overlap_pan_angle(ptz[2], ptz[0] + pan_radius, keyframe.f, keyframe.pan, 1280) > 0 or
+                         abs(keyframe.pan - ptz[0]) <= pan_radius]
+    assert np.array_equal(near_index, brute_force_index)
+
+
 if __name__ == '__main__':
     # ut_add_first_key_frame()
     # ut_good_new_keyframe()
+    # ut_keyframes_near_pose()
     ut_add_keyframe_with_ba()
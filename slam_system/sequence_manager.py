@@ -7,23 +7,176 @@ Created by Luke, 2018.9
 
 import numpy as np
 import cv2 as cv
-import scipy.io as sio
 import copy
+import time
+import itertools
+import threading
+import queue
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from util import *
 from image_process import *
 from ptz_camera import PTZCamera
 from transformation import TransFunction
-import scipy.signal as sig
+
+
+class VideoFrameReader:
+    """
+    Decode a video file sequentially in a background thread.
+    Frame index i is the video frame begin_frame + i * stride.
+    Frames are read in increasing index order, reading a frame before the cached ones restarts decoding.
+    """
+
+    def __init__(self, video_path, begin_frame=0, end_frame=None, stride=1, buffer_size=16):
+        """
+        :param video_path: video file
+        :param begin_frame: first video frame
+        :param end_frame: video frame after the last one, None for the end of the video
+        :param stride: read one video frame in every stride frames
+        :param buffer_size: number of decoded frames waiting in the queue, also the number of cached frames
+        """
+        assert begin_frame >= 0 and stride >= 1 and buffer_size >= 1
+        self.video_path = video_path
+        self.begin_frame = begin_frame
+        self.stride = stride
+        self.buffer_size = buffer_size
+
+        capture = cv.VideoCapture(video_path)
+        assert capture.isOpened(), "can not open video {}".format(video_path)
+        frame_num = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+        if frame_num <= 0:
+            # some containers and streams do not report the frame count, count frames until grab() fails
+            capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+            frame_num = 0
+            while capture.grab():
+                frame_num += 1
+        capture.release()
+        if end_frame is None or end_frame > frame_num:
+            end_frame = frame_num
+        self.length = len(range(begin_frame, end_frame, stride))
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+        self._frames = None
+        self._recent = OrderedDict()
+        self._next_index = 0
+        self._start(0)
+
+    def _start(self, index):
+        """
+        start a decoding thread from frame index
+        """
+        self.close()
+        self._stop = threading.Event()
+        self._frames = queue.Queue(maxsize=self.buffer_size)
+        self._recent.clear()
+        self._next_index = index
+        # the thread does not hold a reference to self, so an unclosed reader can still be collected
+        self._thread = threading.Thread(target=VideoFrameReader._decode_loop,
+                                        args=(self.video_path, self.begin_frame, self.stride, self.length,
+                                              index, self._frames, self._stop),
+                                        daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _decode_loop(video_path, begin_frame, stride, length, index, frames, stop):
+        """
+        decoding thread: put (index, image) to the queue, None at the end of the video
+        """
+        capture = cv.VideoCapture(video_path)
+        # seek once, then decode sequentially
+        if begin_frame + index * stride > 0:
+            capture.set(cv.CAP_PROP_POS_FRAMES, begin_frame + index * stride)
+
+        try:
+            for i in range(index, length):
+                ret, img = capture.read()
+                if not ret:
+                    break
+                # skipped frames are grabbed but not decoded
+                if i + 1 < length:
+                    for _ in range(stride - 1):
+                        capture.grab()
+
+                if not VideoFrameReader._put(frames, stop, (i, img)):
+                    return
+            VideoFrameReader._put(frames, stop, None)
+        finally:
+            capture.release()
+
+    @staticmethod
+    def _put(frames, stop, item):
+        """
+        :return: False if the reader is closed while the queue is full
+        """
+        while not stop.is_set():
+            try:
+                frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get_frame(self, index):
+        """
+        :param index: frame index
+        :return: color image, None if the index is out of the video
+        """
+        if index < 0 or index >= self.length:
+            return None
+
+        with self._lock:
+            if index in self._recent:
+                return self._recent[index]
+            # restart decoding for an earlier frame or after close()
+            if index < self._next_index or self._thread is None:
+                self._start(index)
+
+            while self._next_index <= index:
+                item = self._frames.get()
+                if item is None:
+                    # do not wait for frames after the end of the video
+                    self._next_index = self.length
+                    return None
+                i, img = item
+                self._recent[i] = img
+                if len(self._recent) > self.buffer_size:
+                    self._recent.popitem(last=False)
+                self._next_index = i + 1
+
+            return self._recent.get(index)
+
+    def close(self):
+        """
+        stop the decoding thread
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_thread', None) is not None:
+            self.close()
 
 
 class SequenceManager:
-    def __init__(self, annotation_path=None, image_path=None, ground_truth_path=None, bounding_box_path=None):
+    def __init__(self, annotation_path=None, image_path=None, ground_truth_path=None, bounding_box_path=None,
+                 video_path=None, video_begin_frame=0, video_end_frame=None, video_stride=1):
 
         self.height = 720
         self.width = 1280
 
         # annotation data
         if annotation_path is not None:
+            import scipy.io as sio
             seq = sio.loadmat(annotation_path)
             annotation = seq["annotation"]
             meta = seq['meta']
@@ -38,6 +191,12 @@ class SequenceManager:
         if image_path is not None:
             self.image_path = image_path
 
+        # video file, images are decoded from the video instead of the image folder
+        self.video = None
+        if video_path is not None:
+            self.video = VideoFrameReader(video_path, video_begin_frame, video_end_frame, video_stride)
+            self.length = self.video.length
+
         # ground truth
         if ground_truth_path is not None:
             self.ground_truth_pan, self.ground_truth_tilt, self.ground_truth_f = load_camera_pose(ground_truth_path)
@@ -47,26 +206,42 @@ class SequenceManager:
         if bounding_box_path is not None:
             self.bounding_box = []
             if bounding_box_path:
+                import scipy.io as sio
                 self.bounding_box = sio.loadmat(bounding_box_path)['bounding_box']
 
-    def get_image_gray(self, index, dataset_type=0):
+    def get_image_file(self, index, dataset_type=0):
         """
         :param index: image index for sequence
         :param dataset_type: 0 for basketball dataset, 1 for soccer dataset, 2 for synthesized court sequence
-        :return: gray image
+        :return: image file name, None for an unknown dataset
         """
-
         if dataset_type == 0:
-            img = cv.imread(self.image_path + "/000" + str(index + 84000) + ".jpg", cv.IMREAD_GRAYSCALE)
+            return self.image_path + "/000" + str(index + 84000) + ".jpg"
         elif dataset_type == 1:
-            img = cv.imread(self.image_path + "/00000" + str(index + 515) + ".jpg", cv.IMREAD_GRAYSCALE)
-            # img = cv.imread(self.image_path + "/0" + str(index + 500) + ".jpg")
+            return self.image_path + "/00000" + str(index + 515) + ".jpg"
+            # return self.image_path + "/0" + str(index + 500) + ".jpg"
         elif dataset_type == 2:
-            img = cv.imread(self.image_path + "/" + str(index) + ".jpg", cv.IMREAD_GRAYSCALE)
-        else:
+            return self.image_path + "/" + str(index) + ".jpg"
+        return None
+
+    def get_image_gray(self, index, dataset_type=0):
+        """
+        :param index: image index for sequence
+        :param dataset_type: 0 for basketball dataset, 1 for soccer dataset, 2 for synthesized court sequence
+        :return: gray image
+        """
+        # dataset_type is not used for a video
+        if self.video is not None:
+            img = self.video.get_frame(index)
+            assert isinstance(img, np.ndarray)
+            return cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+
+        file_name = self.get_image_file(index, dataset_type)
+        if file_name is None:
             print("Unknown dataset!")
             return None
 
+        img = cv.imread(file_name, cv.IMREAD_GRAYSCALE)
         assert isinstance(img, np.ndarray)
 
         return img
@@ -77,46 +252,123 @@ class SequenceManager:
         :param dataset_type: 0 for basketball dataset, 1 for soccer dataset, 2 for synthesized court sequence
         :return: color image
         """
+        if self.video is not None:
+            img = self.video.get_frame(index)
+            assert isinstance(img, np.ndarray)
+            return img.copy()
 
-        if dataset_type == 0:
-            img = cv.imread(self.image_path + "/000" + str(index + 84000) + ".jpg", cv.IMREAD_COLOR)
-        elif dataset_type == 1:
-            img = cv.imread(self.image_path + "/00000" + str(index + 515) + ".jpg", cv.IMREAD_COLOR)
-        elif dataset_type == 2:
-            img = cv.imread(self.image_path + "/" + str(index) + ".jpg", cv.IMREAD_COLOR)
-        else:
+        file_name = self.get_image_file(index, dataset_type)
+        if file_name is None:
             print("Unknown dataset!")
             return None
 
+        img = cv.imread(file_name, cv.IMREAD_COLOR)
         assert isinstance(img, np.ndarray)
         return img
 
-    def get_bounding_box_mask(self, index, threshold=0.6):
+    def prefetch_images(self, indices, dataset_type=0, gray=True, prefetch_num=8, thread_num=2):
+        """
+        Iterate images that are decoded ahead of the caller by a thread pool.
+        At most prefetch_num images are decoded but not consumed, so the memory is bounded.
+        Decode and wait time (seconds) of each image are saved in self.decode_time and self.wait_time,
+        the decode time hidden behind the caller is sum(decode_time) - sum(wait_time).
+        :param indices: image indices in reading order
+        :param dataset_type: 0 for basketball dataset, 1 for soccer dataset, 2 for synthesized court sequence
+        :param gray: gray or color image
+        :param prefetch_num: number of images decoded ahead
+        :param thread_num: number of decoding threads
+        :return: generator of (index, image)
+        """
+        assert prefetch_num >= 1 and thread_num >= 1
+        read_image = self.get_image_gray if gray else self.get_image
+
+        def decode(index):
+            start_time = time.time()
+            img = read_image(index, dataset_type)
+            return img, time.time() - start_time
+
+        self.decode_time = []
+        self.wait_time = []
+
+        index_iter = iter(indices)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=thread_num) as executor:
+            try:
+                for index in itertools.islice(index_iter, prefetch_num):
+                    pending.append((index, executor.submit(decode, index)))
+
+                while len(pending) > 0:
+                    index, future = pending.popleft()
+                    start_time = time.time()
+                    img, decode_time = future.result()
+                    self.wait_time.append(time.time() - start_time)
+                    self.decode_time.append(decode_time)
+
+                    # refill the buffer before the caller works on this image
+                    for next_index in itertools.islice(index_iter, 1):
+                        pending.append((next_index, executor.submit(decode, next_index)))
+                    yield index, img
+            finally:
+                # the caller may stop early, do not decode the rest
+                for _, future in pending:
+                    future.cancel()
+
+    def get_bounding_boxes(self, index, threshold=0.6):
         """
-        function to get mask to remove features on players
         :param index: image index for sequence
         :param threshold: threshold for bounding box detected by faster-rcnn
-        :return: a player mask for that frame (1 for no player, 0 for player)
+        :return: int array [M, 4] of (x1, y1, x2, y2), pixels in [x1, x2) x [y1, y2) are on players
         """
-        if len(self.bounding_box) > 0:
-            tmp_mask = np.ones([self.height, self.width])
+        # this only for soccer
+        # boxes = [[60, 60, 490, 100]]
 
-            # this only for soccer
-            # tmp_mask[60:100, 60:490] = 0
+        # this for UBC hockey
+        boxes = [[303, 13, 976, 51]]
 
-            # this for UBC hockey
-            tmp_mask[13:51, 303:976] = 0
+        detections = self.bounding_box[0][index]
+        if detections.shape[0] > 0:
+            detections = detections[detections[:, 4] > threshold, 0:4]
+            boxes = np.vstack([boxes, detections.astype(np.int32)])
 
-            for j in range(self.bounding_box[0][index].shape[0]):
-                if self.bounding_box[0][index][j][4] > threshold:
-                    for x in range(int(self.bounding_box[0][index][j][0]),
-                                   int(self.bounding_box[0][index][j][2])):
-                        for y in range(int(self.bounding_box[0][index][j][1]),
-                                       int(self.bounding_box[0][index][j][3])):
-                            tmp_mask[y, x] = 0
+        # boxes out of the image are clipped
+        boxes = np.array(boxes, dtype=np.int32)
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, self.width)
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, self.height)
+        return boxes
+
+    def get_bounding_box_mask(self, index, threshold=0.6, return_boxes=False, out=None):
+        """
+        function to get mask to remove features on players
+        :param index: image index for sequence
+        :param threshold: threshold for bounding box detected by faster-rcnn
+        :param return_boxes: return the boxes of get_bounding_boxes instead of a mask,
+        keypoints_masking accepts both
+        :param out: uint8 array [height, width] to write the mask to, None for a new array
+        :return: a player mask for that frame (1 for no player, 0 for player)
+        """
+        if len(self.bounding_box) > 0:
+            boxes = self.get_bounding_boxes(index, threshold)
+            if return_boxes:
+                return boxes
+
+            if out is None:
+                tmp_mask = np.ones([self.height, self.width], dtype=np.uint8)
+            else:
+                assert out.shape == (self.height, self.width) and out.dtype == np.uint8
+                tmp_mask = out
+                tmp_mask.fill(1)
+            for x1, y1, x2, y2 in boxes:
+                tmp_mask[y1:y2, x1:x2] = 0
 
             return tmp_mask
 
+    def close(self):
+        """
+        stop decoding the video
+        """
+        if self.video is not None:
+            self.video.close()
+
     def get_ptz(self, index):
         return self.ground_truth_pan[index], self.ground_truth_tilt[index], self.ground_truth_f[index]
 
@@ -200,6 +452,9 @@ def vis_keypoints():
 
 
 def generate_ground_truth():
+    import scipy.io as sio
+    import scipy.signal as sig
+
     # obj = SequenceManager("./two_point_calib_dataset/highlights/seq3_anno.mat", "./seq3_blur",
     #                       "./objects_soccer.mat")
     #
@@ -271,7 +526,57 @@ def ut_ptz_camera():
     print(obj.camera.back_project_to_3D_point(-1726.9998, 1295.25688))
 
 
+def ut_prefetch_images():
+    """
+    Per-frame time of reading an image and detecting sift features, with and without prefetching.
+    """
+    sequence = SequenceManager(image_path="../../dataset/basketball/images")
+    indices = range(0, 300)
+
+    start_time = time.time()
+    for i in indices:
+        img = sequence.get_image_gray(i, dataset_type=0)
+        detect_sift(img, 300)
+    sequential_time = time.time() - start_time
+
+    for prefetch_num, thread_num in [(1, 1), (4, 2), (8, 4)]:
+        start_time = time.time()
+        for i, img in sequence.prefetch_images(indices, dataset_type=0,
+                                               prefetch_num=prefetch_num, thread_num=thread_num):
+            detect_sift(img, 300)
+        prefetch_time = time.time() - start_time
+
+        decode_time, wait_time = np.sum(sequence.decode_time), np.sum(sequence.wait_time)
+        print("prefetch %d images by %d threads: %.4f s per frame (sequential %.4f s), "
+              "decode %.3f s, %.3f s hidden" % (prefetch_num, thread_num, prefetch_time / len(indices),
+                                                 sequential_time / len(indices), decode_time,
+                                                 decode_time - wait_time))
+
+
+def ut_video_sequence():
+    """
+    Read every 2nd frame of a video clip and compare with the frames read by seeking.
+    """
+    video_path = "../../dataset/basketball/basketball.mp4"
+    sequence = SequenceManager(video_path=video_path, video_begin_frame=100, video_end_frame=400, video_stride=2)
+
+    start_time = time.time()
+    for i in range(sequence.length):
+        img = sequence.get_image_gray(i)
+        detect_sift(img, 300)
+    print("%d frames, %.4f s per frame" % (sequence.length, (time.time() - start_time) / sequence.length))
+
+    capture = cv.VideoCapture(video_path)
+    for i in [0, 1, sequence.length - 1]:
+        capture.set(cv.CAP_PROP_POS_FRAMES, 100 + i * 2)
+        _, img = capture.read()
+        print("frame %d, max difference %d" % (i, np.abs(img.astype(np.int32) - sequence.get_image(i)).max()))
+    sequence.close()
+
+
 if __name__ == '__main__':
+    from plot_util import draw_camera_plot
+
     # generate_ground_truth()
 
     gt_p, gt_t, gt_f = load_camera_pose("../../dataset/soccer_dataset/seq3/seq3_ground_truth.mat")
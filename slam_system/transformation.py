@@ -134,6 +134,85 @@ class TransFunction:
         y = -sqrt(f * f + dx * dx) * tan(relative_tilt) + v
         return x, y
 
+    @staticmethod
+    def from_ray_to_image_array(u, v, f, c_p, c_t, p, t):
+        """
+        vectorized version of from_ray_to_image.
+        camera parameters and rays can be arrays of the same length (or scalars), e.g.
+        one camera pose per observation.
+        :param u: camera parameter u
+        :param v: camera parameter v
+        :param f: camera parameter f, scalar or [N] array
+        :param c_p: camera pan, scalar or [N] array
+        :param c_t: camera tilt, scalar or [N] array
+        :param p: ray theta, [N] array
+        :param t: ray phi, [N] array
+        :return: x [N] array, y [N] array in image
+        """
+        tan_pan = np.tan(np.radians(p))
+        tan_tilt = np.tan(np.radians(t))
+        camera_pan = np.radians(c_p)
+        camera_tilt = np.radians(c_t)
+
+        sin_cp, cos_cp = np.sin(camera_pan), np.cos(camera_pan)
+        sin_ct, cos_ct = np.sin(camera_tilt), np.cos(camera_tilt)
+        norm = np.sqrt(tan_pan * tan_pan + 1)
+
+        numerator = tan_pan * cos_cp - sin_cp
+        denominator = tan_pan * sin_cp * cos_ct + tan_tilt * norm * sin_ct + cos_ct * cos_cp
+
+        relative_pan = np.arctan(numerator / denominator)
+        relative_tilt = np.arctan(-(tan_pan * sin_ct * sin_cp - tan_tilt * norm * cos_ct + sin_ct * cos_cp) /
+                                  np.sqrt(numerator * numerator + denominator * denominator))
+
+        dx = f * np.tan(relative_pan)
+        x = dx + u
+        y = -np.sqrt(f * f + dx * dx) * np.tan(relative_tilt) + v
+        return x, y
+
+    @staticmethod
+    def from_ray_to_image_pose_jacobian(f, c_p, c_t, p, t):
+        """
+        closed-form jacobian of from_ray_to_image_array to the camera pose, for rays in front of the camera.
+        With a = tan(relative_pan) * d, x = u + f * a / d and y = v - f * c / d
+        (a, d, c are numerator, denominator and the tilt numerator in from_ray_to_image).
+        :param f: camera parameter f
+        :param c_p: camera pan
+        :param c_t: camera tilt
+        :param p: ray theta, [N] array
+        :param t: ray phi, [N] array
+        :return: [N, 2, 3] d(x, y) / d(pan, tilt, f), angles in degree
+        """
+        tan_pan = np.tan(np.radians(p))
+        tan_tilt = np.tan(np.radians(t))
+        camera_pan = radians(c_p)
+        camera_tilt = radians(c_t)
+
+        sin_cp, cos_cp = sin(camera_pan), cos(camera_pan)
+        sin_ct, cos_ct = sin(camera_tilt), cos(camera_tilt)
+        norm = np.sqrt(tan_pan * tan_pan + 1)
+
+        a = tan_pan * cos_cp - sin_cp
+        d = tan_pan * sin_cp * cos_ct + tan_tilt * norm * sin_ct + cos_ct * cos_cp
+        c = -(tan_pan * sin_ct * sin_cp - tan_tilt * norm * cos_ct + sin_ct * cos_cp)
+
+        # derivatives of a, d and c to camera pan and tilt (in radian)
+        da_dp = -tan_pan * sin_cp - cos_cp
+        dd_dp = cos_ct * a
+        dc_dp = -sin_ct * a
+        dd_dt = c
+        dc_dt = -d
+
+        inv_d = 1.0 / d
+        jacobian = np.empty((len(tan_pan), 2, 3))
+        jacobian[:, 0, 0] = f * (da_dp * d - a * dd_dp) * inv_d * inv_d * pi / 180.0
+        jacobian[:, 1, 0] = -f * (dc_dp * d - c * dd_dp) * inv_d * inv_d * pi / 180.0
+        jacobian[:, 0, 1] = -f * a * dd_dt * inv_d * inv_d * pi / 180.0
+        jacobian[:, 1, 1] = -f * (dc_dt * d - c * dd_dt) * inv_d * inv_d * pi / 180.0
+        jacobian[:, 0, 2] = a * inv_d
+        jacobian[:, 1, 2] = -c * inv_d
+        return jacobian
+
     @staticmethod
     def from_image_to_ray(u, v, f, c_p, c_t, x, y):
         """
@@ -345,3 +424,31 @@ class TransFunction:
             rays = np.row_stack([rays, position])
 
         return rays
+
+
+def ut_from_ray_to_image_pose_jacobian():
+    """
+    Compare the closed-form pose jacobian with the central finite difference of from_ray_to_image_array.
+    """
+    u, v, pose = 640, 360, np.array([10, -8, 3000])
+    rays = np.column_stack([np.random.uniform(3, 17, 500), np.random.uniform(-13, -3, 500)])
+
+    jacobian = TransFunction.from_ray_to_image_pose_jacobian(pose[2], pose[0], pose[1], rays[:, 0], rays[:, 1])
+
+    jacobian_numerical = np.zeros(jacobian.shape)
+    for i, step in enumerate([1e-6, 1e-6, 1e-4]):
+        delta = np.zeros(3)
+        delta[i] = step
+        pose1, pose2 = pose + delta, pose - delta
+        x1, y1 = TransFunction.from_ray_to_image_array(u, v, pose1[2], pose1[0], pose1[1], rays[:, 0], rays[:, 1])
+        x2, y2 = TransFunction.from_ray_to_image_array(u, v, pose2[2], pose2[0], pose2[1], rays[:, 0], rays[:, 1])
+        jacobian_numerical[:, 0, i] = (x1 - x2) / (2 * step)
+        jacobian_numerical[:, 1, i] = (y1 - y2) / (2 * step)
+
+    error = np.abs(jacobian - jacobian_numerical).max()
+    print("max difference %g" % error)
+    assert error < 1e-5
+
+
+if __name__ == '__main__':
+    ut_from_ray_to_image_pose_jacobian()
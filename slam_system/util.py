@@ -6,21 +6,9 @@ Create by Jimmy, 2018.9
 
 import math
 import numpy as np
-import scipy.io as sio
 import cv2 as cv
 import random
 
-from sys import platform as sys_pf
-
-import matplotlib
-
-if sys_pf == 'darwin':
-    matplotlib.use("TkAgg")
-elif sys_pf == 'win32':
-    matplotlib.use('Qt4Agg')
-
-import matplotlib.pyplot as plt
-
 from image_process import blur_sub_image, detect_sift
 
 
@@ -79,20 +67,7 @@ def get_overlap_index(index1, index2):
     :param index2: array 2
     :return: overlapped numbers in two array
     """
-    index1_overlap = np.ndarray([0], np.int8)
-    index2_overlap = np.ndarray([0], np.int8)
-    ptr1 = 0
-    ptr2 = 0
-    while ptr1 < len(index1) and ptr2 < len(index2):
-        if index1[ptr1] == index2[ptr2]:
-            index1_overlap = np.append(index1_overlap, ptr1)
-            index2_overlap = np.append(index2_overlap, ptr2)
-            ptr1 += 1
-            ptr2 += 1
-        elif index1[ptr1] < index2[ptr2]:
-            ptr1 += 1
-        elif index1[ptr1] > index2[ptr2]:
-            ptr2 += 1
+    _, index1_overlap, index2_overlap = np.intersect1d(index1, index2, assume_unique=True, return_indices=True)
     return index1_overlap, index2_overlap
 
 
@@ -203,63 +178,6 @@ def uniform_point_sample_on_field(x_max, y_max, x_num, y_num):
     return np.array(point_list)
 
 
-def draw_camera_plot(ground_truth_pan, ground_truth_tilt, ground_truth_f,
-                     estimate_pan, estimate_tilt, estimate_f):
-    """
-    draw plot for ground truth and estimated camera pose.
-    """
-
-    sequence_length = len(ground_truth_pan)
-
-    plt.figure("pan percentage error")
-    x = np.array([i for i in range(sequence_length)])
-    plt.plot(x, (estimate_pan - ground_truth_pan) / ground_truth_pan * 100, 'b', label='predict')
-    plt.xlabel("frame")
-    plt.ylabel("error %")
-    plt.legend(loc="best")
-
-    plt.figure("tilt percentage error")
-    x = np.array([i for i in range(sequence_length)])
-    plt.plot(x, (estimate_tilt - ground_truth_tilt) / ground_truth_tilt * 100, 'b', label='predict')
-    plt.xlabel("frame")
-    plt.ylabel("error %")
-    plt.legend(loc="best")
-
-    plt.figure("f percentage error")
-    x = np.array([i for i in range(sequence_length)])
-    plt.plot(x, (estimate_f - ground_truth_f) / ground_truth_f * 100, 'b', label='predict')
-    plt.xlabel("frame")
-    plt.ylabel("error %")
-    plt.legend(loc="best")
-
-    """absolute value"""
-    plt.figure("pan")
-    x = np.array([i for i in range(sequence_length)])
-    plt.plot(x, ground_truth_pan, 'r', label='ground truth')
-    plt.plot(x, estimate_pan, 'b', label='predict')
-    plt.xlabel("frame")
-    plt.ylabel("pan angle")
-    plt.legend(loc="best")
-
-    plt.figure("tilt")
-    x = np.array([i for i in range(sequence_length)])
-    plt.plot(x, ground_truth_tilt, 'r', label='ground truth')
-    plt.plot(x, estimate_tilt, 'b', label='predict')
-    plt.xlabel("frame")
-    plt.ylabel("tilt angle")
-    plt.legend(loc="best")
-
-    plt.figure("f")
-    x = np.array([i for i in range(sequence_length)])
-    plt.plot(x, ground_truth_f, 'r', label='ground truth')
-    plt.plot(x, estimate_f, 'b', label='predict')
-    plt.xlabel("frame")
-    plt.ylabel("f")
-    plt.legend(loc="best")
-
-    plt.show()
-
-
 def save_camera_pose(pan, tilt, f, path):
     """
     This function saves camera pose to .mat file.
@@ -269,6 +187,9 @@ def save_camera_pose(pan, tilt, f, path):
     :param f: an array [n] of focal length
     :param path: folder path for mat file
     """
+    # scipy.io is only needed for dataset files, not at import
+    import scipy.io as sio
+
     camera_pose = dict()
     camera_pose['pan'] = pan
     camera_pose['tilt'] = tilt
@@ -283,6 +204,7 @@ def load_camera_pose(path, separate=False):
     :param separate: the pan-tilt-zoom pose saved in one array or separate(3) arrays
     :return: 3 arrays (pan, tilt, zoom) each of size [n]. (n is length of sequence)
     """
+    import scipy.io as sio
 
     camera_pos = sio.loadmat(path)
 
@@ -404,6 +326,8 @@ def ut_add_gaussian():
 
 
 if __name__ == '__main__':
+    from plot_util import draw_camera_plot
+
     # video_capture(
     # "/hdd/luke/hockey_data/USA 2-3 Canada - Men's Ice Hockey Gold Medal Match _ Vancouver 2010 Winter Olympics.mp4",
     #               "/hdd/luke/hockey_data/Olympic_2010/images/", 4072000, 25, 625)
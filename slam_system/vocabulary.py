@@ -0,0 +1,194 @@
+"""
+Vocabulary tree (hierarchical k-means) for keyframe retrieval.
+
+Nister and Stewenius, Scalable Recognition with a Vocabulary Tree, CVPR 2006.
+Descriptors are quantized into visual words. An image is a tf-idf weighted, L1 normalized histogram of words.
+"""
+
+import threading
+
+import numpy as np
+import cv2 as cv
+
+
+class VocabularyTree:
+    def __init__(self, branch_factor=8, depth=3):
+        """
+        :param branch_factor: number of children of each node
+        :param depth: number of levels, at most branch_factor ** depth words
+        """
+        self.branch_factor = branch_factor
+        self.depth = depth
+
+        # [M, D] float32 cluster centers of tree nodes, node 0 is the root
+        self.centers = np.ndarray([0, 0], dtype=np.float32)
+
+        # [M, branch_factor] child node index, -1 for leaf nodes
+        self.children = np.ndarray([0, branch_factor], dtype=np.int64)
+
+        # [M] word index of leaf nodes, -1 for inner nodes
+        self.word_index = np.ndarray([0], dtype=np.int64)
+
+        # database: key (e.g. image index of keyframe) -> [W] word histogram
+        self.word_histograms = dict()
+
+        # [W] number of images in database that have the word
+        self.document_frequency = np.ndarray([0])
+
+        # the database is shared by the mapping thread (add) and relocalization (query)
+        self._lock = threading.Lock()
+
+    @property
+    def word_num(self):
+        return len(self.document_frequency)
+
+    def train(self, descriptors):
+        """
+        build the tree by hierarchical k-means. The database is cleared.
+        :param descriptors: [N, D] descriptors from training images
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        b = self.branch_factor
+        criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 20, 0.1)
+
+        centers = [descriptors.mean(axis=0)]
+        children = [[-1] * b]
+        nodes = [(0, descriptors, 0)]
+        while len(nodes) > 0:
+            node, node_des, level = nodes.pop()
+            # too few descriptors to split, the node is a leaf
+            if level == self.depth or len(node_des) <= b:
+                continue
+
+            _, labels, node_centers = cv.kmeans(node_des, b, None, criteria, 1, cv.KMEANS_PP_CENTERS)
+            labels = labels.ravel()
+            for k in range(b):
+                child = len(centers)
+                centers.append(node_centers[k])
+                children.append([-1] * b)
+                children[node][k] = child
+                nodes.append((child, node_des[labels == k], level + 1))
+
+        self.centers = np.array(centers, dtype=np.float32)
+        self.children = np.array(children, dtype=np.int64)
+
+        is_leaf = self.children[:, 0] < 0
+        self.word_index = np.full(len(self.centers), -1, dtype=np.int64)
+        self.word_index[is_leaf] = np.arange(np.count_nonzero(is_leaf))
+
+        self.word_histograms = dict()
+        self.document_frequency = np.zeros(np.count_nonzero(is_leaf))
+
+    def quantize(self, descriptors):
+        """
+        :param descriptors: [N, D] descriptors
+        :return: [N] word index of each descriptor
+        """
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        node = np.zeros(len(descriptors), dtype=np.int64)
+        for _ in range(self.depth):
+            child = self.children[node]
+            inner = child[:, 0] >= 0
+            if not inner.any():
+                break
+            child = child[inner]
+            dist = np.sum(np.square(descriptors[inner, np.newaxis, :] - self.centers[child]), axis=2)
+            node[inner] = child[np.arange(len(child)), np.argmin(dist, axis=1)]
+        return self.word_index[node]
+
+    def add(self, key, descriptors):
+        """
+        add an image to the database, the vocabulary is not changed.
+        :param key: hashable key of the image
+        :param descriptors: [N, D] descriptors of the image
+        """
+        if key in self.word_histograms:
+            return
+        histogram = np.bincount(self.quantize(descriptors), minlength=self.word_num).astype(np.float64)
+        with self._lock:
+            if key in self.word_histograms:
+                return
+            self.word_histograms[key] = histogram
+            self.document_frequency += histogram > 0
+
+    def remove(self, key):
+        with self._lock:
+            if key in self.word_histograms:
+                self.document_frequency -= self.word_histograms.pop(key) > 0
+
+    def _bow_vectors(self, histograms):
+        """
+        :param histograms: [K, W] word histograms
+        :return: [K, W] L1 normalized tf-idf vectors
+        """
+        idf = np.log(max(len(self.word_histograms), 1) / np.maximum(self.document_frequency, 1))
+        vectors = histograms * idf
+        norm = np.sum(np.abs(vectors), axis=1, keepdims=True)
+        return vectors / np.maximum(norm, 1e-12)
+
+    def query(self, descriptors, keys=None, top_k=5):
+        """
+        rank database images by similarity to the query image
+        :param descriptors: [N, D] descriptors of query image
+        :param keys: candidate keys, None for all images in the database
+        :param top_k: number of returned images
+        :return: list of keys and [top_k] scores in [0, 1], best first
+        """
+        if len(descriptors) == 0:
+            return [], np.ndarray([0])
+        histogram = np.bincount(self.quantize(descriptors), minlength=self.word_num).astype(np.float64)
+
+        with self._lock:
+            if keys is None:
+                keys = list(self.word_histograms.keys())
+            keys = [key for key in keys if key in self.word_histograms]
+            if len(keys) == 0:
+                return [], np.ndarray([0])
+            query_vector = self._bow_vectors(histogram.reshape(1, -1))
+            database_vectors = self._bow_vectors(np.array([self.word_histograms[key] for key in keys]))
+
+        # L1 score of Nister and Stewenius
+        scores = 1 - 0.5 * np.sum(np.abs(database_vectors - query_vector), axis=1)
+        order = np.argsort(-scores)[:top_k]
+        return [keys[i] for i in order], scores[order]
+
+    def save(self, path):
+        """
+        save the vocabulary (not the database) to a .npz file
+        """
+        np.savez(path, branch_factor=self.branch_factor, depth=self.depth,
+                 centers=self.centers, children=self.children, word_index=self.word_index)
+
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        vocabulary = VocabularyTree(int(data['branch_factor']), int(data['depth']))
+        vocabulary.centers = data['centers']
+        vocabulary.children = data['children']
+        vocabulary.word_index = data['word_index']
+        vocabulary.document_frequency = np.zeros(np.count_nonzero(vocabulary.word_index >= 0))
+        return vocabulary
+
+
+def ut_vocabulary_tree():
+    """
+    Retrieve noisy copies of synthesized images.
+    """
+    centers = np.random.uniform(0, 100, (200, 128))
+    images = [centers[np.random.choice(200, 300)] + np.random.normal(0, 3, (300, 128)) for _ in range(50)]
+
+    vocabulary = VocabularyTree(8, 3)
+    vocabulary.train(np.vstack(images))
+    for i, des in enumerate(images):
+        vocabulary.add(i, des)
+
+    correct = 0
+    for i, des in enumerate(images):
+        query_des = des[np.random.choice(300, 150, replace=False)] + np.random.normal(0, 3, (150, 128))
+        keys, scores = vocabulary.query(query_des, top_k=3)
+        correct += keys[0] == i
+    print("words %d, top-1 retrieval %d / %d" % (vocabulary.word_num, correct, len(images)))
+
+
+if __name__ == '__main__':
+    ut_vocabulary_tree()